@@ -0,0 +1,603 @@
+''' Synthetic pooled screens for measuring pipeline throughput.
+
+SyntheticScreen writes quartet fastqs for a screen built from a target and
+guide library in repair_seq/metadata, with families of reads sharing a UMI,
+editing outcomes (deletions, insertions, donor integration, and insertions
+of foreign sequence standing in for genomic capture) and sequencing errors.
+
+run_benchmark times demultiplexing and each stage of processing the
+resulting pools, recording reads/sec and peak RSS for each stage, and can
+compare the results to a previous run to catch performance regressions.
+
+check_partitioned_demux demuxes a screen both into per-experiment files and
+into partitioned containers and checks that every experiment reads back
+the same reads from each.
+'''
+
+import argparse
+import datetime
+import hashlib
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+import traceback
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from hits import fastq, utilities
+from knock_knock import target_info
+
+import repair_seq.compression
+import repair_seq.demux
+import repair_seq.guide_library
+import repair_seq.pooled_screen
+
+memoized_property = utilities.memoized_property
+
+metadata_dir = Path(os.path.realpath(__file__)).parent / 'metadata'
+
+bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+default_outcome_rates = {
+    'wild type': 0.55,
+    'deletion': 0.25,
+    'insertion': 0.1,
+    'donor': 0.05,
+    'genomic insertion': 0.05,
+}
+
+stages = ['demux', 'preprocess', 'align', 'categorize', 'merge']
+
+def install_metadata(base_dir, target, variable_guide_library):
+    ''' Copies the target and guide library a synthetic screen uses into
+    base_dir, leaving anything already there in place.
+    '''
+    for subdir, name in [('targets', target), ('guides', variable_guide_library)]:
+        dest = Path(base_dir) / subdir / name
+        if not dest.exists():
+            shutil.copytree(str(metadata_dir / subdir / name), str(dest))
+
+def random_seqs(rng, num_seqs, length):
+    return [seq.tobytes().decode() for seq in bases[rng.integers(0, 4, size=(num_seqs, length))]]
+
+def distinct_seqs(rng, num_seqs, length, min_distance=3):
+    seqs = []
+    while len(seqs) < num_seqs:
+        seq = random_seqs(rng, 1, length)[0]
+        if all(sum(a != b for a, b in zip(seq, other)) >= min_distance for other in seqs):
+            seqs.append(seq)
+    return seqs
+
+class SyntheticScreen:
+    ''' A group of num_pools pools, each with num_UMIs UMIs spread across
+    num_guides guides from variable_guide_library, sequenced as
+    num_units quartets.
+
+    Each UMI is assigned one outcome, and the number of reads sharing it is
+    1 + a negative binomial with mean mean_reads_per_UMI - 1. Substitution
+    errors are introduced at a rate that increases linearly from
+    error_rates[0] at the start of each read to error_rates[1] at its end,
+    and most errored bases get low quality scores.
+
+    Everything is determined by seed.
+    '''
+    def __init__(self,
+                 base_dir,
+                 group='synthetic',
+                 target='pAX198',
+                 variable_guide_library='AX227',
+                 sgRNAs='SpCas9 target 1',
+                 donor='oBA701',
+                 outcome_primer='reverse_primer',
+                 guide_primer='forward_primer',
+                 num_pools=2,
+                 num_units=2,
+                 num_guides=50,
+                 num_UMIs=20000,
+                 mean_reads_per_UMI=8,
+                 outcome_rates=None,
+                 error_rates=(0.001, 0.01),
+                 R2_read_length=258,
+                 seed=0,
+                ):
+        self.base_dir = Path(base_dir)
+        self.group = group
+        self.target = target
+        self.variable_guide_library_name = variable_guide_library
+        self.sgRNAs = sgRNAs
+        self.donor = donor
+        self.outcome_primer = outcome_primer
+        self.guide_primer = guide_primer
+        self.num_pools = num_pools
+        self.num_units = num_units
+        self.num_guides = num_guides
+        self.num_UMIs = num_UMIs
+        self.mean_reads_per_UMI = mean_reads_per_UMI
+        self.error_rates = error_rates
+        self.R2_read_length = R2_read_length
+        self.seed = seed
+
+        if outcome_rates is None:
+            outcome_rates = dict(default_outcome_rates)
+
+        if donor is None:
+            outcome_rates.pop('donor', None)
+
+        total = sum(outcome_rates.values())
+        self.outcome_rates = {outcome: rate / total for outcome, rate in outcome_rates.items()}
+
+        self.data_dir = self.base_dir / 'data' / group
+        self.sample_sheet_fn = self.data_dir / 'sample_sheet.yaml'
+
+        self.rng = np.random.default_rng(seed)
+
+    @memoized_property
+    def target_info(self):
+        install_metadata(self.base_dir, self.target, self.variable_guide_library_name)
+
+        ti = target_info.TargetInfo(self.base_dir,
+                                    self.target,
+                                    primer_names=[self.outcome_primer, self.guide_primer],
+                                    sgRNAs=self.sgRNAs,
+                                    donor=self.donor,
+                                    sequencing_start_feature_name=self.outcome_primer,
+                                    infer_homology_arms=True,
+                                   )
+        return ti
+
+    @memoized_property
+    def variable_guide_library(self):
+        install_metadata(self.base_dir, self.target, self.variable_guide_library_name)
+        return repair_seq.guide_library.GuideLibrary(self.base_dir, self.variable_guide_library_name)
+
+    @memoized_property
+    def guides(self):
+        all_guides = list(self.variable_guide_library.guides)
+        num_guides = min(self.num_guides, len(all_guides))
+        return sorted(self.rng.choice(all_guides, size=num_guides, replace=False))
+
+    @memoized_property
+    def guide_deletion_multipliers(self):
+        ''' Per-guide scaling of the deletion rate so that guides have
+        different outcome distributions.
+        '''
+        return dict(zip(self.guides, self.rng.lognormal(0, 0.5, size=len(self.guides))))
+
+    @memoized_property
+    def pool_indices(self):
+        pools = [f'pool{i}' for i in range(self.num_pools)]
+        return dict(zip(pools, distinct_seqs(self.rng, self.num_pools, 8)))
+
+    @memoized_property
+    def pool_names(self):
+        return [f'{self.group}_{pool}' for pool in self.pool_indices]
+
+    @memoized_property
+    def amplicon(self):
+        ''' The amplicon on the + strand of the target and the number of its
+        bases before the cut.
+        '''
+        ti = self.target_info
+        interval = ti.amplicon_interval
+        amplicon = ti.target_sequence[interval.start:interval.end + 1]
+        cut = ti.cut_after - interval.start + 1
+        return amplicon, cut
+
+    def edited_amplicon(self, outcome):
+        amplicon, cut = self.amplicon
+
+        if outcome == 'wild type':
+            edited = amplicon
+
+        elif outcome == 'deletion':
+            length = min(int(self.rng.geometric(0.1)), cut)
+            start = cut - int(self.rng.integers(0, length + 1))
+            edited = amplicon[:start] + amplicon[start + length:]
+
+        elif outcome == 'insertion':
+            if self.rng.random() < 0.7:
+                # Most 1-nt insertions duplicate the base before the cut.
+                inserted = amplicon[cut - 1]
+            else:
+                inserted = random_seqs(self.rng, 1, int(self.rng.integers(1, 4)))[0]
+            edited = amplicon[:cut] + inserted + amplicon[cut:]
+
+        elif outcome == 'donor':
+            interval = self.target_info.amplicon_interval
+            SNVs = self.target_info.donor_SNVs
+            edited = list(amplicon)
+            for name, target_SNV in SNVs['target'].items():
+                donor_base = SNVs['donor'][name]['base']
+                if target_SNV['strand'] == '-':
+                    donor_base = utilities.reverse_complement(donor_base)
+                edited[target_SNV['position'] - interval.start] = donor_base
+            edited = ''.join(edited)
+
+        elif outcome == 'genomic insertion':
+            # Without reference genomes available, random sequence stands in
+            # for captured genomic fragments.
+            inserted = random_seqs(self.rng, 1, int(self.rng.integers(20, 100)))[0]
+            edited = amplicon[:cut] + inserted + amplicon[cut:]
+
+        else:
+            raise ValueError(outcome)
+
+        return edited
+
+    def outcome_read_seq(self, outcome):
+        edited = self.edited_amplicon(outcome)
+
+        if self.target_info.sequencing_direction == '-':
+            edited = utilities.reverse_complement(edited)
+
+        return edited[:self.R2_read_length]
+
+    def add_errors(self, seq, num_reads):
+        ''' Returns num_reads copies of seq with independent sequencing errors,
+        as lists of sequences and qualities.
+        '''
+        seq_bytes = np.frombuffer(seq.encode(), dtype=np.uint8)
+        length = len(seq_bytes)
+
+        error_probs = np.linspace(*self.error_rates, num=length)
+        errors = self.rng.random((num_reads, length)) < error_probs
+
+        codes = np.searchsorted(bases, seq_bytes)
+        shifted = (codes + self.rng.integers(1, 4, size=(num_reads, length))) % 4
+
+        seqs = np.where(errors, bases[shifted], seq_bytes)
+
+        quals = np.full((num_reads, length), ord('F'), dtype=np.uint8)
+        low_quality = errors & (self.rng.random((num_reads, length)) < 0.7)
+        quals[low_quality] = np.frombuffer(b',:#', dtype=np.uint8)[self.rng.integers(0, 3, size=low_quality.sum())]
+
+        return [row.tobytes().decode() for row in seqs], [row.tobytes().decode() for row in quals]
+
+    def UMI_families(self, pool):
+        ''' Yields lists of (I1, I2, R1, R2) seq, qual pairs for the reads of
+        each UMI in pool.
+        '''
+        full_guide_seqs = self.variable_guide_library.full_guide_seqs
+        outcomes = list(self.outcome_rates)
+        outcome_probs = np.array([self.outcome_rates[outcome] for outcome in outcomes])
+
+        for UMI in random_seqs(self.rng, self.num_UMIs, 12):
+            guide = self.guides[int(self.rng.integers(0, len(self.guides)))]
+
+            probs = outcome_probs.copy()
+            if 'deletion' in outcomes:
+                probs[outcomes.index('deletion')] *= self.guide_deletion_multipliers[guide]
+            probs /= probs.sum()
+
+            outcome = outcomes[self.rng.choice(len(outcomes), p=probs)]
+
+            num_reads = 1 + int(self.rng.negative_binomial(2, 2 / (2 + self.mean_reads_per_UMI - 1)))
+
+            index = self.pool_indices[pool]
+            if self.rng.random() < 0.02:
+                # Reads with an index that doesn't belong to any pool.
+                index = random_seqs(self.rng, 1, len(index))[0]
+
+            R2_seq = self.outcome_read_seq(outcome)
+
+            family = [
+                self.add_errors(UMI, num_reads),
+                self.add_errors(index, num_reads),
+                self.add_errors(full_guide_seqs[guide][:45], num_reads),
+                self.add_errors(R2_seq, num_reads),
+            ]
+
+            yield [[(seqs[i], quals[i]) for seqs, quals in family] for i in range(num_reads)]
+
+    def fastq_fn(self, unit, which):
+        return self.data_dir / f'{unit}_{which}.fastq.gz'
+
+    def write(self, block_size=100000):
+        ''' Writes fastqs and a sample sheet. Reads are shuffled within blocks
+        of block_size reads to imitate the lack of ordering by UMI in real data,
+        and blocks are dealt out to units in turn.
+        '''
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+
+        units = [f'unit{i}' for i in range(self.num_units)]
+
+        fhs = {(unit, which): repair_seq.compression.open_file(self.fastq_fn(unit, which), 'wt')
+               for unit in units for which in fastq.quartet_order
+              }
+
+        num_reads = {unit: 0 for unit in units}
+        num_blocks = 0
+
+        def write_block(block):
+            nonlocal num_blocks
+
+            unit = units[num_blocks % len(units)]
+            num_blocks += 1
+
+            for i in self.rng.permutation(len(block)):
+                read_number = num_reads[unit]
+                num_reads[unit] += 1
+
+                for read_i, (which, (seq, qual)) in enumerate(zip(fastq.quartet_order, block[i])):
+                    name = f'SYN:{unit}:{read_number} {read_i + 1}:N:0:0'
+                    fhs[unit, which].write(str(fastq.Read(name, seq, qual)))
+
+        block = []
+
+        for pool in self.pool_indices:
+            for family in self.UMI_families(pool):
+                block.extend(family)
+
+                if len(block) >= block_size:
+                    write_block(block)
+                    block = []
+
+        if len(block) > 0:
+            write_block(block)
+
+        for fh in fhs.values():
+            fh.close()
+
+        pool_details = {}
+        for pool, index in self.pool_indices.items():
+            pool_details[pool] = {
+                'index': [index],
+                'target_info': self.target,
+                'sgRNAs': self.sgRNAs,
+                'donor': self.donor,
+                'outcome_primer': self.outcome_primer,
+                'guide_primer': self.guide_primer,
+                'R2_read_length': self.R2_read_length,
+                'infer_homology_arms': True,
+                'supplemental_indices': [],
+                'categorizer': 'pooled_layout',
+                'has_UMIs': True,
+            }
+
+        sample_sheet = {
+            'group_name': self.group,
+            'variable_guide_library': self.variable_guide_library_name,
+            'quartets': {unit: {which: f'{unit}_{which}' for which in fastq.quartet_order} for unit in units},
+            'pool_details': pool_details,
+        }
+
+        for unit in units:
+            sample_sheet['quartets'][unit]['num_reads'] = num_reads[unit]
+
+        self.sample_sheet_fn.write_text(yaml.safe_dump(sample_sheet, default_flow_style=False))
+
+        return sum(num_reads.values())
+
+    @property
+    def total_reads(self):
+        sample_sheet = yaml.safe_load(self.sample_sheet_fn.read_text())
+        return sum(details['num_reads'] for details in sample_sheet['quartets'].values())
+
+def run_in_child(function, *args):
+    ''' Runs function(*args) in a new process and returns the elapsed time and
+    the peak RSS (in bytes) of the largest process involved, including any
+    worker processes it started.
+    '''
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+
+    def target():
+        try:
+            start_time = time.monotonic()
+            function(*args)
+            elapsed = time.monotonic() - start_time
+
+            # ru_maxrss is in KB on Linux.
+            peak_RSS = 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                                 )
+            queue.put((elapsed, peak_RSS, None))
+        except Exception:
+            queue.put((None, None, traceback.format_exc()))
+
+    process = context.Process(target=target)
+    process.start()
+    elapsed, peak_RSS, error = queue.get()
+    process.join()
+
+    if error is not None:
+        raise RuntimeError(error)
+
+    return elapsed, peak_RSS
+
+def demux_stage(screen, num_processes):
+    for pool_name in screen.pool_names:
+        pool_dir = screen.base_dir / 'results' / pool_name
+        if pool_dir.exists():
+            shutil.rmtree(str(pool_dir))
+
+    repair_seq.demux.demux_group(screen.base_dir, screen.group, num_processes=num_processes, restart=True)
+
+def pool_stage(screen, stage, num_processes):
+    logger = logging.getLogger(__name__)
+
+    for pool_name in screen.pool_names:
+        pool = repair_seq.pooled_screen.get_pool(screen.base_dir, pool_name)
+
+        if stage == 'merge':
+            pool.merge_experiment_outputs()
+        else:
+            pool.process_experiment_stage(stage, num_processes, logger)
+
+def experiment_read_digests(screen):
+    ''' Number and hash of the merged demuxed reads of every experiment in
+    screen's pools that has any.
+    '''
+    digests = {}
+
+    for pool_name in screen.pool_names:
+        pool = repair_seq.pooled_screen.get_pool(screen.base_dir, pool_name)
+
+        for fixed_guide, variable_guide in pool.guide_combinations:
+            exp = pool.single_guide_experiment(fixed_guide, variable_guide, no_progress=True)
+
+            digest = hashlib.sha256()
+            num_reads = 0
+
+            for name, record in exp.merged_records:
+                digest.update(record)
+                num_reads += 1
+
+            if num_reads > 0:
+                digests[pool_name, exp.sample_name] = (num_reads, digest.hexdigest())
+
+    return digests
+
+def check_partitioned_demux(screen, num_processes=8):
+    ''' Demuxes screen with and without partitioned_chunks and raises a
+    ValueError if any experiment gets different reads. Returns the number
+    of experiments compared.
+    '''
+    sample_sheet_text = screen.sample_sheet_fn.read_text()
+
+    digests = {}
+
+    try:
+        for partitioned in [False, True]:
+            sample_sheet = yaml.safe_load(sample_sheet_text)
+            sample_sheet['partitioned_chunks'] = partitioned
+            screen.sample_sheet_fn.write_text(yaml.safe_dump(sample_sheet, default_flow_style=False))
+
+            run_in_child(demux_stage, screen, num_processes)
+
+            digests[partitioned] = experiment_read_digests(screen)
+    finally:
+        screen.sample_sheet_fn.write_text(sample_sheet_text)
+
+    all_keys = set(digests[False]) | set(digests[True])
+    differing = sorted(key for key in all_keys if digests[False].get(key) != digests[True].get(key))
+
+    if len(differing) > 0:
+        raise ValueError(f'partitioned demux gave different reads for {len(differing)} experiments, e.g. {differing[:3]}')
+
+    if len(all_keys) == 0:
+        raise ValueError('demux produced no reads to compare')
+
+    return len(all_keys)
+
+def run_benchmark(screen, num_processes=8, stages_to_run=None):
+    ''' Times each of stages_to_run (all stages by default) on screen, which
+    must already have been written. Returns a DataFrame with seconds,
+    reads/sec (of input reads) and peak RSS in GB for each stage.
+    '''
+    if stages_to_run is None:
+        stages_to_run = stages
+
+    total_reads = screen.total_reads
+
+    results = {}
+
+    for stage in stages:
+        if stage not in stages_to_run:
+            continue
+
+        logging.info(f'Running {stage}')
+
+        if stage == 'demux':
+            elapsed, peak_RSS = run_in_child(demux_stage, screen, num_processes)
+        else:
+            elapsed, peak_RSS = run_in_child(pool_stage, screen, stage, num_processes)
+
+        results[stage] = {
+            'seconds': elapsed,
+            'reads_per_second': total_reads / elapsed,
+            'peak_RSS_GB': peak_RSS / 1e9,
+        }
+
+        logging.info(f'{stage}: {elapsed:.1f}s, {total_reads / elapsed:,.0f} reads/s, {peak_RSS / 1e9:.2f} GB')
+
+    results = pd.DataFrame(results).T
+    results.index.name = 'stage'
+
+    return results
+
+def find_regressions(results, baseline, tolerance=0.1):
+    ''' Returns the stages whose throughput in results is more than
+    tolerance (as a fraction) below their throughput in baseline.
+    '''
+    shared = results.index.intersection(baseline.index)
+    ratios = results.loc[shared, 'reads_per_second'] / baseline.loc[shared, 'reads_per_second']
+    return list(ratios[ratios < 1 - tolerance].index)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s: %(message)s',
+                        datefmt='%y-%m-%d %H:%M:%S',
+                        level=logging.INFO,
+                       )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base_dir', type=Path)
+    parser.add_argument('--group', default='synthetic')
+    parser.add_argument('--target', default='pAX198')
+    parser.add_argument('--variable_guide_library', default='AX227')
+    parser.add_argument('--sgRNAs', default='SpCas9 target 1')
+    parser.add_argument('--donor', default='oBA701')
+    parser.add_argument('--num_pools', type=int, default=2)
+    parser.add_argument('--num_units', type=int, default=2)
+    parser.add_argument('--num_guides', type=int, default=50)
+    parser.add_argument('--num_UMIs', type=int, default=20000, help='UMIs per pool')
+    parser.add_argument('--mean_reads_per_UMI', type=float, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help='rewrite fastqs even if they already exist')
+    parser.add_argument('--num_processes', type=int, default=8)
+    parser.add_argument('--stages', nargs='+', choices=stages, default=stages)
+    parser.add_argument('--baseline', type=Path, help='results of a previous run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='fractional drop in reads/sec that counts as a regression')
+    parser.add_argument('--check_partitioned', action='store_true', help='first check that partitioned demux output matches per-experiment files')
+
+    args = parser.parse_args()
+
+    donor = None if args.donor in ('', 'none') else args.donor
+
+    screen = SyntheticScreen(args.base_dir,
+                             group=args.group,
+                             target=args.target,
+                             variable_guide_library=args.variable_guide_library,
+                             sgRNAs=args.sgRNAs,
+                             donor=donor,
+                             num_pools=args.num_pools,
+                             num_units=args.num_units,
+                             num_guides=args.num_guides,
+                             num_UMIs=args.num_UMIs,
+                             mean_reads_per_UMI=args.mean_reads_per_UMI,
+                             seed=args.seed,
+                            )
+
+    if args.regenerate or not screen.sample_sheet_fn.exists():
+        logging.info(f'Writing synthetic screen to {screen.data_dir}')
+        total_reads = screen.write()
+        logging.info(f'Wrote {total_reads:,} reads')
+
+    if args.check_partitioned:
+        num_experiments = check_partitioned_demux(screen, num_processes=args.num_processes)
+        print(f'Partitioned demux matched per-experiment files for {num_experiments:,} experiments')
+
+    results = run_benchmark(screen, num_processes=args.num_processes, stages_to_run=args.stages)
+
+    results_dir = args.base_dir / 'benchmarks'
+    results_dir.mkdir(exist_ok=True)
+    results_fn = results_dir / f'{args.group}_{datetime.datetime.now():%y%m%d-%H%M%S}.txt'
+    results.to_csv(results_fn, sep='\t')
+
+    print(results.to_string(float_format='{:,.2f}'.format))
+    print(f'Results written to {results_fn}')
+
+    if args.baseline is not None:
+        baseline = pd.read_csv(args.baseline, sep='\t', index_col='stage')
+        regressions = find_regressions(results, baseline, tolerance=args.tolerance)
+
+        if len(regressions) > 0:
+            print(f'Throughput regressed by more than {args.tolerance:.0%} in: {", ".join(regressions)}')
+            raise SystemExit(1)
@@ -0,0 +1,201 @@
+''' An on-disk cache of categorization results, shared across runs and pools.
+
+Entries are keyed by a context and a read sequence. The context is a hash of
+everything else that categorization depends on: the reference sequences and
+features of the target info, the categorizer class and the source of the
+modules defining it, and categorization settings. A changed categorizer
+therefore never sees results from an old one, but a replicate pool on the
+same target, or a rerun with an unchanged categorizer, only categorizes
+sequences that haven't been seen before.
+
+Each entry also holds the alignments the sequence was categorized from, and
+the cache holds one bam header per context for rebuilding them, so that reads
+whose outcomes come from the cache can be shown and written to outcome bams
+without being aligned again.
+
+Enable for a pool with an entry in its sample sheet of either
+
+    categorization_cache: true
+
+to use base_dir/categorization_cache.sqlite, or a path to the cache file.
+'''
+
+import hashlib
+import inspect
+import sqlite3
+
+from pathlib import Path
+
+import pysam
+
+from hits import utilities
+
+memoized_property = utilities.memoized_property
+
+def categorizer_version(categorizer):
+    ''' Qualified class name of categorizer and a hash of the source files of
+    every class it inherits from, so that editing any of them changes the version.
+    '''
+    digest = hashlib.sha256()
+
+    for cls in categorizer.__mro__:
+        try:
+            source_fn = inspect.getsourcefile(cls)
+        except TypeError:
+            # Built-in classes have no source.
+            continue
+
+        if source_fn is not None:
+            digest.update(Path(source_fn).read_bytes())
+
+    return f'{categorizer.__module__}.{categorizer.__qualname__}:{digest.hexdigest()[:16]}'
+
+def target_info_fingerprint(ti):
+    digest = hashlib.sha256()
+
+    for name, seq in sorted(ti.reference_sequences.items()):
+        digest.update(f'{name}\t{seq}\n'.encode())
+
+    for (ref_name, feature_name), feature in sorted(ti.features.items()):
+        digest.update(f'{ref_name}\t{feature_name}\t{feature.start}\t{feature.end}\t{feature.strand}\n'.encode())
+
+    return digest.hexdigest()
+
+def context(ti, categorizer, mode, error_corrected, supplemental_index_names):
+    fields = [
+        target_info_fingerprint(ti),
+        categorizer_version(categorizer),
+        str(mode),
+        str(error_corrected),
+        ';'.join(supplemental_index_names),
+    ]
+    return hashlib.sha256('\n'.join(fields).encode()).hexdigest()
+
+def serialize_special_alignment(al):
+    ''' Stores the reference name and length along with the SAM line so that the
+    alignment can be rebuilt without the header of the bam it came from.
+    '''
+    if al is None:
+        return None
+    else:
+        reference_length = al.header.get_reference_length(al.reference_name)
+        return f'{al.reference_name}\t{reference_length}\t{al.to_string()}'
+
+def deserialize_special_alignment(serialized):
+    if serialized is None:
+        return None
+    else:
+        reference_name, reference_length, sam_line = serialized.split('\t', 2)
+        header = pysam.AlignmentHeader.from_references([reference_name], [int(reference_length)])
+        return pysam.AlignedSegment.fromstring(sam_line, header)
+
+def serialize_alignments(als):
+    return '\n'.join(al.to_string() for al in als)
+
+def deserialize_alignments(serialized, header, query_name):
+    ''' Rebuilds alignments with header, renamed to query_name. '''
+    als = []
+
+    for sam_line in serialized.split('\n'):
+        if sam_line == '':
+            continue
+
+        al = pysam.AlignedSegment.fromstring(sam_line, header)
+        al.query_name = query_name
+        als.append(al)
+
+    return als
+
+class CategorizationCache:
+    ''' Maps sequences to (inferred_amplicon_length, category, subcategory, details)
+    tuples, serialized special alignments and serialized alignments within one context.
+    Many processes can read and write the same cache file.
+    '''
+    def __init__(self, fn, context):
+        self.fn = Path(fn)
+        self.context = context
+
+    @memoized_property
+    def connection(self):
+        connection = sqlite3.connect(self.fn, timeout=600)
+        connection.execute('PRAGMA journal_mode=WAL')
+
+        # Entries written before alignments were stored can't be used.
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(outcomes)')]
+        if len(columns) > 0 and 'alignments' not in columns:
+            connection.execute('DROP TABLE outcomes')
+
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS outcomes (
+                context TEXT NOT NULL,
+                seq TEXT NOT NULL,
+                inferred_amplicon_length INTEGER NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT NOT NULL,
+                details TEXT NOT NULL,
+                special_alignment TEXT,
+                alignments TEXT NOT NULL,
+                PRIMARY KEY (context, seq)
+            ) WITHOUT ROWID
+        ''')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS headers (
+                context TEXT PRIMARY KEY,
+                header TEXT NOT NULL
+            )
+        ''')
+        connection.commit()
+        return connection
+
+    def lookup(self, seqs, batch_size=500):
+        ''' Returns a dictionary from each of seqs that is in the cache to its
+        ((inferred_amplicon_length, category, subcategory, details), special_alignment, alignments)
+        '''
+        found = {}
+
+        columns = 'seq, inferred_amplicon_length, category, subcategory, details, special_alignment, alignments'
+        for seq, *fields, special_alignment, alignments in self.select(columns, seqs, batch_size):
+            found[seq] = (tuple(fields), special_alignment, alignments)
+
+        return found
+
+    def contains(self, seqs, batch_size=500):
+        ''' Returns the set of seqs that are in the cache. '''
+        return {seq for seq, in self.select('seq', seqs, batch_size)}
+
+    def select(self, columns, seqs, batch_size):
+        seqs = list(seqs)
+
+        for start in range(0, len(seqs), batch_size):
+            batch = seqs[start:start + batch_size]
+            placeholders = ','.join('?' * len(batch))
+            query = f'''
+                SELECT {columns}
+                FROM outcomes
+                WHERE context = ? AND seq IN ({placeholders})
+            '''
+            yield from self.connection.execute(query, [self.context] + batch)
+
+    def store(self, entries, header):
+        ''' entries: iterable of (seq, (inferred_amplicon_length, category, subcategory, details), special_alignment, alignments)
+        header: the header of the bam that alignments came from
+        '''
+        rows = [(self.context, seq, *fields, special_alignment, alignments) for seq, fields, special_alignment, alignments in entries]
+
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO headers VALUES (?, ?)', (self.context, str(header)))
+            self.connection.executemany('INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def header(self):
+        ''' The header that stored alignments were written with. '''
+        row = self.connection.execute('SELECT header FROM headers WHERE context = ?', (self.context,)).fetchone()
+
+        if row is None:
+            return None
+        else:
+            return pysam.AlignmentHeader.from_text(row[0])
+
+    def close(self):
+        if hasattr(self, '_memoized_connection'):
+            self.connection.close()
+            del self._memoized_connection
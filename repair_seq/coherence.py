@@ -1,9 +1,14 @@
+import heapq
+import itertools
+import os
+import tempfile
+
 from collections import Counter
 
 from knock_knock import outcome_record
 from hits.utilities import group_by
 
-from .collapse_cython import hamming_distance_matrix, register_corrections
+from .collapse_cython import hamming_distance, hamming_distance_matrix, register_corrections
 
 Pooled_UMI_Outcome = outcome_record.OutcomeRecord_factory(
     columns_arg=[
@@ -38,53 +43,225 @@ gDNA_Outcome = outcome_record.OutcomeRecord_factory(
     converters_arg={'inferred_amplicon_length': int},
 )
 
-def collapse_pooled_UMI_outcomes(outcome_iter):
+def UMI_and_cluster_id(outcome):
+    return outcome.UMI, outcome.cluster_id
+
+def external_sort_outcomes(outcome_iter, chunk_size=1000000):
+    ''' Yields the outcomes in outcome_iter sorted by (UMI, cluster_id).
+    If there are more than chunk_size outcomes, sorted runs of chunk_size
+    outcomes are written to temporary files and merged, so that no more than
+    chunk_size are held in memory at once.
+    '''
+    run_fns = []
+    chunk = []
+    outcome_class = None
+
+    def spill(chunk):
+        chunk.sort(key=UMI_and_cluster_id)
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as fh:
+            run_fns.append(fh.name)
+            for outcome in chunk:
+                fh.write(f'{outcome}\n')
+
+    try:
+        for outcome in outcome_iter:
+            # Needed to parse spilled outcomes back from lines.
+            outcome_class = type(outcome)
+
+            chunk.append(outcome)
+            if len(chunk) >= chunk_size:
+                spill(chunk)
+                chunk = []
+
+        if len(run_fns) == 0:
+            yield from sorted(chunk, key=UMI_and_cluster_id)
+
+        else:
+            if len(chunk) > 0:
+                spill(chunk)
+
+            fhs = [open(fn) for fn in run_fns]
+            try:
+                runs = [map(outcome_class.from_line, fh) for fh in fhs]
+                yield from heapq.merge(*runs, key=UMI_and_cluster_id)
+            finally:
+                for fh in fhs:
+                    fh.close()
+
+    finally:
+        for fn in run_fns:
+            os.remove(fn)
+
+def check_grouped_by_UMI(outcome_iter):
+    previous_UMI = None
+    for outcome in outcome_iter:
+        if previous_UMI is not None and outcome.UMI < previous_UMI:
+            raise ValueError(f'outcomes are not sorted by UMI: {outcome.UMI} after {previous_UMI}')
+        previous_UMI = outcome.UMI
+        yield outcome
+
+def iter_collapsed_UMI_outcomes(outcome_iter, presorted=False, chunk_size=1000000):
+    ''' Streaming version of collapse_pooled_UMI_outcomes. For each UMI, yields
+    a list of one representative outcome for each distinct outcome, sorted
+    by cluster_id, and the representative with the most reads if there is a
+    unique one, or None.
+
+    If presorted, outcome_iter must already be sorted by UMI (as outcome lists
+    written from collapsed reads are), and only one UMI's outcomes are held in
+    memory at a time. Otherwise, outcome_iter is sorted with external_sort_outcomes.
+    '''
     def is_relevant(outcome):
         return (outcome.category != 'bad sequence' and
                 outcome.outcome != ('no indel', 'other', 'ambiguous')
                )
 
-    all_outcomes = [o for o in outcome_iter if is_relevant(o)]
-    all_outcomes = sorted(all_outcomes, key=lambda u: (u.UMI, u.cluster_id))
+    relevant_outcomes = (o for o in outcome_iter if is_relevant(o))
 
-    all_collapsed_outcomes = []
-    most_abundant_outcomes = []
+    if presorted:
+        sorted_outcomes = check_grouped_by_UMI(relevant_outcomes)
+    else:
+        sorted_outcomes = external_sort_outcomes(relevant_outcomes, chunk_size=chunk_size)
 
-    for UMI, UMI_outcomes in group_by(all_outcomes, lambda u: u.UMI):
-        observed = set(u.outcome for u in UMI_outcomes)
+    for UMI, UMI_outcomes in itertools.groupby(sorted_outcomes, key=lambda u: u.UMI):
+        UMI_outcomes = sorted(UMI_outcomes, key=UMI_and_cluster_id)
 
-        collapsed_outcomes = []
-        for outcome in observed:
-            relevant = [u for u in UMI_outcomes if u.outcome == outcome]
-            representative = max(relevant, key=lambda u: u.num_reads)
-            representative.num_reads = sum(u.num_reads for u in relevant)
+        # For each distinct outcome, the first outcome with the most reads
+        # and the total number of reads.
+        representatives = {}
+        num_reads = Counter()
+
+        for u in UMI_outcomes:
+            representative = representatives.get(u.outcome)
+            if representative is None or u.num_reads > representative.num_reads:
+                representatives[u.outcome] = u
+
+            num_reads[u.outcome] += u.num_reads
+
+        for outcome, representative in representatives.items():
+            representative.num_reads = num_reads[outcome]
+
+        collapsed_outcomes = sorted(representatives.values(), key=UMI_and_cluster_id)
 
-            collapsed_outcomes.append(representative)
-            all_collapsed_outcomes.append(representative)
-    
         max_count = max(u.num_reads for u in collapsed_outcomes)
         has_max_count = [u for u in collapsed_outcomes if u.num_reads == max_count]
 
         if len(has_max_count) == 1:
-            most_abundant_outcomes.append(has_max_count[0])
+            most_abundant_outcome = has_max_count[0]
+        else:
+            most_abundant_outcome = None
+
+        yield collapsed_outcomes, most_abundant_outcome
+
+def collapse_pooled_UMI_outcomes(outcome_iter, presorted=False):
+    all_collapsed_outcomes = []
+    most_abundant_outcomes = []
+
+    for collapsed_outcomes, most_abundant_outcome in iter_collapsed_UMI_outcomes(outcome_iter, presorted=presorted):
+        all_collapsed_outcomes.extend(collapsed_outcomes)
+
+        if most_abundant_outcome is not None:
+            most_abundant_outcomes.append(most_abundant_outcome)
 
-    all_collapsed_outcomes = sorted(all_collapsed_outcomes, key=lambda u: (u.UMI, u.cluster_id))
     return all_collapsed_outcomes, most_abundant_outcomes
         
-def error_correct_outcome_UMIs(outcome_group, max_UMI_distance=1):
+base_to_bits = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+def pack_UMI(UMI):
+    ''' Packs UMI into an int with 2 bits per base, or returns None if UMI
+    contains anything other than ACGT.
+    '''
+    packed = 0
+    for b in UMI:
+        bits = base_to_bits.get(b)
+        if bits is None:
+            return None
+        packed = (packed << 2) | bits
+    return packed
+
+def register_corrections_indexed(UMIs, max_UMI_distance):
+    ''' Equivalent of register_corrections(hamming_distance_matrix(UMIs), ...)
+    without comparing every pair of UMIs.
+
+    By the pigeonhole principle, UMIs within max_UMI_distance mismatches of
+    each other must exactly share at least one of max_UMI_distance + 1
+    segments, so only UMIs that share a segment are compared. Distances
+    between 2-bit packed UMIs are popcounts of their XOR.
+    '''
+    length = len(UMIs[0]) if len(UMIs) > 0 else 0
+    num_segments = max_UMI_distance + 1
+
+    if any(len(UMI) != length for UMI in UMIs) or num_segments > length:
+        ds = hamming_distance_matrix(UMIs)
+        return register_corrections(ds, max_UMI_distance, UMIs)
+
+    boundaries = [length * k // num_segments for k in range(num_segments + 1)]
+    segments = list(zip(boundaries, boundaries[1:]))
+
+    # Low bit of each base's 2 bits.
+    low_bits = int('01' * length, 2) if length > 0 else 0
+
+    packed = [pack_UMI(UMI) for UMI in UMIs]
+
+    def distance(i, j):
+        if packed[i] is not None and packed[j] is not None:
+            diff = packed[i] ^ packed[j]
+            return bin((diff | (diff >> 1)) & low_bits).count('1')
+        else:
+            return hamming_distance(UMIs[i].encode(), UMIs[j].encode())
+
+    # For each segment, indices of UMIs with each value of that segment in
+    # increasing order, i.e. from most to least common.
+    tables = [{} for _ in segments]
+
+    corrections = {}
+
+    for j, UMI in enumerate(UMIs):
+        # Correct to the most common UMI within max_UMI_distance of UMI.
+        best = None
+        for table, (start, end) in zip(tables, segments):
+            for i in table.get(UMI[start:end], []):
+                if best is not None and i >= best:
+                    break
+
+                if distance(i, j) <= max_UMI_distance:
+                    best = i
+                    break
+
+        if best is not None:
+            corrections[UMI] = UMIs[best]
+
+        for table, (start, end) in zip(tables, segments):
+            table.setdefault(UMI[start:end], []).append(j)
+
+    # If a correction points to a UMI that is itself going to be corrected,
+    # propogate this correction through.  
+    for from_, to in list(corrections.items()):
+        while to in corrections:
+            to = corrections[to]
+
+        corrections[from_] = to
+
+    return corrections
+
+def error_correct_outcome_UMIs(outcome_group, max_UMI_distance=1, indexed=True):
+    ''' If indexed, finds nearby UMIs with register_corrections_indexed instead of
+    computing a full UMI distance matrix. Corrections are the same either way.
+    '''
     # sort UMIs in descending order by number of occurrences.
     UMI_read_counts = Counter()
     for outcome in outcome_group:
         UMI_read_counts[outcome.UMI] += outcome.num_reads
     UMIs = [UMI for UMI, read_count in UMI_read_counts.most_common()]
 
-    ds = hamming_distance_matrix(UMIs)
-
-    corrections = register_corrections(ds, max_UMI_distance, UMIs)
+    if indexed:
+        corrections = register_corrections_indexed(UMIs, max_UMI_distance)
+    else:
+        ds = hamming_distance_matrix(UMIs)
+        corrections = register_corrections(ds, max_UMI_distance, UMIs)
 
     for outcome in outcome_group:
         correct_to = corrections.get(outcome.UMI)
         if correct_to:
             outcome.UMI = correct_to
     
-    return outcome_group
\ No newline at end of file
+    return outcome_group
@@ -1,5 +1,4 @@
 import array
-from collections import Counter
 
 import numpy as np
 import tqdm
@@ -7,7 +6,6 @@ import pysam
 
 from hits import fastq, utilities
 
-from .collapse_cython import hq_mismatches_from_seed
 from repair_seq.annotations import Annotations
 
 progress = tqdm.tqdm_notebook
@@ -19,109 +17,102 @@ HIGH_Q = 31
 LOW_Q = 10
 N_Q = 2
 
-def consensus_seq_and_qs(reads, max_read_length, bam):
-    if max_read_length is None:
-        max_read_length = len(reads[0].query_sequence)
-
-    statistics = fastq.quality_and_complexity(reads, max_read_length, alignments=bam, min_q=30)
-    shape = statistics['c'].shape
-
-    rl_range = np.arange(max_read_length)
-    
-    fields = [
-        ('c_above_min_q', int),
-        ('c', int),
-        ('average_q', float),
-    ]
-
-    stat_tuples = np.zeros(shape, dtype=fields)
-    for k in ['c_above_min_q', 'c', 'average_q']:
-        stat_tuples[k] = statistics[k]
-
-    argsorted = stat_tuples.argsort()
-    second_best_idxs, best_idxs = argsorted[:, -2:].T
-    
-    best_stats = stat_tuples[rl_range, best_idxs]
-
-    majority = (best_stats['c'] / len(reads)) > 0.5
-    at_least_one_hq = best_stats['c_above_min_q'] > 0
-    
-    qs = np.full(max_read_length, LOW_Q, dtype=int)
-    qs[majority & at_least_one_hq] = HIGH_Q
-    
-    ties = (best_stats == stat_tuples[rl_range, second_best_idxs])
+# Maps ASCII bytes to indices into utilities.base_order. Anything else,
+# including the zero padding past the end of shorter reads, maps to an extra
+# index that is never counted.
+NOT_A_BASE = len(utilities.base_order)
+base_to_code = np.full(256, NOT_A_BASE, dtype=np.uint8)
+for i, b in enumerate(utilities.base_order):
+    base_to_code[ord(b)] = i
 
-    best_idxs[ties] = utilities.base_to_index['N']
-    qs[ties] = N_Q
+code_to_base = np.frombuffer(utilities.base_order.encode(), dtype=np.uint8)
 
-    seq = ''.join(utilities.base_order[i] for i in best_idxs)
+def strings_to_array(strings, offset=0):
+    ''' Returns an (n, width) uint8 array of the ASCII values of strings minus
+    offset, zero-padded past the end of shorter strings.
+    '''
+    lengths = [len(s) for s in strings]
+    width = max(lengths, default=0)
 
-    return seq, qs
+    if all(length == width for length in lengths):
+        values = np.frombuffer(''.join(strings).encode(), dtype=np.uint8).reshape(len(strings), width) - np.uint8(offset)
+    else:
+        values = np.zeros((len(strings), width), dtype=np.uint8)
+        for i, s in enumerate(strings):
+            values[i, :len(s)] = np.frombuffer(s.encode(), dtype=np.uint8) - np.uint8(offset)
 
-def call_consensus(reads, max_read_length, bam):
-    seq, qs = consensus_seq_and_qs(reads, max_read_length, bam)
+    return values
 
-    if bam:
-        consensus = pysam.AlignedSegment()
-        consensus.query_sequence = seq
-        consensus.query_qualities = array.array('B', qs)
-        consensus.set_tag(NUM_READS_TAG, len(reads), 'i')
+def fit_to_width(values, width, fill):
+    if width > values.shape[1]:
+        values = np.pad(values, ((0, 0), (0, width - values.shape[1])), constant_values=fill)
     else:
-        guide_reads = []
-        for read in reads:
-            annotation = Annotations['UMI_guide'].from_identifier(read.name)
-            guide_read = fastq.Read('PH', annotation['guide'], annotation['guide_qual'])
-            guide_reads.append(guide_read)
-
-        guide_seq, guide_qs = consensus_seq_and_qs(guide_reads, None, False)
-        guide_qual = fastq.encode_sanger(guide_qs)
-
-        annotation = Annotations['collapsed_UMI'](UMI='PH',
-                                                  num_reads=len(reads),
-                                                  guide=guide_seq,
-                                                  guide_qual=guide_qual,
-                                                  cluster_id=0,
-                                                 )
-        name = str(annotation)
-        qual = fastq.encode_sanger(qs)
-        consensus = fastq.Read(name, seq, qual)
-
-    return consensus
-
-def within_radius_of_seed(seed, reads, max_hq_mismatches):
-    seed_b = seed.encode()
-    ds = [hq_mismatches_from_seed(seed_b, read.query_sequence.encode(), read.query_qualities, 20)
-          for read in reads]
-    
-    near_seed = []
-    remaining = []
-    
-    for i, (d, al) in enumerate(zip(ds, reads)):
-        if d <= max_hq_mismatches:
-            near_seed.append(al)
-        else:
-            remaining.append(al)
-    
-    return near_seed, remaining
+        values = values[:, :width]
 
-def propose_seed(reads, max_read_length, bam):
-    seqs = (read.query_sequence for read in reads)
+    return values
 
-    seq_counts = Counter(seqs).most_common()
+def encode_qs(qs):
+    return (np.asarray(qs) + fastq.SANGER_OFFSET).astype(np.uint8).tobytes().decode()
 
-    highest_count = seq_counts[0][1]
-    most_frequents = [s for s, c in seq_counts if c == highest_count]
+def consensus_from_arrays(codes, quals, num_reads):
+    ''' Calls a consensus base and quality at every position of reads given
+    as (n, length) arrays of base codes and integer qualities.
 
-    # If there is a tie, take the alphabetically first for determinism.
-    seq = sorted(most_frequents)[0]
-    
-    if highest_count > 1:
-        seed = seq
-    else:
-        consensus = call_consensus(reads, max_read_length, bam)
-        seed = consensus.query_sequence
-        
-    return seed
+    The called base is the one with the lexicographically largest (number of
+    Q30+ occurences, number of occurences, average quality). If more than one
+    base shares the largest, N is called with quality N_Q. Otherwise the
+    quality is HIGH_Q if a majority of reads have the base and at least one
+    has it at Q30+, or LOW_Q if not.
+
+    Returns the consensus sequence as bytes and its qualities.
+    '''
+    length = codes.shape[1]
+    num_columns = NOT_A_BASE + 1
+    size = length * num_columns
+
+    # Indices into a flattened (length x num_columns) one-hot count table, so
+    # that every statistic is a single bincount.
+    flat = (np.arange(length) * num_columns + codes).ravel()
+    above_min_q = (quals >= 30).ravel()
+
+    c = np.bincount(flat, minlength=size)
+    c_above_min_q = np.bincount(flat[above_min_q], minlength=size)
+    q_sum = np.bincount(flat, weights=quals.ravel(), minlength=size)
+
+    c, c_above_min_q, q_sum = [stat.reshape(length, num_columns)[:, :NOT_A_BASE] for stat in [c, c_above_min_q, q_sum]]
+
+    average_q = q_sum / np.maximum(1, c)
+
+    best = np.ones(c.shape, bool)
+    for stat in [c_above_min_q, c, average_q]:
+        masked = np.where(best, stat, -1)
+        best &= masked == masked.max(axis=1, keepdims=True)
+
+    ties = best.sum(axis=1) > 1
+    best_idxs = best.argmax(axis=1)
+
+    rl_range = np.arange(length)
+
+    majority = (c[rl_range, best_idxs] / num_reads) > 0.5
+    at_least_one_hq = c_above_min_q[rl_range, best_idxs] > 0
+
+    qs = np.full(length, LOW_Q, dtype=int)
+    qs[majority & at_least_one_hq] = HIGH_Q
+
+    best_idxs[ties] = utilities.base_to_index['N']
+    qs[ties] = N_Q
+
+    seq = code_to_base[best_idxs].tobytes()
+
+    return seq, qs
+
+def consensus_seq_and_qs(reads, max_read_length, bam):
+    family = UMIFamily(reads, bam)
+    seq, qs = family.consensus(np.arange(len(reads)), max_read_length)
+    return seq.decode(), qs
+
+def call_consensus(reads, max_read_length, bam):
+    return UMIFamily(reads, bam).make_cluster(np.arange(len(reads)), max_read_length)
 
 def make_singleton_cluster(read, bam):
     if bam:
@@ -141,24 +132,138 @@ def make_singleton_cluster(read, bam):
 
     return singleton
 
-def form_clusters(reads, max_read_length=None, max_hq_mismatches=0, bam=False):
-    if len(reads) == 0:
+class UMIFamily:
+    ''' The reads sharing a UMI, loaded once into (reads x positions) arrays
+    of bases and qualities so that clusters can be formed with vectorized
+    operations on rows instead of by recursively rebuilding lists of reads.
+    '''
+    def __init__(self, reads, bam=False):
+        self.reads = reads
+        self.bam = bam
+
+        seqs = [read.query_sequence for read in reads]
+        self.seqs = strings_to_array(seqs)
+        self.codes = base_to_code[self.seqs]
+        self.lengths = np.array([len(seq) for seq in seqs], dtype=int)
+
+        if bam:
+            self.quals = np.zeros(self.seqs.shape, dtype=np.uint8)
+            for i, read in enumerate(reads):
+                self.quals[i, :len(read.query_qualities)] = read.query_qualities
+        else:
+            self.quals = strings_to_array([read.qual for read in reads], offset=fastq.SANGER_OFFSET)
+
+        # Indices into the sorted distinct sequences, so that among equally
+        # common sequences the lowest index is the alphabetically first.
+        distinct_seqs, self.seq_ids = np.unique(np.array(seqs), return_inverse=True)
+        self.seq_ids = self.seq_ids.ravel()
+        self.num_distinct = len(distinct_seqs)
+
+    @utilities.memoized_property
+    def guides(self):
+        ''' Guide codes, qualities, and lengths from the UMI_guide annotations
+        of fastq reads.
+        '''
+        annotations = [Annotations['UMI_guide'].from_identifier(read.name) for read in self.reads]
+        guides = [annotation['guide'] for annotation in annotations]
+
+        codes = base_to_code[strings_to_array(guides)]
+        quals = strings_to_array([annotation['guide_qual'] for annotation in annotations], offset=fastq.SANGER_OFFSET)
+        lengths = np.array([len(guide) for guide in guides], dtype=int)
+
+        return codes, quals, lengths
+
+    def consensus(self, rows, max_read_length):
+        if max_read_length is None:
+            max_read_length = self.lengths[rows[0]]
+
+        codes = fit_to_width(self.codes[rows], max_read_length, NOT_A_BASE)
+        quals = fit_to_width(self.quals[rows], max_read_length, 0)
+
+        return consensus_from_arrays(codes, quals, len(rows))
+
+    def propose_seed(self, rows, max_read_length):
+        ''' Returns the most common sequence among rows as a row of the seqs
+        array if it appears more than once, otherwise the consensus of rows.
+        '''
+        counts = np.bincount(self.seq_ids[rows], minlength=self.num_distinct)
+        most_common = counts.argmax()
+
+        if counts[most_common] > 1:
+            seed = self.seqs[rows[self.seq_ids[rows] == most_common][0]]
+        else:
+            seq, qs = self.consensus(rows, max_read_length)
+            seed = fit_to_width(np.frombuffer(seq, dtype=np.uint8)[None], self.seqs.shape[1], 0)[0]
+
+        return seed
+
+    def hq_mismatches_from_seed(self, seed, rows):
+        # Padding past the end of a read has quality 0, so is never counted.
+        return ((self.seqs[rows] != seed) & (self.quals[rows] >= 20)).sum(axis=1)
+
+    def make_cluster(self, rows, max_read_length):
+        if max_read_length is None:
+            max_read_length = self.lengths[rows[0]]
+
+        if self.bam:
+            seq, qs = self.consensus(rows, max_read_length)
+
+            cluster = pysam.AlignedSegment()
+            cluster.query_sequence = seq.decode()
+            cluster.query_qualities = array.array('B', qs)
+            cluster.set_tag(NUM_READS_TAG, len(rows), 'i')
+        else:
+            guide_codes, guide_quals, guide_lengths = self.guides
+            guide_length = guide_lengths[rows[0]]
+
+            # Read and guide positions are independent, so both consensuses
+            # come from a single call on the reads and guides side by side.
+            codes = np.hstack([fit_to_width(self.codes[rows], max_read_length, NOT_A_BASE),
+                               fit_to_width(guide_codes[rows], guide_length, NOT_A_BASE),
+                              ])
+            quals = np.hstack([fit_to_width(self.quals[rows], max_read_length, 0),
+                               fit_to_width(guide_quals[rows], guide_length, 0),
+                              ])
+
+            seq, qs = consensus_from_arrays(codes, quals, len(rows))
+
+            annotation = Annotations['collapsed_UMI'](UMI='PH',
+                                                      num_reads=len(rows),
+                                                      guide=seq[max_read_length:].decode(),
+                                                      guide_qual=encode_qs(qs[max_read_length:]),
+                                                      cluster_id=0,
+                                                     )
+            cluster = fastq.Read(str(annotation), seq[:max_read_length].decode(), encode_qs(qs[:max_read_length]))
+
+        return cluster
+
+    def form_clusters(self, max_read_length=None, max_hq_mismatches=0):
+        ''' Repeatedly takes the reads within max_hq_mismatches high-quality
+        mismatches of a seed as a cluster until no reads are left or no reads
+        are near the seed, in which case each remaining read is its own cluster.
+        '''
         clusters = []
-    
-    elif len(reads) == 1:
+
+        remaining = np.arange(len(self.reads))
+
+        while len(remaining) > 1:
+            seed = self.propose_seed(remaining, max_read_length)
+            near_seed = self.hq_mismatches_from_seed(seed, remaining) <= max_hq_mismatches
+
+            if not near_seed.any():
+                break
+
+            clusters.append(self.make_cluster(remaining[near_seed], max_read_length))
+            remaining = remaining[~near_seed]
+
+        clusters.extend(make_singleton_cluster(self.reads[i], self.bam) for i in remaining)
+
+        return clusters
+
+def form_clusters(reads, max_read_length=None, max_hq_mismatches=0, bam=False):
+    if len(reads) <= 1:
         clusters = [make_singleton_cluster(read, bam) for read in reads]
-    
     else:
-        seed = propose_seed(reads, max_read_length, bam)
-        near_seed, remaining = within_radius_of_seed(seed, reads, max_hq_mismatches)
-        
-        if len(near_seed) == 0:
-            # didn't make progress, so give up
-            clusters = [make_singleton_cluster(read, bam) for read in reads]
-        
-        else:
-            consensus_near_seed = call_consensus(near_seed, max_read_length, bam)
-            all_others = form_clusters(remaining, max_read_length, max_hq_mismatches, bam)
-            clusters = [consensus_near_seed] + all_others
-            
-    return clusters
\ No newline at end of file
+        clusters = UMIFamily(reads, bam).form_clusters(max_read_length, max_hq_mismatches)
+
+    return clusters
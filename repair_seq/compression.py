@@ -0,0 +1,235 @@
+''' Reading and writing of the fastq files passed between pipeline stages.
+
+The codec of a file is determined by its suffix:
+.gz (gzip), .zst (zstd), .lz4 (lz4), or anything else (uncompressed).
+
+Where available, gzip is handled by isal (much faster than zlib, with
+optional background threads) or by a pigz subprocess. Otherwise Python's
+gzip module is used. zstd and lz4 need the zstandard and lz4 packages.
+
+Stages can be configured with a 'compression' entry in a sample sheet, e.g.
+
+    compression:
+        demux_input:
+            threads: 4
+        demux_chunks:
+            codec: lz4
+        collapsed_R2:
+            level: 3
+
+Only temporary stages, whose files are deleted once the next stage has
+consumed them, can use codecs other than gzip. Files from other stages
+are also read by knock_knock.
+'''
+
+import gzip
+import io
+import shutil
+import subprocess
+
+from pathlib import Path
+
+from hits import fastq
+
+try:
+    from isal import igzip, igzip_threaded
+except ImportError:
+    igzip = None
+    igzip_threaded = None
+
+codec_suffixes = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'lz4': '.lz4',
+    'none': '',
+}
+
+stages = [
+    'demux_input',
+    'demux_chunks',
+    'experiment_chunks',
+    'collapsed_R2',
+    'low_quality_R2',
+    'collapsed_uncommon_R2',
+    'common_sequences',
+]
+
+temporary_stages = {'demux_chunks', 'experiment_chunks'}
+
+default_settings = {
+    'codec': 'gzip',
+    'level': 1,
+    'threads': 1,
+}
+
+def get_settings(sample_sheet, stage):
+    if stage not in stages:
+        raise ValueError(f'unknown stage: {stage}')
+
+    settings = dict(default_settings)
+
+    if sample_sheet is not None:
+        settings.update((sample_sheet.get('compression') or {}).get(stage, {}))
+
+    if settings['codec'] not in codec_suffixes:
+        raise ValueError(f'unknown codec for {stage}: {settings["codec"]}')
+
+    if settings['codec'] != 'gzip' and stage not in temporary_stages:
+        raise ValueError(f'{stage} files are read by other tools and must be gzip')
+
+    return settings
+
+def fastq_suffix(codec):
+    return '.fastq' + codec_suffixes[codec]
+
+def codec_from_fn(fn):
+    suffix = Path(fn).suffix
+
+    for codec, codec_suffix in codec_suffixes.items():
+        if codec_suffix != '' and suffix == codec_suffix:
+            return codec
+
+    return 'none'
+
+class PipedFile(io.RawIOBase):
+    ''' Binary file object reading from or writing to a subprocess, whose exit
+    status is checked on close.
+    '''
+    def __init__(self, command, fn, mode):
+        super().__init__()
+
+        self.fn = fn
+        self.mode = mode
+
+        if mode == 'rb':
+            self.process = subprocess.Popen(command + [str(fn)], stdout=subprocess.PIPE)
+            self.fh = self.process.stdout
+        else:
+            self.output_fh = open(fn, 'wb')
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.output_fh)
+            self.fh = self.process.stdin
+
+    def readable(self):
+        return self.mode == 'rb'
+
+    def writable(self):
+        return self.mode == 'wb'
+
+    def readinto(self, buffer):
+        return self.fh.readinto(buffer)
+
+    def write(self, data):
+        return self.fh.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.fh.close()
+        return_code = self.process.wait()
+
+        if self.mode == 'wb':
+            self.output_fh.close()
+
+        super().close()
+
+        # A reader that stops early closes the pipe, which pigz reports as an error.
+        if return_code != 0 and not (self.mode == 'rb' and return_code < 0):
+            raise OSError(f'{self.process.args[0]} exited with status {return_code} for {self.fn}')
+
+def open_gzip(fn, mode, level, threads):
+    binary_mode = mode.replace('t', '') + ('b' if 'b' not in mode else '')
+
+    if igzip is not None:
+        # isal only has levels 0 to 3.
+        level = min(level, 3)
+
+        if threads > 1:
+            fh = igzip_threaded.open(fn, binary_mode, compresslevel=level, threads=threads)
+        else:
+            fh = igzip.open(fn, binary_mode, compresslevel=level)
+
+    elif threads > 1 and shutil.which('pigz') is not None:
+        if 'r' in mode:
+            command = ['pigz', '-dc', '-p', str(threads)]
+        else:
+            command = ['pigz', '-c', f'-{level}', '-p', str(threads)]
+
+        raw = PipedFile(command, fn, binary_mode)
+
+        if 'r' in mode:
+            fh = io.BufferedReader(raw)
+        else:
+            fh = io.BufferedWriter(raw)
+
+    else:
+        fh = gzip.open(fn, binary_mode, compresslevel=level)
+
+    return fh
+
+def open_file(fn, mode='rt', level=1, threads=1):
+    ''' Opens fn with the codec given by its suffix.
+    level and threads are ignored where the codec doesn't support them.
+    '''
+    codec = codec_from_fn(fn)
+    binary_mode = mode.replace('t', '') + ('b' if 'b' not in mode else '')
+
+    if codec == 'gzip':
+        fh = open_gzip(fn, mode, level, threads)
+
+    elif codec == 'zstd':
+        import zstandard
+
+        if 'r' in mode:
+            fh = zstandard.open(fn, binary_mode)
+        else:
+            compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+            fh = zstandard.open(fn, binary_mode, cctx=compressor)
+
+    elif codec == 'lz4':
+        import lz4.frame
+
+        fh = lz4.frame.open(fn, binary_mode, compression_level=level)
+
+    else:
+        fh = open(fn, binary_mode)
+
+    if 'b' not in mode:
+        fh = io.TextIOWrapper(fh)
+
+    return fh
+
+def open_for_stage(fn, mode, sample_sheet, stage):
+    settings = get_settings(sample_sheet, stage)
+    return open_file(fn, mode, level=settings['level'], threads=settings['threads'])
+
+def reads(fn, threads=1, **kwargs):
+    ''' Like fastq.reads, but decompresses through open_file. '''
+    with open_file(fn, 'rt', threads=threads) as fh:
+        yield from fastq.reads(fh, **kwargs)
+
+def line_groups(fn, threads=1):
+    with open_file(fn, 'rt', threads=threads) as fh:
+        yield from fastq.get_line_groups(fh)
+
+def iter_records(fh):
+    ''' Yields (name, record) pairs of bytes for each record in binary fastq
+    file object fh, where name is the read name up to the first space and
+    record is all four lines. Lets callers order and group reads by name
+    without making a Read for every record.
+    '''
+    lines = iter(fh)
+    for name_line in lines:
+        record = name_line + next(lines) + next(lines) + next(lines)
+        yield name_line[1:].split(None, 1)[0], record
+
+def records(fn, threads=1):
+    with open_file(fn, 'rb', threads=threads) as fh:
+        yield from iter_records(fh)
+
+def record_to_read(record):
+    ''' Equivalent of reading record with fastq.reads(..., up_to_space=True). '''
+    name_line, seq_line, _, qual_line = record.decode().split('\n', 3)
+    name = name_line.rstrip().lstrip('@').split()[0]
+    seq = seq_line.strip().translate(fastq.period_to_N)
+    return fastq.Read(name, seq, qual_line.strip())
@@ -1,24 +1,22 @@
 import argparse
-import gzip
-import itertools
 import logging
-import multiprocessing
-import shutil
 
 from pathlib import Path
-from collections import defaultdict, Counter
 
 import numpy as np
 import pandas as pd
 idx = pd.IndexSlice
 import yaml
-import tqdm
 
 from hits import fastq, fasta, utilities
 
+import repair_seq.demux_engine
 import repair_seq.guide_library
+import repair_seq.resolvers
 from repair_seq.annotations import Annotations
 
+memoized_property = utilities.memoized_property
+
 def load_sample_sheet(base_dir, group):
     sample_sheet_fn = Path(base_dir) / 'data' / group / 'sample_sheet.yaml'
     sample_sheet = yaml.safe_load(sample_sheet_fn.read_text())
@@ -37,7 +35,7 @@ def load_pool_details(base_dir, group):
         pool_details = None
     return pool_details
 
-def make_pool_sample_sheets(base_dir, group):
+def make_pool_sample_sheets(base_dir, group, subsample=None):
     sample_sheet = load_sample_sheet(base_dir, group)
 
     for pool_name, details in sample_sheet['pool_details'].items():
@@ -52,8 +50,14 @@ def make_pool_sample_sheets(base_dir, group):
         else:
             pool_sample_sheet['target_info_prefix'] = 'pooled_vector'
 
+        if 'compression' in sample_sheet:
+            pool_sample_sheet['compression'] = sample_sheet['compression']
+
         pool_sample_sheet.update(details)
 
+        if subsample is not None:
+            pool_sample_sheet['UMI_subsample'] = subsample.to_dict()
+
         full_pool_name = f'{sample_sheet["group_name"]}_{pool_name}'
         pool_sample_sheet_fn = Path(base_dir) / 'results' / full_pool_name / 'sample_sheet.yaml'
         pool_sample_sheet_fn.parent.mkdir(parents=True, exist_ok=True)
@@ -85,9 +89,12 @@ def load_SRA_pool_sample_sheet(screen_name):
 
     return sample_sheet
 
-def write_SRA_pool_sample_sheet(base_dir, screen_name):
+def write_SRA_pool_sample_sheet(base_dir, screen_name, subsample=None):
     sample_sheet = load_SRA_pool_sample_sheet(screen_name)
 
+    if subsample is not None:
+        sample_sheet['UMI_subsample'] = subsample.to_dict()
+
     base_dir = Path(base_dir)
 
     results_dir = base_dir / 'results'
@@ -99,124 +106,6 @@ def write_SRA_pool_sample_sheet(base_dir, screen_name):
     sample_sheet_fn = screen_dir / 'sample_sheet.yaml'
     sample_sheet_fn.write_text(yaml.safe_dump(sample_sheet))
 
-def chunk_number_to_string(chunk_number):
-    return f'{chunk_number:06d}'
-
-class FastqChunker:
-    def __init__(self, base_dir, group, quartet_name, which, reads_per_chunk=None, queue=None, debug=False, from_SRA=False):
-        self.base_dir = Path(base_dir)
-        self.group = group
-        self.quartet_name = quartet_name
-        self.which = which
-        self.reads_per_chunk = reads_per_chunk
-        self.queue = queue
-        self.debug = debug
-
-        if from_SRA:
-            sample_sheet = load_SRA_pool_sample_sheet(self.group)
-        else:
-            sample_sheet = load_sample_sheet(self.base_dir, self.group)
-
-        quartet = sample_sheet['quartets'][quartet_name]
-        
-        self.fn_name = quartet[self.which]
-        
-        group_dir = self.base_dir / 'data' / self.group
-        self.input_fn = (group_dir / self.fn_name).with_suffix('.fastq.gz')
-        
-        self.chunks_dir = group_dir / 'chunks'
-        self.chunks_dir.mkdir(exist_ok=True)
-        
-        self.current_chunk_number = 0
-        
-        self.current_fh = None
-        
-    def close_current_chunk(self):
-        if self.current_fh is not None:
-            self.current_fh.close()
-            if self.queue is not None:
-                self.queue.put(('chunk', self.quartet_name, self.which, self.current_chunk_number))
-                
-            self.current_chunk_number += 1
-            
-    def get_chunk_fn(self, chunk_number):
-        chunk_string = chunk_number_to_string(chunk_number)
-        next_fn = self.chunks_dir / f'{self.fn_name}_{chunk_string}.fastq.gz'
-        return next_fn
-            
-    def start_next_chunk(self):
-        self.close_current_chunk()
-        
-        chunk_fn = self.get_chunk_fn(self.current_chunk_number)
-        self.current_fh = gzip.open(chunk_fn, 'wt', compresslevel=1)
-        
-    def split_into_chunks(self):
-        line_groups = fastq.get_line_groups(self.input_fn)
-
-        if self.debug:
-            line_groups = itertools.islice(line_groups, int(1e6))
-        
-        for read_number, line_group in enumerate(line_groups):
-            if read_number % self.reads_per_chunk == 0:
-                self.start_next_chunk()
-            
-            for line in line_group:
-                self.current_fh.write(line)
-                
-        self.close_current_chunk()
-        
-        self.queue.put(('chunk', self.quartet_name, self.which, 'DONE'))
-                
-class UMISorters:
-    def __init__(self, base_dir, group, quartet_name, chunk_number, from_SRA):
-        self.base_dir = Path(base_dir)
-        
-        self.from_SRA = from_SRA
-        if from_SRA:
-            self.screen_name = group
-        else:
-            sample_sheet = load_sample_sheet(base_dir, group)
-            self.group_name = sample_sheet['group_name']
-        
-        self.chunk_string = f'{quartet_name}_{chunk_number_to_string(chunk_number)}'
-
-        self.sorters = defaultdict(list)
-
-
-    def __getitem__(self, key):
-        return self.sorters[key]
-
-    def sort_and_write(self):
-        for sample, fixed_guide, variable_guide in sorted(self.sorters):
-            reads = self.sorters[sample, fixed_guide, variable_guide]
-            sorted_reads = sorted(reads, key=lambda r: r.name)
-
-            if self.from_SRA:
-                if sample != self.screen_name:
-                    raise ValueError(sample, self.screen_name)
-                pool_name = self.screen_name
-            else:
-                pool_name = f'{self.group_name}_{sample}'
-
-            pool = repair_seq.pooled_screen.PooledScreen(self.base_dir, pool_name)
-
-            exp = pool.single_guide_experiment(fixed_guide, variable_guide)
-            output_dir = exp.fns['chunks']
-            output_dir.mkdir(exist_ok=True, parents=True)
-            
-            fn = output_dir / f'{self.chunk_string}_R2.fastq.gz'
-            
-            with gzip.open(fn, 'wt', compresslevel=1) as zfh:
-                for read in sorted_reads:
-                    zfh.write(str(read))
-
-            del self.sorters[sample, fixed_guide, variable_guide]
-            del sorted_reads
-            
-def split_into_chunks(base_dir, group, quartet_name, which, reads_per_chunk, queue, debug, from_SRA):
-    chunker = FastqChunker(base_dir, group, quartet_name, which, reads_per_chunk, queue, debug, from_SRA)
-    return chunker.split_into_chunks()
-
 def get_resolvers(base_dir, group, from_SRA):
     expected_seqs = {}
     resolvers = {}
@@ -240,10 +129,7 @@ def get_resolvers(base_dir, group, from_SRA):
     if 'fixed_guide_library' not in sample_sheet:
         # If there weren't multiple fixed guide pools present, keep everything
         # to allow possibility of outcomes that don't include the intended NotI site.
-        def fixed_guide_barcode_resolver(*args):
-            return {'none'}
-
-        resolvers['fixed_guide_barcode'] = fixed_guide_barcode_resolver
+        resolvers['fixed_guide_barcode'] = repair_seq.resolvers.resolve_to_none
         expected_seqs['fixed_guide_barcode'] = set()
 
     else:
@@ -258,373 +144,158 @@ def get_resolvers(base_dir, group, from_SRA):
 
     return resolvers, expected_seqs
 
-def demux_chunk_from_SRA(base_dir, screen_name, quartet_name, chunk_number, queue):
-    resolvers, expected_seqs = get_resolvers(base_dir, screen_name, from_SRA=True)
 
-    SRA_annotation = Annotations['SRA']
-    Annotation = Annotations['UMI_guide']
-    
-    fastq_fns = [FastqChunker(base_dir, screen_name, quartet_name, which, from_SRA=True).get_chunk_fn(chunk_number) for which in ['R1', 'R2']]
+def get_resolvers_fn(base_dir, group):
+    return Path(base_dir) / 'data' / group / 'resolvers.pkl'
 
-    sorters = UMISorters(base_dir, screen_name, quartet_name, chunk_number, from_SRA=True)
+def compile_resolvers(base_dir, group, from_SRA):
+    return repair_seq.resolvers.compile_resolvers(get_resolvers_fn(base_dir, group), get_resolvers, base_dir, group, from_SRA)
 
-    counts = defaultdict(Counter)
+def load_resolvers(base_dir, group, from_SRA):
+    return repair_seq.resolvers.load_resolvers(get_resolvers_fn(base_dir, group), get_resolvers, base_dir, group, from_SRA)
 
-    sample_sheet = load_SRA_pool_sample_sheet(screen_name)
-
-    guide_barcode_slice = idx[:22]
+def SRA_original_name(read):
+    return Annotations['SRA'].from_identifier(read.name)['original_name']
 
-    if 'fixed_guide_library' in sample_sheet:
-        # If a guide barcode is present, remove it from R2 before passing along
-        # to simplify analysis of common sequences in pool.
-        after_guide_barcode_slice = idx[22:] 
-    else:
-        after_guide_barcode_slice = idx[:]
+def SRA_UMI(read):
+    return Annotations['SRA'].from_identifier(read.name)['UMI_seq']
 
-    for R1, R2 in fastq.read_pairs(*fastq_fns, up_to_space=True):
-        if R1.name != R2.name:
-            raise ValueError('read pair out of sync')
-
-        sample = screen_name
+class UMILibrary(repair_seq.demux_engine.Library):
+    ''' Quartets of UMI-tagged reads from a pooled screen. I1 holds the UMI,
+    I2 the sample index, R1 the variable guide, and R2 the outcome, optionally
+    preceded by a fixed guide barcode.
+    Reads downloaded from SRA only have R1 and R2, with the original name and
+    UMI stored in read names, and come from a single sample.
+    '''
+    def __init__(self, base_dir, group, from_SRA=False):
+        super().__init__(base_dir, group)
+        self.from_SRA = from_SRA
 
-        variable_guides = resolvers['variable_guide'](R1.seq[:45], 'unknown')
-        if len(variable_guides) == 1:
-            variable_guide = next(iter(variable_guides))
+    @memoized_property
+    def sample_sheet(self):
+        if self.from_SRA:
+            return load_SRA_pool_sample_sheet(self.group)
         else:
-            variable_guide = 'unknown'
+            return load_sample_sheet(self.base_dir, self.group)
 
-        guide_barcode = R2.seq[guide_barcode_slice]
-        fixed_guides = resolvers['fixed_guide_barcode'](guide_barcode, {'unknown'})
-        if len(fixed_guides) == 1:
-            fixed_guide = next(iter(fixed_guides))
+    @property
+    def read_types(self):
+        if self.from_SRA:
+            return ['R1', 'R2']
         else:
-            fixed_guide = 'unknown'
-
-        counts['fixed_guide_barcode'][guide_barcode] += 1
-
-        counts['id'][sample, fixed_guide, variable_guide] += 1
-
-        # Retain quartets with an unknown fixed guide to allow detection of weird ligations.
-        if 'unknown' in {sample, variable_guide}:
-            continue
+            return fastq.quartet_order
 
-        incoming_annotation = SRA_annotation.from_identifier(R1.name)
+    @property
+    def units(self):
+        return sorted(self.sample_sheet['quartets'])
 
-        annotation = Annotation(guide=R1.seq,
-                                guide_qual=fastq.sanitize_qual(R1.qual),
-                                original_name=incoming_annotation['original_name'],
-                                UMI=incoming_annotation['UMI_seq'],
-                               )
-        R2.name = str(annotation)
-
-        sorters[sample, fixed_guide, variable_guide].append(R2[after_guide_barcode_slice])
-
-    sorters.sort_and_write()
-
-    chunk_dir = base_dir / 'data' / screen_name / 'chunks'
-    for k, cs in counts.items():
-        cs = pd.Series(cs).sort_values(ascending=False)
-        fn = chunk_dir / f'{k}_{quartet_name}_{chunk_number_to_string(chunk_number)}.txt'
-        cs.to_csv(fn, sep='\t', header=False)
-
-    # Delete the chunk.
-    for fastq_fn in fastq_fns:
-        fastq_fn.unlink()
-
-    queue.put(('demux', quartet_name, chunk_number))
-
-def demux_chunk(base_dir, group, quartet_name, chunk_number, queue):
-    resolvers, expected_seqs = get_resolvers(base_dir, group, from_SRA=False)
-    
-    Annotation = Annotations['UMI_guide']
-    
-    fastq_fns = [FastqChunker(base_dir, group, quartet_name, which).get_chunk_fn(chunk_number) for which in fastq.quartet_order]
-
-    sorters = UMISorters(base_dir, group, quartet_name, chunk_number, from_SRA=False)
+    @property
+    def samples(self):
+        if self.from_SRA:
+            return [self.group]
+        else:
+            return super().samples
 
-    counts = defaultdict(Counter)
+    def input_fn_name(self, quartet_name, which):
+        return self.sample_sheet['quartets'][quartet_name][which]
 
-    sample_sheet = load_sample_sheet(base_dir, group)
+    def num_reads(self, quartet_name):
+        return self.sample_sheet['quartets'][quartet_name]['num_reads']
 
-    guide_barcode_slice = idx[:22]
-
-    if 'fixed_guide_library' in sample_sheet:
-        # If a guide barcode is present, remove it from R2 before passing along
-        # to simplify analysis of common sequences in pool.
-        after_guide_barcode_slice = idx[22:] 
-    else:
-        after_guide_barcode_slice = idx[:]
+    def get_pool_name(self, sample):
+        if self.from_SRA:
+            if sample != self.group:
+                raise ValueError(sample, self.group)
+            pool_name = self.group
+        else:
+            pool_name = f'{self.sample_sheet["group_name"]}_{sample}'
 
-    for quartet in fastq.read_quartets(fastq_fns, up_to_space=True):
-        if len({r.name for r in quartet}) != 1:
-            raise ValueError('quartet out of sync')
+        return pool_name
 
-        samples = resolvers['sample'](quartet.I2.seq, {'unknown'})
+    def prepare(self):
+        logging.info(f'Demultiplexing {self.group} in {self.base_dir}')
 
-        if len(samples) == 1:
-            sample = next(iter(samples))
+        if self.from_SRA:
+            write_SRA_pool_sample_sheet(self.base_dir, self.group, subsample=self.subsample)
         else:
-            sample = 'unknown'
-
-        counts['sample'][quartet.I2.seq] += 1
-
-        variable_guides = resolvers['variable_guide'](quartet.R1.seq[:45], 'unknown')
-        if len(variable_guides) == 1:
-            variable_guide = next(iter(variable_guides))
+            make_pool_sample_sheets(self.base_dir, self.group, subsample=self.subsample)
+
+    def get_resolvers_fn(self):
+        return get_resolvers_fn(self.base_dir, self.group)
+
+    def get_resolvers(self):
+        return get_resolvers(self.base_dir, self.group, self.from_SRA)
+
+    @property
+    def stat_keys(self):
+        keys = []
+        if not self.from_SRA:
+            keys.append('sample')
+        if 'fixed_guide_library' in self.sample_sheet:
+            keys.append('fixed_guide_barcode')
+        return keys
+
+    def read_structure(self):
+        engine = repair_seq.demux_engine
+
+        if self.from_SRA:
+            # Every read pair in an SRA run comes from the same sample.
+            sample = engine.ConstantField('sample', self.group)
+            annotation_values = {
+                'original_name': ('R1', SRA_original_name),
+                'UMI': ('R1', SRA_UMI),
+            }
         else:
-            variable_guide = 'unknown'
-
-        guide_barcode = quartet.R2.seq[guide_barcode_slice]
-        fixed_guides = resolvers['fixed_guide_barcode'](guide_barcode, {'unknown'})
-        if len(fixed_guides) == 1:
-            fixed_guide = next(iter(fixed_guides))
+            sample = engine.Field('sample', 'I2', count_key='sample')
+            annotation_values = {
+                'original_name': ('R1', engine.read_name),
+                'UMI': ('I1', engine.read_seq),
+            }
+
+        annotation_values['guide'] = ('R1', engine.read_seq)
+        annotation_values['guide_qual'] = ('R1', engine.sanitized_qual)
+
+        if 'fixed_guide_library' in self.sample_sheet:
+            # If a guide barcode is present, remove it from R2 before passing along
+            # to simplify analysis of common sequences in pool.
+            output_slice = idx[22:]
         else:
-            fixed_guide = 'unknown'
-
-        counts['fixed_guide_barcode'][guide_barcode] += 1
-
-        counts['id'][sample, fixed_guide, variable_guide] += 1
-
-        # Retain quartets with an unknown fixed guide to allow detection of weird ligations.
-        if 'unknown' in {sample, variable_guide}:
-            continue
-
-        original_name = quartet.R1.name
-        UMI = quartet.I1.seq
-        guide_seq = quartet.R1.seq
-        guide_qual = fastq.sanitize_qual(quartet.R1.qual)
-
-        annotation = Annotation(guide=guide_seq,
-                                guide_qual=guide_qual,
-                                original_name=original_name,
-                                UMI=UMI,
-                               )
-        quartet.R2.name = str(annotation)
-
-        sorters[sample, fixed_guide, variable_guide].append(quartet.R2[after_guide_barcode_slice])
-
-    sorters.sort_and_write()
-
-    chunk_dir = base_dir / 'data' / group / 'chunks'
-    for k, cs in counts.items():
-        cs = pd.Series(cs).sort_values(ascending=False)
-        fn = chunk_dir / f'{k}_{quartet_name}_{chunk_number_to_string(chunk_number)}.txt'
-        cs.to_csv(fn, sep='\t', header=False)
-
-    # Delete the chunk.
-    for fastq_fn in fastq_fns:
-        fastq_fn.unlink()
-
-    queue.put(('demux', quartet_name, chunk_number))
-
-def merge_seq_counts(base_dir, group, k, from_SRA):
-    chunk_dir = Path(base_dir) / 'data' / group / 'chunks'
-    count_fns = sorted(chunk_dir.glob(f'{k}*.txt'))
-
-    counts = Counter()
-    for fn in count_fns:
-        for line in open(fn):
-            seq, count = line.strip().split()
-            counts[seq] += int(count)
-
-    merged_fn = Path(base_dir) / 'data' / group / f'{k}_stats.txt'
-
-    resolvers, expected_seqs = get_resolvers(base_dir, group, from_SRA)
-    resolver = resolvers[k]
-    expected_seqs = expected_seqs[k]
-
-    with open(merged_fn, 'w') as fh:
-        total = sum(counts.values())
-
-        for seq, count in counts.most_common(100):
-            name = resolver(seq, '')
-
-            if seq in expected_seqs:
-                mismatches = ''
-            elif name != '':
-                mismatches = ' (1 mismatch)'
-            else:
-                mismatches = ''
-
-            fraction = float(count) / total
-
-            fh.write(f'{seq}\t{count: >10,}\t({fraction: >6.2%})\t{name}{mismatches}\n')
-
-    for fn in count_fns:
-        fn.unlink()
-    
-def merge_ids(base_dir, group):
-    chunk_dir = Path(base_dir) / 'data' / group / 'chunks'
-    count_fns = sorted(chunk_dir.glob('id*.txt'))
-
-    counts = Counter()
-    for fn in count_fns:
-        for line in open(fn):
-            sample, fixed_guide, variable_guide, count = line.strip().split()
-            counts[sample, fixed_guide, variable_guide] += int(count)
-
-    merged_fn = Path(base_dir) / 'data' / group / 'id_stats.txt'
-
-    counts = pd.Series(counts).sort_index()
-    counts.to_csv(merged_fn, sep='\t', header=False)
-
-    for fn in count_fns:
-        fn.unlink()
-
-def demux_group(base_dir,
-                group,
-                debug=False,
-                reads_per_chunk=int(5e6),
-                from_SRA=False,
-                just_chunk=False,
-               ):
-    '''
-    just_chunk: Only split input files into chunks (don't demux them). 
-    '''
-    logging.info(f'Demultiplexing {group} in {base_dir}')
-
-    if from_SRA:
-        write_SRA_pool_sample_sheet(base_dir, group)
-        sample_sheet = load_SRA_pool_sample_sheet(group)
-        relevant_read_types = ['R1', 'R2']
-        demux_chunk_function = demux_chunk_from_SRA
-    else:
-        make_pool_sample_sheets(base_dir, group)
-        sample_sheet = load_sample_sheet(base_dir, group)
-        relevant_read_types = fastq.quartet_order
-        demux_chunk_function = demux_chunk
-
-    quartet_names = sorted(sample_sheet['quartets'])
-
-    if debug:
-        reads_per_chunk = int(5e5)
-
-    chunks_per_quartet = [int(np.ceil(d['num_reads'] / reads_per_chunk)) for q, d in sample_sheet['quartets'].items()]
-    total_chunks = sum(chunks_per_quartet)
-
-    manager = multiprocessing.Manager()
-    tasks_done_queue = manager.Queue()
-    
-    chunks_done = defaultdict(set) 
-    
-    chunk_pool = multiprocessing.Pool(processes=4 * len(quartet_names))
-    chunk_progress = tqdm.tqdm(desc='Chunk progress', total=total_chunks)
-    chunk_results = []
-
-    demux_pool = multiprocessing.Pool(processes=4 * len(quartet_names))
-    demux_progress = tqdm.tqdm(desc='Demux progress', total=total_chunks)
-    demux_results = []
-    
-    with chunk_pool, demux_pool:
-
-        unfinished_chunkers = set()
-        
-        for quartet_name in quartet_names:
-            for which in relevant_read_types:
-                args = (base_dir, group, quartet_name, which, reads_per_chunk, tasks_done_queue, debug, from_SRA)
-                chunk_result = chunk_pool.apply_async(split_into_chunks, args)
-
-                if debug:
-                    result = chunk_result.get()
-                    if not chunk_result.successful():
-                        print(result)
-
-                chunk_results.append(chunk_result)
-
-                unfinished_chunkers.add((quartet_name, which))
-            
-        chunk_pool.close()
-        
-        while True:
-            task_type, *task_info = tasks_done_queue.get()
-            
-            if task_type == 'chunk':
-                quartet_name, which, chunk_number = task_info
-                
-                if chunk_number == 'DONE':
-                    unfinished_chunkers.remove((quartet_name, which))
-                    if len(unfinished_chunkers) == 0:
-                        break
-                else:
-                    chunks_done[quartet_name, chunk_number].add(which)
-                    if chunks_done[quartet_name, chunk_number] == set(relevant_read_types):
-                        chunk_progress.update()
-                        
-                        if not just_chunk:
-                            args = (base_dir, group, quartet_name, chunk_number, tasks_done_queue)
-                            demux_result = demux_pool.apply_async(demux_chunk_function, args)
-
-                            if debug:
-                                result = demux_result.get()
-                                if not demux_result.successful():
-                                    print(result)
-
-                                demux_results.append(demux_result)
-
-            elif task_type == 'demux':
-                demux_progress.update()
-
-        if not just_chunk:
-            while demux_progress.n < chunk_progress.n:
-                task_type, *task_info = tasks_done_queue.get()
-                if task_type == 'demux':
-                    demux_progress.update()
-                else:
-                    error, = task_info
-                    raise error
-        
-        chunk_pool.join()
-        for chunk_result in chunk_results:
-            if not chunk_result.successful():
-                print(chunk_result.get())
-                
-        demux_pool.close()
-                
-        demux_pool.join()
-        for demux_result in demux_results:
-            if not demux_result.successful():
-                print(demux_result.get())
-
-    chunk_progress.close()
-
-    if not just_chunk:
-        demux_progress.close()
-
-        logging.info('Merging statistics...')
-
-        merge_pool = multiprocessing.Pool(processes=3)
-        merge_results = []
-        if not from_SRA:
-            merge_results.append(merge_pool.apply_async(merge_seq_counts, args=(base_dir, group, 'sample', from_SRA)))
-        if 'fixed_guide_library' in sample_sheet:
-            merge_results.append(merge_pool.apply_async(merge_seq_counts, args=(base_dir, group, 'fixed_guide_barcode', from_SRA)))
-
-        merge_results.append(merge_pool.apply_async(merge_ids, args=(base_dir, group)))
-
-        merge_pool.close()
-        merge_pool.join()
-
-        for merge_result in merge_results:
-            if not merge_result.successful():
-                print(merge_result.get())
-
-        chunk_dir = base_dir / 'data' / group / 'chunks'
-        shutil.rmtree(str(chunk_dir))
+            output_slice = idx[:]
+
+        fields = [
+            sample,
+            engine.Field('fixed_guide', 'R2', idx[:22], resolver='fixed_guide_barcode', count_key='fixed_guide_barcode'),
+            engine.Field('variable_guide', 'R1', idx[:45]),
+        ]
+
+        return engine.ReadStructure(
+            read_types=self.read_types,
+            fields=fields,
+            key_fields=['sample', 'fixed_guide', 'variable_guide'],
+            # Retain quartets with an unknown fixed guide to allow detection of weird ligations.
+            required_fields=['sample', 'variable_guide'],
+            output_read_type='R2',
+            output_slice=output_slice,
+            Annotation=Annotations['UMI_guide'],
+            annotation_values=annotation_values,
+            subsample_key=annotation_values['UMI'],
+        )
+
+def demux_group(base_dir, group, from_SRA=False, **kwargs):
+    ''' See repair_seq.demux_engine.demux for options. '''
+    library = UMILibrary(base_dir, group, from_SRA=from_SRA)
+    repair_seq.demux_engine.demux(library, **kwargs)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('base_dir', type=Path, default=Path.home() / 'projects' / 'repair_seq')
     parser.add_argument('group_name')
-    parser.add_argument('--debug', action='store_true')
     parser.add_argument('--from_SRA', action='store_true')
-    parser.add_argument('--just_chunk', action='store_true')
-    parser.add_argument('--reads_per_chunk', type=int, default=int(5e6))
+    repair_seq.demux_engine.add_arguments(parser)
 
     args = parser.parse_args()
 
     demux_group(args.base_dir, args.group_name,
-                debug=args.debug,
                 from_SRA=args.from_SRA,
-                reads_per_chunk=args.reads_per_chunk,
-                just_chunk=args.just_chunk,
-               )
\ No newline at end of file
+                **repair_seq.demux_engine.options_from_args(args),
+               )
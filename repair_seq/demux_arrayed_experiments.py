@@ -1,5 +1,11 @@
+import functools
 import gzip
+import io
 import itertools
+import logging
+import multiprocessing
+import threading
+import time
 from pathlib import Path
 from collections import Counter
 from contextlib import ExitStack
@@ -10,114 +16,200 @@ import tqdm
 import hits.fastq
 import hits.utilities
 
+import repair_seq.compression
+import repair_seq.demux_engine
+import repair_seq.resolvers
+
 progress = tqdm.tqdm
 
-def demux_SE(base_dir, batch, payload_read_type='R1', num_reads=None, only_first_n=None):
-    base_dir = Path(base_dir)
-    data_dir = base_dir  / 'data' / batch
+def get_sample_field(sample_sheet):
+    ''' Returns a field that resolves samples from i7 and i5 reads, and the
+    packed resolvers it uses.
+    '''
+    engine = repair_seq.demux_engine
 
-    sample_sheet_fn = data_dir / 'sample_sheet.csv'
+    packed = {k: repair_seq.resolvers.PackedResolver(hits.utilities.get_one_mismatch_resolver(sample_sheet[k]).get) for k in ['i7', 'i5']}
+
+    sample_field = engine.ConsistentField('sample', [
+        engine.Field('i7', 'i7'),
+        engine.Field('i5', 'i5'),
+    ], raise_if_ambiguous=True)
+
+    return sample_field, packed
+
+@functools.lru_cache(maxsize=None)
+def load_sample_field(sample_sheet_fn):
     sample_sheet = pd.read_csv(sample_sheet_fn, index_col='sample_name')
+    return get_sample_field(sample_sheet)
+
+def resolve_samples(sample_field, packed, columns):
+    ''' Returns the sample of each read in columns, with reads that don't
+    resolve to a sample named by their index sequences.
+    '''
+    names, indices = sample_field.resolve(columns, packed, None)
+
+    samples = []
+    for i7, i5, index in zip(columns['i7'], columns['i5'], indices):
+        if index == -1:
+            samples.append(f'{i7.seq}+{i5.seq}')
+        else:
+            samples.append(names[index])
 
-    fns = {which: data_dir / f'{which}.fastq.gz' for which in [payload_read_type, 'i7', 'i5']}
-    reads = {k: hits.fastq.reads(v) for k, v in fns.items()} 
+    return samples
 
-    counts = Counter()
+def read_shards(fns, reads_per_shard, only_first_n=None, semaphore=None):
+    ''' Yields shards of up to reads_per_shard reads from each of fns (a dict of
+    read type to file name) as {read_type: text of the shard's fastq records}.
+    If semaphore is given, it is acquired before reading each shard so that
+    only a bounded number of shards are held in memory at once.
+    '''
+    line_groups = zip(*[repair_seq.compression.line_groups(fn) for fn in fns.values()])
+
+    if only_first_n is not None:
+        line_groups = itertools.islice(line_groups, only_first_n)
+
+    while True:
+        if semaphore is not None:
+            semaphore.acquire()
+
+        shard = list(itertools.islice(line_groups, reads_per_shard))
+        if len(shard) == 0:
+            break
+
+        yield {which: ''.join(itertools.chain.from_iterable(groups)) for which, groups in zip(fns, zip(*shard))}
+
+def demux_shard(sample_sheet_fn, payload_read_types, outputs, shard):
+    ''' Resolves the sample of each read in shard and returns the counts of
+    each sample (or index pair), and gzip-compressed payload reads for each
+    sample in outputs as {sample: {read_type: bytes}}.
+    '''
+    sample_field, packed = load_sample_field(sample_sheet_fn)
+
+    columns = {which: list(hits.fastq.reads(io.StringIO(text))) for which, text in shard.items()}
+
+    samples = resolve_samples(sample_field, packed, columns)
+
+    texts = {sample: {which: [] for which in payload_read_types} for sample in outputs}
+
+    for i, sample in enumerate(samples):
+        if sample in texts:
+            for which in payload_read_types:
+                texts[sample][which].append(str(columns[which][i]))
+
+    compressed = {sample: {which: gzip.compress(''.join(text).encode(), compresslevel=1) for which, text in by_which.items()}
+                  for sample, by_which in texts.items()
+                 }
+
+    return Counter(samples), compressed
+
+def demux(base_dir, batch, payload_read_types, output_fn_columns,
+          num_reads=None,
+          only_first_n=None,
+          num_processes=None,
+          reads_per_shard=int(2.5e5),
+         ):
+    ''' Splits the full input into shards that are demultiplexed in parallel.
+    Each shard's output for a sample is a separate gzip member appended to that
+    sample's output files in input order, so outputs match a single-process run.
 
-    resolvers = {k: hits.utilities.get_one_mismatch_resolver(sample_sheet[k]).get for k in ['i7', 'i5']}
+    output_fn_columns: {read_type: sample sheet column with output file name}
+    '''
+    base_dir = Path(base_dir)
+    data_dir = base_dir / 'data' / batch
+
+    sample_sheet_fn = data_dir / 'sample_sheet.csv'
+    sample_sheet = pd.read_csv(sample_sheet_fn, index_col='sample_name')
+
+    read_types = list(payload_read_types) + [which for which in ['i7', 'i5'] if which not in payload_read_types]
+    fns = {which: data_dir / f'{which}.fastq.gz' for which in read_types}
 
-    zipped_reads = zip(reads[payload_read_type], reads['i7'], reads['i5'])
+    outputs = {sample: {which: data_dir / sample_sheet.loc[sample, column] for which, column in output_fn_columns.items()}
+               for sample in sample_sheet.index
+              }
 
     if only_first_n is not None:
-        zipped_reads = itertools.islice(zipped_reads, only_first_n)
         if num_reads is not None:
             num_reads = min(num_reads, only_first_n)
         else:
             num_reads = only_first_n
 
-    with ExitStack() as stack:
-
-        sample_to_fh = {}
-
-        for sample, fn in sample_sheet['fastq_fn'].items():
-            fh = stack.enter_context(gzip.open(data_dir / fn, 'wt', compresslevel=1))
-            sample_to_fh[sample] = fh
-
-        for payload_read, i7, i5 in progress(zipped_reads, total=num_reads):
-            i7_samples = resolvers['i7'](i7.seq, {'unknown'})
-            i5_samples = resolvers['i5'](i5.seq, {'unknown'})
-            
-            consistent_with_both = i7_samples & i5_samples
-
-            if len(consistent_with_both) == 0:
-                sample = f'{i7.seq}+{i5.seq}'
-
-            elif len(consistent_with_both) == 1:
-                sample = next(iter(consistent_with_both))
-                if sample == 'unknown':
-                    sample = f'{i7.seq}+{i5.seq}'
-
-            else:
-                print(i7.seq, i5.seq, consistent_with_both)
-                raise ValueError
-                
-            counts[sample] += 1
-                        
-            if sample in sample_to_fh:
-                sample_to_fh[sample].write(str(payload_read))
-            
-    index_counts_fn = data_dir / 'index_counts.txt'
-    pd.Series(counts).sort_values(ascending=False).to_csv(index_counts_fn, header=None)
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
 
-def demux_PE(base_dir, batch):
-    data_dir = base_dir  / 'data' / batch
+    # Bounds the number of shards read but not yet written.
+    shards_in_flight = threading.Semaphore(2 * num_processes)
 
-    sample_sheet_fn = data_dir / 'sample_sheet.csv'
-    sample_sheet = pd.read_csv(sample_sheet_fn, index_col='sample_name')
+    counts = Counter()
 
-    fns = {which: data_dir / f'{which}.fastq.gz' for which in ['R1', 'R2', 'i7', 'i5']}
-    reads = {k: hits.fastq.reads(v) for k, v in fns.items()} 
+    start_time = time.monotonic()
 
-    counts = Counter()
+    shards = read_shards(fns, reads_per_shard, only_first_n, shards_in_flight)
+    demux_shard_function = functools.partial(demux_shard, sample_sheet_fn, payload_read_types, list(outputs))
 
-    resolvers = {k: hits.utilities.get_one_mismatch_resolver(sample_sheet[k]).get for k in ['i7', 'i5']}
+    opened_fns = []
 
-    sample_to_fhs = {
-        sample_name: {
-            which: gzip.open(data_dir / sample_sheet.loc[sample_name, f'{which}_fn'], 'wt', compresslevel=1)
-            for which in ['R1', 'R2']
-        } for sample_name in sample_sheet.index
-    }
+    try:
+        with ExitStack() as stack:
+            output_fhs = {}
+            for sample, by_which in outputs.items():
+                output_fhs[sample] = {}
+                for which, fn in by_which.items():
+                    output_fhs[sample][which] = stack.enter_context(open(fn, 'wb'))
+                    opened_fns.append(fn)
 
-    quartets = zip(reads['R1'], reads['R2'], reads['i7'], reads['i5'])
-    quartets = itertools.islice(quartets, int(1e6))
-    for R1, R2, i7, i5 in progress(quartets):
-        i7_samples = resolvers['i7'](i7.seq, {'unknown'})
-        i5_samples = resolvers['i5'](i5.seq, {'unknown'})
-        
-        consistent_with_both = i7_samples & i5_samples
+            progress_bar = stack.enter_context(progress(total=num_reads, unit='reads', unit_scale=True))
 
-        if len(consistent_with_both) == 0:
-            sample = f'{i7.seq}+{i5.seq}'
+            pool = stack.enter_context(multiprocessing.Pool(processes=num_processes))
 
-        elif len(consistent_with_both) == 1:
-            sample = next(iter(consistent_with_both))
-            if sample == 'unknown':
-                sample = f'{i7.seq}+{i5.seq}'
+            # imap returns results in input order, so writing them as they arrive
+            # keeps every output file in input order.
+            for shard_counts, compressed in pool.imap(demux_shard_function, shards):
+                for sample, by_which in compressed.items():
+                    for which, data in by_which.items():
+                        output_fhs[sample][which].write(data)
 
-        else:
-            print(i7.seq, i5.seq, consistent_with_both)
-            raise ValueError
-            
-        counts[sample] += 1
-                    
-        if sample in sample_to_fhs:
-            sample_to_fhs[sample]['R1'].write(str(R1))
-            sample_to_fhs[sample]['R2'].write(str(R2))
-            
-    for fhs in sample_to_fhs.values():
-        for fh in fhs.values():
-            fh.close()      
+                counts.update(shard_counts)
+                progress_bar.update(sum(shard_counts.values()))
+
+                shards_in_flight.release()
+
+    except:
+        # Outputs are only complete if every shard was written, so don't
+        # leave partial ones behind to be mistaken for finished files.
+        for fn in opened_fns:
+            if fn.exists():
+                fn.unlink()
+        raise
+
+    elapsed = time.monotonic() - start_time
+
+    counts = pd.Series(counts, dtype=int).sort_values(ascending=False)
 
     index_counts_fn = data_dir / 'index_counts.txt'
-    pd.Series(counts).sort_values(ascending=False).to_csv(index_counts_fn, header=None)
\ No newline at end of file
+    counts.to_csv(index_counts_fn, header=None)
+
+    total = counts.sum()
+    logging.info(f'Demultiplexed {total:,} reads from {batch} in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} reads/s)')
+
+    for sample in sample_sheet.index:
+        num_sample_reads = counts.get(sample, 0)
+        logging.info(f'{sample}: {num_sample_reads:,} reads ({num_sample_reads / max(total, 1):.2%}, {num_sample_reads / max(elapsed, 1e-9):,.0f} reads/s)')
+
+    unassigned = counts.drop(sample_sheet.index, errors='ignore')
+    logging.info(f'{unassigned.sum():,} reads from {len(unassigned):,} unassigned index pairs')
+
+    return counts
+
+def demux_SE(base_dir, batch, payload_read_type='R1', num_reads=None, only_first_n=None, num_processes=None):
+    return demux(base_dir, batch, [payload_read_type], {payload_read_type: 'fastq_fn'},
+                 num_reads=num_reads,
+                 only_first_n=only_first_n,
+                 num_processes=num_processes,
+                )
+
+def demux_PE(base_dir, batch, num_reads=None, only_first_n=None, num_processes=None):
+    return demux(base_dir, batch, ['R1', 'R2'], {'R1': 'R1_fn', 'R2': 'R2_fn'},
+                 num_reads=num_reads,
+                 only_first_n=only_first_n,
+                 num_processes=num_processes,
+                )
@@ -0,0 +1,1320 @@
+''' Shared machinery for demultiplexing pooled screens.
+
+A Library describes one kind of sequencing library. It says where a group's
+input files are and how its reads are laid out, as a ReadStructure. It also
+says where demuxed reads and statistics should go. demux.py, demux_gDNA.py
+and demux_just_guides.py each define a Library. Everything else lives here:
+chunking, direct indexed reading, scheduling, resumption, the per-read loop,
+writing demuxed reads and merging statistics.
+'''
+
+import bisect
+import contextlib
+import functools
+import gzip
+import itertools
+import logging
+import multiprocessing
+import shutil
+import zlib
+
+from collections import defaultdict, Counter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import tqdm
+
+from hits import fastq, utilities
+
+import repair_seq.compression
+import repair_seq.partitioned_fastq
+import repair_seq.pooled_screen
+import repair_seq.resolvers
+import repair_seq.seq_counts
+import repair_seq.subsample
+
+try:
+    from repair_seq import fastq_cython
+except ImportError:
+    # Falls back to parsing with hits.fastq if the extension hasn't been built.
+    fastq_cython = None
+
+memoized_property = utilities.memoized_property
+
+def chunk_number_to_string(chunk_number):
+    return f'{chunk_number:06d}'
+
+def count_seq_array(counter, seq_bytes, lengths):
+    ''' Adds counts of the sequences in seq_bytes (an array of ASCII bases
+    zero-padded past each row's length) to counter.
+    '''
+    if len(lengths) == 0:
+        return
+
+    if seq_bytes.shape[1] == 0:
+        counter[''] += len(lengths)
+        return
+
+    rows = np.ascontiguousarray(seq_bytes).view(np.dtype((np.void, seq_bytes.shape[1]))).ravel()
+    unique_rows, first, row_counts = np.unique(rows, return_index=True, return_counts=True)
+
+    for i, count in zip(first, row_counts):
+        counter[seq_bytes[i, :lengths[i]].tobytes().decode()] += int(count)
+
+# Read structure
+
+class Field:
+    ''' A sequence taken from seq_slice of read_type and resolved to a name by
+    the resolver stored under resolver (defaults to name).
+    If count_key is given, the raw sequences are also tallied under count_key.
+    '''
+    def __init__(self, name, read_type, seq_slice=slice(None), resolver=None, count_key=None):
+        self.name = name
+        self.read_type = read_type
+        self.seq_slice = seq_slice
+        self.resolver = resolver if resolver is not None else name
+        self.count_key = count_key
+
+    def resolve_sets(self, columns, packed, counts):
+        ''' Returns an array of indices into the resolver's name_sets. '''
+        column = columns[self.read_type]
+        resolver = packed[self.resolver]
+
+        if isinstance(column, list):
+            seqs = [read.seq[self.seq_slice] for read in column]
+
+            if self.count_key is not None:
+                counts[self.count_key].update(seqs)
+
+            return resolver.resolve_sets(seqs)
+
+        else:
+            seq_bytes, lengths = column.seq_array(self.seq_slice)
+
+            if self.count_key is not None:
+                count_seq_array(counts[self.count_key], seq_bytes, lengths)
+
+            return resolver.resolve_sets_array(seq_bytes, lengths)
+
+    def resolve(self, columns, packed, counts):
+        ''' Returns a list of names ending in 'unknown' and an array of indices
+        into it, one per read.
+        '''
+        resolver = packed[self.resolver]
+        return resolver.names_with_unknown, resolver.set_to_name[self.resolve_sets(columns, packed, counts)]
+
+class ConsistentField:
+    ''' A name consistent with each of several Fields, i.e. the single name
+    in the intersection of the sets of names they resolve to. For example,
+    a sample identified by both its I7 and I5 index.
+    '''
+    def __init__(self, name, fields, raise_if_ambiguous=False):
+        self.name = name
+        self.fields = fields
+        self.raise_if_ambiguous = raise_if_ambiguous
+
+    def resolve(self, columns, packed, counts):
+        resolvers = [packed[field.resolver] for field in self.fields]
+        set_indices = np.stack([field.resolve_sets(columns, packed, counts) for field in self.fields], axis=1)
+
+        names = sorted(set.intersection(*[set(resolver.names) for resolver in resolvers]))
+        names_with_unknown = names + ['unknown']
+        name_to_index = {name: i for i, name in enumerate(names)}
+
+        unique_rows, inverse = np.unique(set_indices, axis=0, return_inverse=True)
+
+        row_values = np.full(len(unique_rows), -1, dtype=np.int32)
+        for row_i, row in enumerate(unique_rows):
+            name_sets = [resolver.name_sets[i] if i != -1 else frozenset() for resolver, i in zip(resolvers, row)]
+            consistent = frozenset.intersection(*name_sets)
+
+            if len(consistent) == 1:
+                row_values[row_i] = name_to_index[next(iter(consistent))]
+            elif len(consistent) > 1 and self.raise_if_ambiguous:
+                raise ValueError(f'{self.name} is ambiguous: {sorted(consistent)}')
+
+        return names_with_unknown, row_values[inverse.ravel()]
+
+class ConstantField:
+    ''' A name that is the same for every read, e.g. the sample for data that
+    was already demultiplexed.
+    '''
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def resolve(self, columns, packed, counts):
+        num_reads = len(next(iter(columns.values())))
+        return [self.value, 'unknown'], np.zeros(num_reads, dtype=np.int32)
+
+def read_name(read):
+    return read.name
+
+def read_seq(read):
+    return read.seq
+
+def sanitized_qual(read):
+    return fastq.sanitize_qual(read.qual)
+
+class ReadStructure:
+    ''' Declarative description of how a library's reads are demultiplexed.
+
+    read_types: read types that make up one unit of reads, in order.
+    fields: Fields (or ConsistentFields or ConstantFields) to resolve.
+    key_fields: names of the three fields (sample, fixed guide, variable guide)
+        that determine where a read is written.
+    required_fields: names of fields that must resolve for a read to be kept.
+    output_read_type, output_slice: which read is written, and what part of it.
+    Annotation, annotation_values: the annotation given to the written read's name,
+        built from {key: (read_type, function of that read)}.
+    id_fields: names of fields whose combinations are counted as ids.
+    read_kwargs: passed to fastq.reads when reading inputs.
+    subsample_key: (read_type, function of that read) giving the UMI (or
+        other key) that determines whether a read is kept when subsampling.
+    '''
+    def __init__(self,
+                 read_types,
+                 fields,
+                 key_fields,
+                 required_fields,
+                 output_read_type,
+                 Annotation,
+                 annotation_values,
+                 output_slice=slice(None),
+                 id_fields=None,
+                 read_kwargs=None,
+                 subsample_key=None,
+                ):
+        self.read_types = read_types
+        self.fields = fields
+        self.key_fields = key_fields
+        self.required_fields = required_fields
+        self.output_read_type = output_read_type
+        self.output_slice = output_slice
+        self.Annotation = Annotation
+        self.annotation_values = annotation_values
+
+        if id_fields is None:
+            id_fields = key_fields
+        self.id_fields = id_fields
+
+        if read_kwargs is None:
+            read_kwargs = dict(up_to_space=True)
+        self.read_kwargs = read_kwargs
+
+        self.subsample_key = subsample_key
+
+# Per-read loop
+
+# Number of reads resolved together in each batch.
+demux_batch_size = 100000
+
+def count_ids(counts, resolved):
+    ''' Adds counts of each combination of resolved names (pairs of
+    (names, array of indices into names)) to counts. Combinations of more
+    than one field are keyed by tuples of names.
+    '''
+    ids = np.stack([indices for names, indices in resolved], axis=1)
+    unique_ids, id_counts = np.unique(ids, axis=0, return_counts=True)
+    for row, count in zip(unique_ids, id_counts):
+        key = tuple(names[i] for (names, _), i in zip(resolved, row))
+        if len(key) == 1:
+            key = key[0]
+        counts[key] += int(count)
+
+def read_batches(structure, read_tuples, batch_size=demux_batch_size):
+    ''' Groups tuples of reads (in structure.read_types order) into batches,
+    yielded as {read_type: list of reads}.
+    '''
+    for batch in utilities.chunks(read_tuples, batch_size):
+        columns = dict(zip(structure.read_types, map(list, zip(*batch))))
+
+        names = [[read.name for read in column] for column in columns.values()]
+        if any(other_names != names[0] for other_names in names[1:]):
+            raise ValueError('reads out of sync')
+
+        yield columns
+
+def resolve_batch(structure, columns, packed, counts):
+    resolved = {field.name: field.resolve(columns, packed, counts) for field in structure.fields}
+    count_ids(counts['id'], [resolved[name] for name in structure.id_fields])
+    return resolved
+
+def demux_reads(structure, packed, read_tuples, writers, counts, subsample=None):
+    demux_batches(structure, packed, read_batches(structure, read_tuples), writers, counts, subsample=subsample)
+
+def demux_batches(structure, packed, batches, writers, counts, subsample=None):
+    ''' Resolves every field of every read, tallying counts, and adds annotated
+    output reads for reads with all required fields resolved to writers, keyed by
+    the names of structure.key_fields.
+    batches: iterable of {read_type: column}, where columns are lists of Reads or
+        fastq_cython.FastqColumns.
+    subsample: if given, a repair_seq.subsample.Subsample that the value of
+        structure.subsample_key must be in for a read to be written. Counts
+        are still made from all reads.
+    '''
+    if subsample is not None and structure.subsample_key is None:
+        raise ValueError('read structure has no subsample_key')
+
+    # Read types that Reads need to be made for, for kept reads only.
+    needed_read_types = {structure.output_read_type} | {read_type for read_type, _ in structure.annotation_values.values()}
+    if subsample is not None:
+        needed_read_types.add(structure.subsample_key[0])
+
+    for columns in batches:
+        resolved = resolve_batch(structure, columns, packed, counts)
+
+        keep = np.ones(len(columns[structure.output_read_type]), dtype=bool)
+        for name in structure.required_fields:
+            keep &= resolved[name][1] != -1
+
+        key_resolved = [resolved[name] for name in structure.key_fields]
+
+        for i in np.flatnonzero(keep):
+            key = tuple(names[indices[i]] for names, indices in key_resolved)
+
+            reads = {read_type: columns[read_type][i] for read_type in needed_read_types}
+
+            if subsample is not None:
+                read_type, get_key = structure.subsample_key
+                if get_key(reads[read_type]) not in subsample:
+                    continue
+
+            values = {k: get_value(reads[read_type]) for k, (read_type, get_value) in structure.annotation_values.items()}
+
+            read = reads[structure.output_read_type]
+            read.name = str(structure.Annotation(**values))
+
+            writers[key].append(read[structure.output_slice])
+
+# Output
+
+@functools.lru_cache(maxsize=None)
+def get_demux_pool(base_dir, pool_name, pool_class):
+    return pool_class(base_dir, pool_name)
+
+@functools.lru_cache(maxsize=None)
+def get_chunks_dir(base_dir, pool_name, fixed_guide, variable_guide, pool_class=None):
+    ''' Returns the directory that demuxed chunks for a guide pair in pool_name
+    should be written to. Pools and experiments are only constructed the first
+    time each guide pair is seen in a worker process, rather than once per
+    guide pair per chunk.
+    '''
+    if pool_class is None:
+        pool_class = repair_seq.pooled_screen.PooledScreen
+
+    pool = get_demux_pool(Path(base_dir), pool_name, pool_class)
+    exp = pool.single_guide_experiment(fixed_guide, variable_guide)
+    return exp.fns['chunks']
+
+def get_read_chunks_dir(base_dir, pool_name, pool_class=None):
+    if pool_class is None:
+        pool_class = repair_seq.pooled_screen.PooledScreen
+
+    return get_demux_pool(Path(base_dir), pool_name, pool_class).fns['read_chunks']
+
+def write_partitioned_chunks(base_dir, sorters, get_pool_name, chunk_string, pool_class=None):
+    ''' Writes reads from sorters (keyed by (sample, fixed_guide, variable_guide))
+    into one partitioned container per pool, with one partition per guide
+    combination. Empties sorters as it goes.
+    '''
+    keys_by_pool = defaultdict(list)
+    for sample, fixed_guide, variable_guide in sorted(sorters):
+        keys_by_pool[get_pool_name(sample)].append((sample, fixed_guide, variable_guide))
+
+    def partitions(keys):
+        for sample, fixed_guide, variable_guide in keys:
+            reads = sorters.pop((sample, fixed_guide, variable_guide))
+            sorted_reads = sorted(reads, key=lambda r: r.name)
+            # Keys match SingleGuideExperiment sample_names.
+            yield f'{fixed_guide}-{variable_guide}', sorted_reads
+
+    for pool_name, keys in keys_by_pool.items():
+        output_dir = get_read_chunks_dir(base_dir, pool_name, pool_class=pool_class)
+        output_dir.mkdir(exist_ok=True, parents=True)
+
+        fn = output_dir / f'{chunk_string}_R2.partitioned_fastq'
+        repair_seq.partitioned_fastq.write(fn, partitions(keys))
+
+class Writers:
+    ''' Collects demuxed reads from one chunk, keyed by (sample, fixed_guide,
+    variable_guide), and writes them sorted by name into each guide
+    combination's experiment.
+    '''
+    def __init__(self, library, unit, chunk_number):
+        self.library = library
+        self.chunk_string = f'{unit}_{chunk_number_to_string(chunk_number)}'
+        self.writers = defaultdict(list)
+
+    def __getitem__(self, key):
+        return self.writers[key]
+
+    def write(self):
+        library = self.library
+
+        if library.partitioned:
+            write_partitioned_chunks(library.base_dir, self.writers, library.get_pool_name, self.chunk_string,
+                                     pool_class=library.pool_class,
+                                    )
+            return
+
+        for sample, fixed_guide, variable_guide in sorted(self.writers):
+            reads = self.writers[sample, fixed_guide, variable_guide]
+            sorted_reads = sorted(reads, key=lambda r: r.name)
+
+            pool_name = library.get_pool_name(sample)
+
+            output_dir = get_chunks_dir(library.base_dir, pool_name, fixed_guide, variable_guide, pool_class=library.pool_class)
+            output_dir.mkdir(exist_ok=True, parents=True)
+
+            settings = library.compression_settings('experiment_chunks')
+            fn = output_dir / f'{self.chunk_string}_R2{repair_seq.compression.fastq_suffix(settings["codec"])}'
+
+            with repair_seq.compression.open_for_stage(fn, 'wt', library.sample_sheet, 'experiment_chunks') as zfh:
+                for read in sorted_reads:
+                    zfh.write(str(read))
+
+            del self.writers[sample, fixed_guide, variable_guide]
+            del sorted_reads
+
+# Libraries
+
+class Library:
+    ''' Base class for descriptions of a kind of library. Subclasses provide
+    sample_sheet, units, input_fn_name, num_reads, get_pool_name,
+    get_resolvers_fn, get_resolvers, read_structure and stat_keys, and may
+    override samples, prepare and finish.
+
+    Instances are passed to worker processes, so shouldn't hold on to
+    anything expensive to pickle.
+    '''
+    read_types = fastq.quartet_order
+    chunks_dir_name = 'chunks'
+    manifest_name = 'demux_manifest.txt'
+    # Number of reads per unit to process in debug mode.
+    debug_num_reads = int(1e6)
+
+    def __init__(self, base_dir, group):
+        self.base_dir = Path(base_dir)
+        self.group = group
+        # Set by demux.
+        self.subsample = None
+
+    @property
+    def pool_class(self):
+        return repair_seq.pooled_screen.PooledScreen
+
+    @property
+    def samples(self):
+        ''' Samples whose reads are demuxed into the pools given by get_pool_name. '''
+        return sorted(self.sample_sheet['pool_details'])
+
+    @property
+    def pool_names(self):
+        return [self.get_pool_name(sample) for sample in self.samples]
+
+    @property
+    def group_dir(self):
+        return self.base_dir / 'data' / self.group
+
+    @property
+    def chunks_dir(self):
+        return self.group_dir / self.chunks_dir_name
+
+    @property
+    def manifest_fn(self):
+        return self.group_dir / self.manifest_name
+
+    @property
+    def partitioned(self):
+        # If partitioned_chunks is set, each chunk writes one container per pool
+        # instead of one file per guide combination.
+        return self.sample_sheet.get('partitioned_chunks', False)
+
+    def input_fn(self, unit, which):
+        return (self.group_dir / self.input_fn_name(unit, which)).with_suffix('.fastq.gz')
+
+    def chunk_fn(self, unit, which, chunk_number):
+        suffix = repair_seq.compression.fastq_suffix(self.compression_settings('demux_chunks')['codec'])
+        return self.chunks_dir / f'{self.input_fn_name(unit, which)}_{chunk_number_to_string(chunk_number)}{suffix}'
+
+    def compression_settings(self, stage):
+        return repair_seq.compression.get_settings(self.sample_sheet, stage)
+
+    def index_fn(self, unit, which):
+        return self.group_dir / 'fastq_indices' / f'{self.input_fn_name(unit, which)}.npz'
+
+    def count_fn(self, key, unit, chunk_number):
+        return self.chunks_dir / f'{key}_{unit}_{chunk_number_to_string(chunk_number)}.npz'
+
+    def stats_fn(self, key):
+        return self.group_dir / f'{key}_stats.txt'
+
+    def prepare(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def compile_resolvers(self):
+        return repair_seq.resolvers.compile_resolvers(self.get_resolvers_fn(), self.get_resolvers)
+
+    def load_resolvers(self):
+        return repair_seq.resolvers.load_resolvers(self.get_resolvers_fn(), self.get_resolvers)
+
+    def load_packed_resolvers(self):
+        resolvers, expected_seqs, *_ = self.load_resolvers()
+        return repair_seq.resolvers.pack_resolvers(resolvers)
+
+# Chunking and indexed reading
+
+class FastqChunker:
+    def __init__(self, library, unit, which, reads_per_chunk=None, queue=None, debug=False, semaphore=None, completed_chunks=None):
+        self.library = library
+        self.unit = unit
+        self.which = which
+        self.reads_per_chunk = reads_per_chunk
+        self.queue = queue
+        self.debug = debug
+        # If given, acquired before starting each chunk and released by the
+        # scheduler once that chunk has been demuxed, bounding the number of
+        # chunks on disk.
+        self.semaphore = semaphore
+
+        # Chunks written by a previous run, which are passed over without writing.
+        if completed_chunks is None:
+            completed_chunks = set()
+        self.completed_chunks = completed_chunks
+
+        self.input_fn = library.input_fn(unit, which)
+
+        self.current_chunk_number = -1
+
+        self.current_fh = None
+
+    def close_current_chunk(self):
+        if self.current_fh is not None:
+            self.current_fh.close()
+            self.current_fh = None
+            if self.queue is not None:
+                self.queue.put(('chunk', self.unit, self.which, self.current_chunk_number))
+
+    def get_chunk_fn(self, chunk_number):
+        return self.library.chunk_fn(self.unit, self.which, chunk_number)
+
+    def start_next_chunk(self):
+        self.close_current_chunk()
+
+        self.current_chunk_number += 1
+
+        if self.current_chunk_number in self.completed_chunks:
+            return
+
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+
+        chunk_fn = self.get_chunk_fn(self.current_chunk_number)
+        self.current_fh = repair_seq.compression.open_for_stage(chunk_fn, 'wt', self.library.sample_sheet, 'demux_chunks')
+
+    def split_into_chunks(self):
+        self.library.chunks_dir.mkdir(exist_ok=True, parents=True)
+
+        threads = self.library.compression_settings('demux_input')['threads']
+        line_groups = repair_seq.compression.line_groups(self.input_fn, threads=threads)
+
+        if self.debug:
+            line_groups = itertools.islice(line_groups, self.library.debug_num_reads)
+
+        for read_number, line_group in enumerate(line_groups):
+            if read_number % self.reads_per_chunk == 0:
+                self.start_next_chunk()
+
+            if self.current_fh is None:
+                continue
+
+            for line in line_group:
+                self.current_fh.write(line)
+
+        self.close_current_chunk()
+
+        self.queue.put(('chunk', self.unit, self.which, 'DONE'))
+
+def split_into_chunks(library, unit, which, reads_per_chunk, queue, debug, semaphore=None, completed_chunks=None):
+    chunker = FastqChunker(library, unit, which, reads_per_chunk, queue, debug, semaphore, completed_chunks)
+    return chunker.split_into_chunks()
+
+class FastqIndex:
+    ''' Index of the gzip members that make up a fastq.gz file, recording the
+    compressed offset of each member and the number of lines that precede it.
+    Multi-member files (e.g. BGZF or concatenated gzip output from the sequencer)
+    can then be read starting from an arbitrary read without decompressing
+    everything before it.
+    '''
+    block_size = 1 << 20
+
+    def __init__(self, input_fn, index_fn):
+        self.input_fn = Path(input_fn)
+        self.index_fn = Path(index_fn)
+
+    @property
+    def is_current(self):
+        return self.index_fn.exists() and self.index_fn.stat().st_mtime >= self.input_fn.stat().st_mtime
+
+    def build(self):
+        member_offsets = []
+        lines_before_member = []
+
+        num_lines = 0
+        position = 0
+        pending = b''
+        decompressor = None
+
+        with open(self.input_fn, 'rb') as fh:
+            while True:
+                if len(pending) == 0:
+                    pending = fh.read(self.block_size)
+                    if len(pending) == 0:
+                        break
+
+                if decompressor is None:
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    member_offsets.append(position)
+                    lines_before_member.append(num_lines)
+
+                num_lines += decompressor.decompress(pending).count(b'\n')
+
+                if decompressor.eof:
+                    unused = decompressor.unused_data
+                    position += len(pending) - len(unused)
+                    pending = unused
+                    decompressor = None
+                else:
+                    position += len(pending)
+                    pending = b''
+
+        if num_lines % 4 != 0:
+            raise ValueError(f'{self.input_fn} has {num_lines} lines, not a multiple of 4')
+
+        self.index_fn.parent.mkdir(exist_ok=True, parents=True)
+        with open(self.index_fn, 'wb') as fh:
+            np.savez(fh,
+                     member_offsets=np.array(member_offsets, dtype=np.int64),
+                     lines_before_member=np.array(lines_before_member, dtype=np.int64),
+                     num_lines=num_lines,
+                    )
+
+    @memoized_property
+    def arrays(self):
+        with np.load(self.index_fn) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+        return arrays
+
+    @property
+    def num_reads(self):
+        return int(self.arrays['num_lines']) // 4
+
+    @property
+    def max_reads_per_member(self):
+        boundaries = np.append(self.arrays['lines_before_member'], self.arrays['num_lines'])
+        return int(np.diff(boundaries).max(initial=0)) // 4
+
+    def locate(self, start):
+        ''' Returns the compressed offset of the member containing read number
+        start and the number of lines to skip from the beginning of that member.
+        '''
+        start_line = start * 4
+
+        # Members can start partway through a line, so the chosen member starts
+        # strictly before start_line. Skipping lines from its start then
+        # consumes any partial first line, whether or not the member starts on
+        # a line boundary.
+        lines_before_member = list(self.arrays['lines_before_member'])
+        member = max(bisect.bisect_left(lines_before_member, start_line) - 1, 0)
+
+        offset = int(self.arrays['member_offsets'][member])
+        lines_to_skip = start_line - int(lines_before_member[member])
+
+        return offset, lines_to_skip
+
+    @contextlib.contextmanager
+    def open_binary(self, start):
+        ''' Opens a binary decompressed stream positioned at read number start. '''
+        offset, lines_to_skip = self.locate(start)
+
+        with open(self.input_fn, 'rb') as fh:
+            fh.seek(offset)
+            with gzip.open(fh, 'rb') as decompressed:
+                for _ in range(lines_to_skip):
+                    decompressed.readline()
+
+                yield decompressed
+
+    def reads(self, start, num_reads, **kwargs):
+        ''' Yields num_reads Read's starting from read number start. '''
+        offset, lines_to_skip = self.locate(start)
+
+        with open(self.input_fn, 'rb') as fh:
+            fh.seek(offset)
+            with gzip.open(fh, 'rt') as lines:
+                lines = itertools.islice(lines, lines_to_skip, lines_to_skip + num_reads * 4)
+                yield from fastq.reads(lines, **kwargs)
+
+def get_fastq_index(library, unit, which):
+    return FastqIndex(library.input_fn(unit, which), library.index_fn(unit, which))
+
+def build_fastq_index(library, unit, which):
+    index = get_fastq_index(library, unit, which)
+
+    if not index.is_current:
+        index.build()
+
+    return unit, which, index.num_reads, index.max_reads_per_member
+
+def index_input_fastqs(library, reads_per_chunk):
+    ''' Builds (or reuses) a FastqIndex for every input file and returns the
+    number of reads in each unit, or None if any file has gzip members too
+    large for reads_per_chunk-sized pieces to be read efficiently.
+    '''
+    args_list = [(library, unit, which) for unit in library.units for which in library.read_types]
+
+    with multiprocessing.Pool(processes=len(args_list)) as index_pool:
+        results = index_pool.starmap(build_fastq_index, args_list)
+
+    num_reads = defaultdict(set)
+
+    for unit, which, unit_num_reads, max_reads_per_member in results:
+        if max_reads_per_member > reads_per_chunk:
+            logging.warning(f'{unit} {which} has gzip members with up to {max_reads_per_member:,} reads')
+            return None
+
+        num_reads[unit].add(unit_num_reads)
+
+    for unit, counts in num_reads.items():
+        if len(counts) != 1:
+            raise ValueError(f'{unit} files have different numbers of reads: {counts}')
+
+    return {unit: counts.pop() for unit, counts in num_reads.items()}
+
+def get_chunk_reads(library, unit, chunk_number, read_kwargs, reads_per_chunk=None):
+    ''' Returns a list of Read iterators (one per read type) over the reads
+    in chunk chunk_number, plus the list of chunk files to delete afterwards.
+    If reads_per_chunk is given, reads are pulled directly from indexed input
+    files instead of from chunk files written by a FastqChunker.
+    '''
+    if reads_per_chunk is None:
+        fastq_fns = [library.chunk_fn(unit, which, chunk_number) for which in library.read_types]
+        all_reads = [repair_seq.compression.reads(fn, **read_kwargs) for fn in fastq_fns]
+    else:
+        fastq_fns = []
+        start = chunk_number * reads_per_chunk
+        indices = [get_fastq_index(library, unit, which) for which in library.read_types]
+        all_reads = [index.reads(start, reads_per_chunk, **read_kwargs) for index in indices]
+
+    return all_reads, fastq_fns
+
+def compiled_batches(library, unit, chunk_number, reads_per_chunk=None):
+    ''' Yields {read_type: FastqColumn} batches of the reads in chunk
+    chunk_number, parsed by fastq_cython.QuartetReader.
+    '''
+    with contextlib.ExitStack() as stack:
+        if reads_per_chunk is None:
+            fhs = [stack.enter_context(repair_seq.compression.open_file(library.chunk_fn(unit, which, chunk_number), 'rb')) for which in library.read_types]
+            max_records = None
+        else:
+            start = chunk_number * reads_per_chunk
+            indices = [get_fastq_index(library, unit, which) for which in library.read_types]
+            fhs = [stack.enter_context(index.open_binary(start)) for index in indices]
+            max_records = reads_per_chunk
+
+        reader = fastq_cython.QuartetReader(fhs, demux_batch_size, up_to_space=True, max_records=max_records)
+
+        for columns in reader:
+            yield dict(zip(library.read_types, columns))
+
+def get_chunk_batches(library, structure, unit, chunk_number, reads_per_chunk=None):
+    ''' Returns an iterator over batches of the reads in chunk chunk_number and
+    the list of chunk files to delete afterwards. Uses the compiled reader
+    if it is available and the read structure's naming allows it.
+    '''
+    if fastq_cython is not None and structure.read_kwargs == dict(up_to_space=True):
+        if reads_per_chunk is None:
+            fastq_fns = [library.chunk_fn(unit, which, chunk_number) for which in library.read_types]
+        else:
+            fastq_fns = []
+
+        batches = compiled_batches(library, unit, chunk_number, reads_per_chunk)
+
+    else:
+        all_reads, fastq_fns = get_chunk_reads(library, unit, chunk_number, structure.read_kwargs, reads_per_chunk)
+        batches = read_batches(structure, zip(*all_reads))
+
+    return batches, fastq_fns
+
+def demux_chunk(library, unit, chunk_number, queue, reads_per_chunk=None):
+    structure = library.read_structure()
+    packed = library.load_packed_resolvers()
+
+    batches, fastq_fns = get_chunk_batches(library, structure, unit, chunk_number, reads_per_chunk)
+
+    writers = Writers(library, unit, chunk_number)
+
+    counts = defaultdict(Counter)
+
+    demux_batches(structure, packed, batches, writers, counts, subsample=library.subsample)
+
+    writers.write()
+
+    for k, cs in counts.items():
+        repair_seq.seq_counts.write_counts(library.count_fn(k, unit, chunk_number), cs)
+
+    # Delete the chunk.
+    for fastq_fn in fastq_fns:
+        fastq_fn.unlink()
+
+    queue.put(('demux', unit, chunk_number))
+
+# Statistics
+
+def merge_seq_counts(library, k, max_distinct_seqs=None):
+    ''' If max_distinct_seqs is given, counts are merged with a bounded-memory
+    heavy hitters sketch that keeps at most that many sequences, and reported
+    counts may be slight underestimates.
+    '''
+    count_fns = sorted(library.chunks_dir.glob(f'{k}_*.npz'))
+
+    if max_distinct_seqs is None:
+        seqs, counts = repair_seq.seq_counts.merge_counts(count_fns)
+        total = int(counts.sum())
+        max_error = 0
+        most_common = repair_seq.seq_counts.most_common(seqs, counts, 100)
+    else:
+        sketch = repair_seq.seq_counts.HeavyHitters(max_distinct_seqs)
+        sketch.update_from_files(count_fns)
+        total = sketch.total
+        max_error = sketch.max_error
+        most_common = sketch.most_common(100)
+
+    resolvers, expected_seqs, *_ = library.load_resolvers()
+    resolver = resolvers[k]
+    expected_seqs = expected_seqs[k]
+
+    with open(library.stats_fn(k), 'w') as fh:
+        if max_error > 0:
+            fh.write(f'# Approximate counts: each may be underestimated by up to {max_error:,}\n')
+
+        for seq, count in most_common:
+            name = resolver(seq, '')
+
+            if isinstance(name, (set, frozenset)):
+                name = sorted(name)
+
+            if seq in expected_seqs:
+                mismatches = ''
+            elif name != '':
+                mismatches = ' (1 mismatch)'
+            else:
+                mismatches = ''
+
+            fraction = float(count) / total
+
+            fh.write(f'{seq}\t{count: >10,}\t({fraction: >6.2%})\t{name}{mismatches}\n')
+
+    for fn in count_fns:
+        fn.unlink()
+
+def merge_ids(library):
+    count_fns = sorted(library.chunks_dir.glob('id_*.npz'))
+
+    counts = repair_seq.seq_counts.to_dict(*repair_seq.seq_counts.merge_counts(count_fns))
+
+    counts = pd.Series(counts, dtype=int).sort_index()
+    counts.to_csv(library.stats_fn('id'), sep='\t', header=False)
+
+    for fn in count_fns:
+        fn.unlink()
+
+    return counts
+
+def merge_statistics(library, max_distinct_seqs=None):
+    with multiprocessing.Pool(processes=3) as merge_pool:
+        merge_results = [merge_pool.apply_async(merge_seq_counts, args=(library, k, max_distinct_seqs)) for k in library.stat_keys]
+        merge_results.append(merge_pool.apply_async(merge_ids, args=(library,)))
+
+        merge_pool.close()
+        merge_pool.join()
+
+    for merge_result in merge_results:
+        # Re-raises any exception from the worker so that the run isn't
+        # recorded as merged.
+        merge_result.get()
+
+# Scheduling and resumption
+
+class DemuxManifest:
+    ''' Record of which units of work in a demux run have finished, so that
+    an interrupted run can be resumed by rerunning the same command.
+    Lines are appended as work finishes:
+        chunked  unit  which  chunk_number
+        demuxed  unit  chunk_number
+        merged
+        complete
+    Only the main process writes to the manifest.
+    '''
+    def __init__(self, fn, reads_per_chunk, subsample=None):
+        self.fn = Path(fn)
+        self.reads_per_chunk = reads_per_chunk
+        self.subsample = subsample
+
+        self.chunked = defaultdict(set)
+        self.demuxed = set()
+        self.merged = False
+        self.complete = False
+
+        if self.fn.exists():
+            self.load()
+        else:
+            self.fn.parent.mkdir(exist_ok=True, parents=True)
+            with open(self.fn, 'w') as fh:
+                fh.write(f'# reads_per_chunk\t{reads_per_chunk}\n')
+                if subsample is not None:
+                    fh.write(f'# subsample\t{subsample.fraction}\t{subsample.seed}\n')
+
+    def load(self):
+        loaded_subsample = None
+
+        with open(self.fn) as fh:
+            for line in fh:
+                # An interrupted write can leave a partial final line.
+                if not line.endswith('\n'):
+                    break
+
+                fields = line.rstrip('\n').split('\t')
+
+                if fields[0] == '# reads_per_chunk':
+                    if int(fields[1]) != self.reads_per_chunk:
+                        raise ValueError(f'{self.fn} was made with reads_per_chunk={fields[1]}, not {self.reads_per_chunk}; use restart to start over')
+
+                elif fields[0] == '# subsample':
+                    loaded_subsample = repair_seq.subsample.Subsample(float(fields[1]), seed=int(fields[2]))
+
+                elif fields[0] == 'chunked':
+                    unit, which, chunk_number = fields[1:]
+                    self.chunked[unit, int(chunk_number)].add(which)
+
+                elif fields[0] == 'demuxed':
+                    unit, chunk_number = fields[1:]
+                    self.demuxed.add((unit, int(chunk_number)))
+
+                elif fields[0] == 'merged':
+                    self.merged = True
+
+                elif fields[0] == 'complete':
+                    self.complete = True
+
+                else:
+                    raise ValueError(line)
+
+        if loaded_subsample != self.subsample:
+            raise ValueError(f'{self.fn} was made with subsample={loaded_subsample}, not {self.subsample}; use restart to start over')
+
+    def record(self, *fields):
+        with open(self.fn, 'a') as fh:
+            fh.write('\t'.join(map(str, fields)) + '\n')
+
+    def record_chunked(self, unit, which, chunk_number):
+        self.chunked[unit, chunk_number].add(which)
+        self.record('chunked', unit, which, chunk_number)
+
+    def record_demuxed(self, unit, chunk_number):
+        self.demuxed.add((unit, chunk_number))
+        self.record('demuxed', unit, chunk_number)
+
+    def record_merged(self):
+        self.merged = True
+        self.record('merged')
+
+    def record_complete(self):
+        self.complete = True
+        self.record('complete')
+
+    def completed_chunks(self, unit, which):
+        ''' Chunk numbers that don't need to be written again for (unit, which). '''
+        chunk_numbers = {n for (u, n), whiches in self.chunked.items() if u == unit and which in whiches}
+        chunk_numbers.update(n for u, n in self.demuxed if u == unit)
+        return chunk_numbers
+
+def remove_demux_progress(library):
+    ''' Deletes the manifest and any intermediate files from a previous run,
+    including reads it already demuxed into experiments and pools. Chunk
+    numbers depend on reads_per_chunk, so these wouldn't be overwritten by a
+    new run and would instead be merged with its reads.
+    '''
+    if library.manifest_fn.exists():
+        library.manifest_fn.unlink()
+
+    if library.chunks_dir.exists():
+        shutil.rmtree(str(library.chunks_dir))
+
+    for pool_name in library.pool_names:
+        pool = repair_seq.pooled_screen.get_pool(library.base_dir, pool_name)
+        if pool is not None:
+            pool.remove_demuxed_reads()
+
+def allocate_processes(num_processes, num_units, num_read_types):
+    ''' Splits a budget of num_processes between chunkers and demuxers.
+    Chunkers get up to half of the budget, in whole units' worth of read
+    types where possible. A chunker is submitted for every read type of
+    every unit in unit order, so any unit with a started chunker
+    only waits on units ahead of it, which can always finish.
+    '''
+    num_chunkers = num_units * num_read_types
+
+    if num_processes is None:
+        return num_chunkers, 4 * num_units
+
+    chunk_processes = (num_processes // 2) // num_read_types * num_read_types
+    chunk_processes = min(num_chunkers, max(num_read_types, chunk_processes))
+
+    demux_processes = max(1, num_processes - chunk_processes)
+
+    return chunk_processes, demux_processes
+
+def demux_directly(library, reads_per_unit, reads_per_chunk, debug, num_processes=None, manifest=None):
+    ''' Demux reads_per_chunk-sized pieces of each unit by having workers
+    read their piece directly out of indexed input files.
+    '''
+    manager = multiprocessing.Manager()
+    tasks_done_queue = manager.Queue()
+
+    arg_tuples = []
+    total_chunks = 0
+    for unit, num_reads in sorted(reads_per_unit.items()):
+        if debug:
+            num_reads = min(num_reads, library.debug_num_reads)
+
+        for chunk_number in range(int(np.ceil(num_reads / reads_per_chunk))):
+            total_chunks += 1
+
+            if manifest is not None and (unit, chunk_number) in manifest.demuxed:
+                continue
+
+            arg_tuples.append((library, unit, chunk_number, tasks_done_queue, reads_per_chunk))
+
+    demux_progress = tqdm.tqdm(desc='Demux progress', total=total_chunks, initial=total_chunks - len(arg_tuples))
+
+    def make_callback(unit, chunk_number):
+        def callback(result):
+            if manifest is not None:
+                manifest.record_demuxed(unit, chunk_number)
+            demux_progress.update()
+
+        return callback
+
+    if num_processes is None:
+        num_processes = 4 * len(reads_per_unit)
+
+    with multiprocessing.Pool(processes=num_processes) as demux_pool:
+        demux_results = [demux_pool.apply_async(demux_chunk, args, callback=make_callback(args[1], args[2])) for args in arg_tuples]
+        demux_pool.close()
+        demux_pool.join()
+
+    demux_progress.close()
+
+    for demux_result in demux_results:
+        # Re-raises any exception from the worker.
+        demux_result.get()
+
+def chunk_and_demux(library, reads_per_chunk, debug, just_chunk,
+                    num_processes=None,
+                    max_chunks_in_flight=None,
+                    manifest=None,
+                   ):
+    ''' num_processes: total budget of worker processes for chunking and demuxing.
+    max_chunks_in_flight: maximum number of chunks that have been started but
+        not yet demuxed, split evenly across units. Chunkers wait for their
+        unit's earlier chunks to be demuxed before starting more.
+    '''
+    units = library.units
+    read_types = library.read_types
+
+    chunks_per_unit = [int(np.ceil(library.num_reads(unit) / reads_per_chunk)) for unit in units]
+    total_chunks = sum(chunks_per_unit)
+
+    manager = multiprocessing.Manager()
+    tasks_done_queue = manager.Queue()
+
+    chunk_processes, demux_processes = allocate_processes(num_processes, len(units), len(read_types))
+
+    # Backpressure doesn't make sense when nothing is demuxed, and debug
+    # mode waits for each chunker to finish before starting the next.
+    if max_chunks_in_flight is not None and not just_chunk and not debug:
+        per_unit = max(1, max_chunks_in_flight // len(units))
+        semaphores = {(unit, which): manager.Semaphore(per_unit) for unit in units for which in read_types}
+    else:
+        semaphores = {}
+
+    chunks_done = defaultdict(set)
+    demuxed = set()
+    completed_chunks = defaultdict(set)
+
+    if manifest is not None:
+        demuxed = set(manifest.demuxed)
+
+        for (unit, chunk_number), whiches in manifest.chunked.items():
+            if (unit, chunk_number) in demuxed:
+                continue
+
+            for which in whiches:
+                # A demux worker may have deleted the chunk without its
+                # completion being recorded, in which case it must be rewritten.
+                if library.chunk_fn(unit, which, chunk_number).exists():
+                    chunks_done[unit, chunk_number].add(which)
+
+        for unit, chunk_number in demuxed:
+            chunks_done[unit, chunk_number] = set(read_types)
+
+        for (unit, chunk_number), whiches in chunks_done.items():
+            for which in whiches:
+                completed_chunks[unit, which].add(chunk_number)
+
+    already_chunked = [key for key, whiches in chunks_done.items() if whiches == set(read_types)]
+
+    chunk_pool = multiprocessing.Pool(processes=chunk_processes)
+    chunk_progress = tqdm.tqdm(desc='Chunk progress', total=total_chunks, initial=len(already_chunked))
+    chunk_results = []
+
+    demux_pool = multiprocessing.Pool(processes=demux_processes)
+    demux_progress = tqdm.tqdm(desc='Demux progress', total=total_chunks, initial=len(demuxed))
+    demux_results = []
+
+    # Chunks left over from a previous run don't hold any semaphore permits.
+    resumed = set()
+
+    # A failed chunker never sends DONE and a failed demux worker never
+    # releases its chunk's permits, so failures are sent to the main loop
+    # to fail fast instead of waiting forever.
+    def report_error(error):
+        tasks_done_queue.put(('error', error))
+
+    with chunk_pool, demux_pool:
+
+        if not just_chunk:
+            for unit, chunk_number in sorted(already_chunked):
+                if (unit, chunk_number) not in demuxed:
+                    args = (library, unit, chunk_number, tasks_done_queue)
+                    demux_results.append(demux_pool.apply_async(demux_chunk, args, error_callback=report_error))
+                    resumed.add((unit, chunk_number))
+
+        unfinished_chunkers = set()
+
+        for unit in units:
+            for which in read_types:
+                args = (library, unit, which, reads_per_chunk, tasks_done_queue, debug,
+                        semaphores.get((unit, which)),
+                        completed_chunks[unit, which],
+                       )
+                chunk_result = chunk_pool.apply_async(split_into_chunks, args, error_callback=report_error)
+
+                if debug:
+                    result = chunk_result.get()
+                    if not chunk_result.successful():
+                        print(result)
+
+                chunk_results.append(chunk_result)
+
+                unfinished_chunkers.add((unit, which))
+
+        chunk_pool.close()
+
+        while True:
+            task_type, *task_info = tasks_done_queue.get()
+
+            if task_type == 'chunk':
+                unit, which, chunk_number = task_info
+
+                if chunk_number == 'DONE':
+                    unfinished_chunkers.remove((unit, which))
+                    if len(unfinished_chunkers) == 0:
+                        break
+                else:
+                    if manifest is not None:
+                        manifest.record_chunked(unit, which, chunk_number)
+
+                    chunks_done[unit, chunk_number].add(which)
+                    if chunks_done[unit, chunk_number] == set(read_types):
+                        chunk_progress.update()
+
+                        if not just_chunk:
+                            args = (library, unit, chunk_number, tasks_done_queue)
+                            demux_result = demux_pool.apply_async(demux_chunk, args, error_callback=report_error)
+
+                            if debug:
+                                result = demux_result.get()
+                                if not demux_result.successful():
+                                    print(result)
+
+                            demux_results.append(demux_result)
+
+            elif task_type == 'demux':
+                demux_progress.update()
+
+                unit, chunk_number = task_info
+
+                if manifest is not None:
+                    manifest.record_demuxed(unit, chunk_number)
+
+                if (unit, chunk_number) not in resumed:
+                    for which in read_types:
+                        if (unit, which) in semaphores:
+                            semaphores[unit, which].release()
+
+            elif task_type == 'error':
+                error, = task_info
+                raise error
+
+        if not just_chunk:
+            while demux_progress.n < chunk_progress.n:
+                task_type, *task_info = tasks_done_queue.get()
+                if task_type == 'demux':
+                    demux_progress.update()
+
+                    if manifest is not None:
+                        manifest.record_demuxed(*task_info)
+                elif task_type == 'error':
+                    error, = task_info
+                    raise error
+
+        chunk_pool.join()
+        for chunk_result in chunk_results:
+            if not chunk_result.successful():
+                print(chunk_result.get())
+
+        demux_pool.close()
+
+        demux_pool.join()
+        for demux_result in demux_results:
+            if not demux_result.successful():
+                print(demux_result.get())
+
+    chunk_progress.close()
+
+    if not just_chunk:
+        demux_progress.close()
+
+def demux(library,
+          debug=False,
+          reads_per_chunk=int(5e6),
+          just_chunk=False,
+          direct=False,
+          num_processes=None,
+          max_chunks_in_flight=None,
+          restart=False,
+          max_distinct_seqs=None,
+          subsample=None,
+         ):
+    ''' Demultiplexes every unit of library.
+    Progress is recorded in a DemuxManifest, so rerunning an interrupted
+    call resumes from the first unfinished unit of work.
+
+    just_chunk: Only split input files into chunks (don't demux them).
+    direct: Skip writing chunk files and have demux workers read their share
+        of each input file directly, using an index of gzip member offsets.
+        Falls back to chunking if input files aren't split into small enough
+        gzip members (e.g. single-member files).
+    num_processes: total number of worker processes to use. Defaults to a
+        chunker per input file and 4 demuxers per unit.
+    max_chunks_in_flight: if given, limits the number of chunks written but
+        not yet demuxed to bound the amount of scratch space used.
+    restart: Discard progress from any previous run and start over.
+    max_distinct_seqs: if given, bounds the memory used to merge index and
+        barcode statistics by tracking only approximately this many of the
+        most common sequences.
+    subsample: if given, a repair_seq.subsample.Subsample of UMIs to keep.
+        It is recorded in pool sample sheets so that later stages apply
+        the same subsample. Statistics are still counted over all reads.
+    '''
+    library.subsample = subsample
+
+    if debug:
+        reads_per_chunk = int(5e5)
+
+    if restart:
+        remove_demux_progress(library)
+
+    # Checked before prepare so that pool sample sheets aren't rewritten with
+    # settings that don't match a previous run's output.
+    manifest = DemuxManifest(library.manifest_fn, reads_per_chunk, subsample=subsample)
+
+    if manifest.complete:
+        logging.info(f'{library.group} has already been demultiplexed; pass restart to redo it.')
+        return
+
+    library.prepare()
+
+    if not just_chunk:
+        # Build resolvers once up front so that demux workers only need to load them.
+        library.compile_resolvers()
+
+    if direct and not just_chunk:
+        logging.info('Indexing input files...')
+        reads_per_unit = index_input_fastqs(library, reads_per_chunk)
+        if reads_per_unit is None:
+            logging.warning('Input files can\'t be read directly in pieces, falling back to chunking.')
+            direct = False
+
+    # If statistics were merged, every chunk has already been demuxed.
+    if not manifest.merged:
+        if direct and not just_chunk:
+            library.chunks_dir.mkdir(exist_ok=True, parents=True)
+            demux_directly(library, reads_per_unit, reads_per_chunk, debug,
+                           num_processes=num_processes,
+                           manifest=manifest,
+                          )
+        else:
+            chunk_and_demux(library, reads_per_chunk, debug, just_chunk,
+                            num_processes=num_processes,
+                            max_chunks_in_flight=max_chunks_in_flight,
+                            manifest=manifest,
+                           )
+
+    if just_chunk:
+        return
+
+    if not manifest.merged:
+        logging.info('Merging statistics...')
+        merge_statistics(library, max_distinct_seqs)
+        manifest.record_merged()
+
+    library.finish()
+
+    if library.chunks_dir.exists():
+        shutil.rmtree(str(library.chunks_dir))
+
+    manifest.record_complete()
+
+def add_arguments(parser):
+    ''' Adds arguments for options to demux to an argparse parser. '''
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--just_chunk', action='store_true')
+    parser.add_argument('--reads_per_chunk', type=int, default=int(5e6))
+    parser.add_argument('--direct', action='store_true', help='Read input files directly in demux workers instead of writing chunk files.')
+    parser.add_argument('--num_processes', type=int, help='Total number of worker processes.')
+    parser.add_argument('--max_chunks_in_flight', type=int, help='Maximum number of chunks written but not yet demuxed.')
+    parser.add_argument('--restart', action='store_true', help='Discard progress from a previous interrupted run.')
+    parser.add_argument('--max_distinct_seqs', type=int, help='Approximate barcode statistics using at most this many distinct sequences.')
+    parser.add_argument('--subsample', type=float, help='Keep only this fraction of UMIs, chosen by a hash of their sequence.')
+    parser.add_argument('--subsample_seed', type=int, default=0, help='Seed for the hash used by --subsample.')
+
+def options_from_args(args):
+    return dict(
+        debug=args.debug,
+        just_chunk=args.just_chunk,
+        reads_per_chunk=args.reads_per_chunk,
+        direct=args.direct,
+        num_processes=args.num_processes,
+        max_chunks_in_flight=args.max_chunks_in_flight,
+        restart=args.restart,
+        max_distinct_seqs=args.max_distinct_seqs,
+        subsample=None if args.subsample is None else repair_seq.subsample.Subsample(args.subsample, seed=args.subsample_seed),
+    )
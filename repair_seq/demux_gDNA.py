@@ -1,28 +1,27 @@
 import argparse
-import gzip
 import logging
-import multiprocessing
 import itertools
-import shutil
 
 from pathlib import Path
-from collections import defaultdict, Counter
+from collections import defaultdict
 
 import numpy as np
 import pandas as pd
 idx = pd.IndexSlice
-import tqdm
 import yaml
 
 from hits import fastq, utilities
 import knock_knock.target_info
 import repair_seq.guide_library
 import repair_seq.pooled_screen
-import repair_seq.guide_library
 import repair_seq.demux
+import repair_seq.demux_engine
+import repair_seq.resolvers
 
 from repair_seq.annotations import Annotations
 
+memoized_property = utilities.memoized_property
+
 def get_R1_read_length(base_dir, batch, sample_sheet):
     data_dir = Path(base_dir) / 'data' / batch 
 
@@ -61,7 +60,7 @@ def load_pool_details(base_dir, batch):
 
     return pool_details
 
-def make_pool_sample_sheets(base_dir, batch):
+def make_pool_sample_sheets(base_dir, batch, subsample=None):
     sample_sheet = load_sample_sheet(base_dir, batch)
 
     for pool_name, details in sample_sheet['pool_details'].items():
@@ -86,133 +85,20 @@ def make_pool_sample_sheets(base_dir, batch):
 
         pool_sample_sheet['target_info_prefix'] = target_info_prefix
 
+        if 'compression' in sample_sheet:
+            pool_sample_sheet['compression'] = sample_sheet['compression']
+
         pool_sample_sheet.update(details)
 
+        if subsample is not None:
+            pool_sample_sheet['UMI_subsample'] = subsample.to_dict()
+
         full_pool_name = f'{sample_sheet["group_name"]}_{pool_name}'
         pool_sample_sheet_fn = Path(base_dir) / 'results' / full_pool_name / 'sample_sheet.yaml'
         pool_sample_sheet_fn.parent.mkdir(parents=True, exist_ok=True)
         pool_sample_sheet_fn.write_text(yaml.safe_dump(pool_sample_sheet, default_flow_style=False))
 
     return sample_sheet['pool_details']
-
-class FastqChunker:
-    def __init__(self, base_dir, batch, quartet_name, which, reads_per_chunk=None, queue=None, debug=False, from_SRA=False):
-        self.base_dir = Path(base_dir)
-        self.batch = batch
-        self.quartet_name = quartet_name
-        self.which = which
-        self.reads_per_chunk = reads_per_chunk
-        self.queue = queue
-        self.debug = debug
-        
-        if from_SRA:
-            sample_sheet = repair_seq.demux.load_SRA_pool_sample_sheet(self.batch)
-        else:
-            sample_sheet = load_sample_sheet(self.base_dir, self.group)
-
-        quartet = sample_sheet['quartets'][quartet_name]
-        
-        self.fn_name = quartet[self.which]
-        
-        group_dir = self.base_dir / 'data' / self.batch
-        self.input_fn = (group_dir / self.fn_name).with_suffix('.fastq.gz')
-        
-        self.chunks_dir = group_dir / 'gDNA_chunks'
-        self.chunks_dir.mkdir(exist_ok=True)
-        
-        self.current_chunk_number = 0
-        
-        self.current_fh = None
-        
-    def close_current_chunk(self):
-        if self.current_fh is not None:
-            self.current_fh.close()
-            if self.queue is not None:
-                self.queue.put(('chunk', self.quartet_name, self.which, self.current_chunk_number))
-                
-            self.current_chunk_number += 1
-            
-    def get_chunk_fn(self, chunk_number):
-        chunk_string = repair_seq.demux.chunk_number_to_string(chunk_number)
-        next_fn = self.chunks_dir / f'{self.fn_name}_{chunk_string}.fastq.gz'
-        return next_fn
-            
-    def start_next_chunk(self):
-        self.close_current_chunk()
-        
-        chunk_fn = self.get_chunk_fn(self.current_chunk_number)
-        self.current_fh = gzip.open(chunk_fn, 'wt', compresslevel=1)
-        
-    def split_into_chunks(self):
-        line_groups = fastq.get_line_groups(self.input_fn)
-
-        if self.debug:
-            line_groups = itertools.islice(line_groups, int(1e6))
-        
-        for read_number, line_group in enumerate(line_groups):
-            if read_number % self.reads_per_chunk == 0:
-                self.start_next_chunk()
-            
-            for line in line_group:
-                self.current_fh.write(line)
-                
-        self.close_current_chunk()
-        
-        self.queue.put(('chunk', self.quartet_name, self.which, 'DONE'))
-
-class Writers:
-    def __init__(self, base_dir, batch, quartet_name, chunk_number, from_SRA):
-        self.base_dir = Path(base_dir)
-        
-        self.from_SRA = from_SRA
-        if from_SRA:
-            self.batch = batch
-        else:
-            sample_sheet = load_sample_sheet(base_dir, batch)
-            self.batch = sample_sheet['group_name']
-        
-        self.chunk_string = f'{quartet_name}_{repair_seq.demux.chunk_number_to_string(chunk_number)}'
-
-        self.writers = defaultdict(list)
-
-    def __getitem__(self, key):
-        return self.writers[key]
-
-    def write(self):
-        pools = {}
-
-        for sample, fixed_guide, variable_guide in sorted(self.writers):
-            if sample not in pools:
-                if self.from_SRA:
-                    pool_name = self.batch
-                else:
-                    pool_name = f'{self.batch}_{sample}'
-                
-                pool = repair_seq.pooled_screen.PooledScreenNoUMI(self.base_dir, pool_name)
-                pools[sample] = pool
-
-            pool = pools[sample]
-
-            reads = self.writers[sample, fixed_guide, variable_guide]
-            sorted_reads = sorted(reads, key=lambda r: r.name)
-
-            exp = pool.single_guide_experiment(fixed_guide, variable_guide)
-            output_dir = exp.fns['chunks']
-            output_dir.mkdir(exist_ok=True, parents=True)
-            
-            fn = output_dir / f'{self.chunk_string}_R2.fastq.gz'
-            
-            with gzip.open(fn, 'wt', compresslevel=1) as zfh:
-                for read in sorted_reads:
-                    zfh.write(str(read))
-
-            del self.writers[sample, fixed_guide, variable_guide]
-            del sorted_reads
-                
-def split_into_chunks(base_dir, group, quartet_name, which, reads_per_chunk, queue, debug, from_SRA):
-    chunker = FastqChunker(base_dir, group, quartet_name, which, reads_per_chunk, queue, debug, from_SRA)
-    return chunker.split_into_chunks()
-
 def get_resolvers(base_dir, group, from_SRA):
     expected_seqs = {}
     resolvers = {}
@@ -313,10 +199,7 @@ def get_resolvers(base_dir, group, from_SRA):
     else:
         # If there weren't multiple fixed guide pools present, keep everything
         # to allow possibility of outcomes that don't include the intended NotI site.
-        def fixed_guide_barcode_resolver(*args):
-            return {'none'}
-
-        resolvers['fixed_guide_barcode'] = fixed_guide_barcode_resolver
+        resolvers['fixed_guide_barcode'] = repair_seq.resolvers.resolve_to_none
         expected_seqs['fixed_guide_barcode'] = set()
 
         guide_barcode_slice = slice(None)
@@ -327,374 +210,178 @@ def get_resolvers(base_dir, group, from_SRA):
 
     return resolvers, expected_seqs, guide_barcode_slice, after_guide_barcode_slice
 
-def demux_chunk_from_SRA(base_dir, screen_name, quartet_name, chunk_number, queue):
-    resolvers, expected_seqs, guide_barcode_slice, after_guide_barcode_slice = get_resolvers(base_dir, screen_name, from_SRA=True)
+def get_resolvers_fn(base_dir, group):
+    return Path(base_dir) / 'data' / group / 'gDNA_resolvers.pkl'
 
-    Annotation = Annotations['R2_with_guide']
-    
-    fastq_fns = [FastqChunker(base_dir, screen_name, quartet_name, which, from_SRA=True).get_chunk_fn(chunk_number) for which in ['R1', 'R2']]
+def compile_resolvers(base_dir, group, from_SRA):
+    return repair_seq.resolvers.compile_resolvers(get_resolvers_fn(base_dir, group), get_resolvers, base_dir, group, from_SRA)
 
-    writers = Writers(base_dir, screen_name, quartet_name, chunk_number, from_SRA=True)
+def load_resolvers(base_dir, group, from_SRA):
+    return repair_seq.resolvers.load_resolvers(get_resolvers_fn(base_dir, group), get_resolvers, base_dir, group, from_SRA)
 
-    counts = defaultdict(Counter)
+class gDNALibrary(repair_seq.demux_engine.Library):
+    ''' Quartets of reads from genomic DNA amplified from a pooled screen,
+    without UMIs. Samples are identified by the combination of I7 (I1) and I5 (I2)
+    indices, the variable guide by all of R1, and the fixed guide (if any) by a
+    barcode at the start of R2.
+    '''
+    chunks_dir_name = 'gDNA_chunks'
+    manifest_name = 'gDNA_demux_manifest.txt'
 
-    for R1, R2 in fastq.read_pairs(*fastq_fns, up_to_space=True):
-        if R1.name != R2.name:
-            raise ValueError('read pair out of sync')
+    def __init__(self, base_dir, batch, from_SRA=False):
+        super().__init__(base_dir, batch)
+        self.from_SRA = from_SRA
 
-        sample = screen_name
+    @property
+    def pool_class(self):
+        return repair_seq.pooled_screen.PooledScreenNoUMI
 
-        variable_guides = resolvers['variable_guide'](R1.seq, 'unknown')
-        if len(variable_guides) == 1:
-            variable_guide = next(iter(variable_guides))
+    @memoized_property
+    def sample_sheet(self):
+        if self.from_SRA:
+            return repair_seq.demux.load_SRA_pool_sample_sheet(self.group)
         else:
-            variable_guide = 'unknown'
-
-        fixed_guide = 'none'
-
-        counts['fixed_guide_barcode'][''] += 1
-
-        counts['id'][sample, fixed_guide, variable_guide] += 1
-
-        if 'unknown' in {sample, variable_guide}:
-            continue
-
-        query_name = R1.name
-        guide_seq = R1.seq
-        guide_qual = fastq.sanitize_qual(R1.qual)
-
-        annotation = Annotation(query_name=query_name,
-                                guide=guide_seq,
-                                guide_qual=guide_qual,
-                               )
-        R2.name = str(annotation)
-
-        writers[sample, fixed_guide, variable_guide].append(R2[after_guide_barcode_slice])
-
-    writers.write()
+            return load_sample_sheet(self.base_dir, self.group)
 
-    chunk_dir = base_dir / 'data' / screen_name / 'gDNA_chunks'
-    for k, cs in counts.items():
-        cs = pd.Series(cs).sort_values(ascending=False)
-        fn = chunk_dir / f'{k}_{quartet_name}_{repair_seq.demux.chunk_number_to_string(chunk_number)}.txt'
-        cs.to_csv(fn, sep='\t', header=False)
-
-    # Delete the chunk.
-    for fastq_fn in fastq_fns:
-        fastq_fn.unlink()
-
-    queue.put(('demux', quartet_name, chunk_number))
-
-def demux_chunk(base_dir, group, quartet_name, chunk_number, queue):
-    resolvers, expected_seqs, guide_barcode_slice, after_guide_barcode_slice = get_resolvers(base_dir, group)
-    
-    fastq_fns = [FastqChunker(base_dir, group, quartet_name, which).get_chunk_fn(chunk_number) for which in fastq.quartet_order]
-
-    writers = Writers(base_dir, group, quartet_name, chunk_number, from_SRA=False)
+    @property
+    def read_types(self):
+        if self.from_SRA:
+            return ['R1', 'R2']
+        else:
+            return fastq.quartet_order
 
-    counts = defaultdict(Counter)
+    @property
+    def units(self):
+        return sorted(self.sample_sheet['quartets'])
 
-    Annotation = Annotations['R2_with_guide']
+    @property
+    def samples(self):
+        if self.from_SRA:
+            return [self.group]
+        else:
+            return super().samples
 
-    for quartet in fastq.read_quartets(fastq_fns, standardize_names=True):
-        if len({r.name for r in quartet}) != 1:
-            raise ValueError('quartet out of sync')
+    @property
+    def partitioned(self):
+        return not self.from_SRA and self.sample_sheet.get('partitioned_chunks', False)
 
-        I7_samples = resolvers['I7'](quartet.I1.seq, {'unknown'})
-        I5_samples = resolvers['I5'](quartet.I2.seq, {'unknown'})
+    def input_fn_name(self, quartet_name, which):
+        return self.sample_sheet['quartets'][quartet_name][which]
 
-        consistent_with_both = I7_samples & I5_samples
+    def num_reads(self, quartet_name):
+        return self.sample_sheet['quartets'][quartet_name]['num_reads']
 
-        if len(consistent_with_both) == 1:
-            sample = next(iter(consistent_with_both))
+    def get_pool_name(self, sample):
+        if self.from_SRA:
+            pool_name = self.group
         else:
-            sample = 'unknown'
+            pool_name = f'{self.sample_sheet["group_name"]}_{sample}'
 
-        counts['I7'][quartet.I1.seq] += 1
-        counts['I5'][quartet.I2.seq] += 1
+        return pool_name
 
-        # Note: primer for gDNA prep makes R1 read start 1 downstream of UMI prep.
-        variable_guide_seq = quartet.R1.seq
+    def prepare(self):
+        logging.info(f'Demultiplexing {self.group} in {self.base_dir}')
 
-        variable_guides = resolvers['variable_guide'](variable_guide_seq, {'unknown'})
-        if len(variable_guides) == 1:
-            variable_guide = next(iter(variable_guides))
+        if self.from_SRA:
+            repair_seq.demux.write_SRA_pool_sample_sheet(self.base_dir, self.group, subsample=self.subsample)
         else:
-            variable_guide = 'unknown'
-
-        counts['variable_guide'][variable_guide_seq] += 1
-
-        guide_barcode = quartet.R2.seq[guide_barcode_slice]
-        fixed_guides = resolvers['fixed_guide_barcode'](guide_barcode, {'unknown'})
-        if len(fixed_guides) == 1:
-            fixed_guide = next(iter(fixed_guides))
+            make_pool_sample_sheets(self.base_dir, self.group, subsample=self.subsample)
+
+    def get_resolvers_fn(self):
+        return get_resolvers_fn(self.base_dir, self.group)
+
+    def get_resolvers(self):
+        return get_resolvers(self.base_dir, self.group, self.from_SRA)
+
+    @property
+    def stat_keys(self):
+        keys = []
+        if not self.from_SRA:
+            keys.extend(['I5', 'I7', 'variable_guide'])
+            if 'fixed_guide_library' in self.sample_sheet:
+                keys.append('fixed_guide_barcode')
+        return keys
+
+    def read_structure(self):
+        engine = repair_seq.demux_engine
+
+        resolvers, expected_seqs, guide_barcode_slice, after_guide_barcode_slice = self.load_resolvers()
+
+        if self.from_SRA:
+            fields = [
+                engine.ConstantField('sample', self.group),
+                engine.ConstantField('fixed_guide', 'none'),
+                engine.Field('variable_guide', 'R1'),
+            ]
+            read_kwargs = dict(up_to_space=True)
         else:
-            fixed_guide = 'unknown'
-
-        counts['fixed_guide_barcode'][guide_barcode] += 1
-
-        counts['id'][sample, fixed_guide, variable_guide] += 1
-
-        if 'unknown' in {sample, variable_guide}:
-            continue
-
-        query_name = quartet.R1.name
-        guide_seq = quartet.R1.seq
-        guide_qual = fastq.sanitize_qual(quartet.R1.qual)
-
-        annotation = Annotation(query_name=query_name,
-                                guide=guide_seq,
-                                guide_qual=guide_qual,
-                               )
-        quartet.R2.name = str(annotation)
-
-        writers[sample, fixed_guide, variable_guide].append(quartet.R2[after_guide_barcode_slice])
-
-    writers.write()
-
-    chunk_dir = base_dir / 'data' / group / 'gDNA_chunks'
-    for k, cs in counts.items():
-        cs = pd.Series(cs).sort_values(ascending=False)
-        fn = chunk_dir / f'{k}_{quartet_name}_{repair_seq.demux.chunk_number_to_string(chunk_number)}.txt'
-        cs.to_csv(fn, sep='\t', header=False)
-
-    # Delete the chunk.
-    for fastq_fn in fastq_fns:
-        fastq_fn.unlink()
-
-    queue.put(('demux', quartet_name, chunk_number))
-
-def merge_seq_counts(base_dir, group, k, from_SRA):
-    chunk_dir = Path(base_dir) / 'data' / group / 'gDNA_chunks'
-    # Note: glob returns generator, need to make into list
-    # so it can be re-used for cleanup.
-    count_fns = sorted(chunk_dir.glob(f'{k}*.txt'))
-
-    counts = Counter()
-    for fn in count_fns:
-        for line in open(fn):
-            seq, count = line.strip().split()
-            counts[seq] += int(count)
-
-    merged_fn = Path(base_dir) / 'data' / group / f'{k}_stats.txt'
-
-    resolvers, expected_seqs, *_ = get_resolvers(base_dir, group, from_SRA)
-    resolver = resolvers[k]
-    expected_seqs = expected_seqs[k]
-
-    with open(merged_fn, 'w') as fh:
-        total = sum(counts.values())
-
-        for seq, count in counts.most_common(100):
-            name = resolver(seq, '')
-
-            if isinstance(name, set):
-                name = sorted(name)
-
-            if seq in expected_seqs:
-                mismatches = ''
-            elif name != '':
-                mismatches = ' (1 mismatch)'
+            if 'fixed_guide_library' in self.sample_sheet:
+                fixed_guide_count_key = 'fixed_guide_barcode'
             else:
-                mismatches = ''
-
-            fraction = float(count) / total
-
-            fh.write(f'{seq}\t{count: >10,}\t({fraction: >6.2%})\t{name}{mismatches}\n')
-
-    for fn in count_fns:
-        fn.unlink()
-    
-def merge_ids(base_dir, group):
-    chunk_dir = Path(base_dir) / 'data' / group / 'gDNA_chunks'
-    # Note: glob returns generator, need to make into list
-    # so it can be re-used for cleanup.
-    count_fns = sorted(chunk_dir.glob('id*.txt'))
-
-    counts = Counter()
-    for fn in count_fns:
-        for line in open(fn):
-            sample, fixed_guide, variable_guide, count = line.strip().split()
-            counts[sample, fixed_guide, variable_guide] += int(count)
-
-    merged_fn = Path(base_dir) / 'data' / group / 'id_stats.txt'
-
-    counts = pd.Series(counts).sort_index()
-    counts.to_csv(merged_fn, sep='\t', header=False)
-
-    for fn in count_fns:
-        fn.unlink()
-
-def demux_group(base_dir,
-                batch,
-                debug=False,
-                reads_per_chunk=int(5e6),
-                from_SRA=False,
-                just_chunk=False,
-               ):
-
-    logging.info(f'Demultiplexing {batch} in {base_dir}')
-
-    if from_SRA:
-        repair_seq.demux.write_SRA_pool_sample_sheet(base_dir, batch)
-        sample_sheet = repair_seq.demux.load_SRA_pool_sample_sheet(batch)
-        relevant_read_types = ['R1', 'R2']
-        demux_chunk_function = demux_chunk_from_SRA
-    else:
-        make_pool_sample_sheets(base_dir, batch)
-        sample_sheet = load_sample_sheet(base_dir, batch)
-        relevant_read_types = fastq.quartet_order
-        demux_chunk_function = demux_chunk
-
-    quartet_names = sorted(sample_sheet['quartets'])
-
-    if debug:
-        reads_per_chunk = int(5e5)
-
-    chunks_per_quartet = [int(np.ceil(d['num_reads'] / reads_per_chunk)) for q, d in sample_sheet['quartets'].items()]
-    total_chunks = sum(chunks_per_quartet)
-
-    manager = multiprocessing.Manager()
-    tasks_done_queue = manager.Queue()
-    
-    chunks_done = defaultdict(set) 
-    
-    chunk_progress = tqdm.tqdm(desc='Chunk progress', total=total_chunks)
-    demux_progress = tqdm.tqdm(desc='Demux progress', total=total_chunks)
-    
-    chunk_pool = multiprocessing.Pool(processes=4 * len(quartet_names))
-    demux_pool = multiprocessing.Pool(processes=4 * len(quartet_names))
-
-    with chunk_pool, demux_pool:
-        chunk_results = []
-        demux_results = []
-
-        unfinished_chunkers = set()
-        
-        for quartet_name in quartet_names:
-            for which in relevant_read_types:
-                args = (base_dir, batch, quartet_name, which, reads_per_chunk, tasks_done_queue, debug, from_SRA)
-                chunk_result = chunk_pool.apply_async(split_into_chunks, args)
-                if debug:
-                    print(chunk_result.get())
-                chunk_results.append(chunk_result)
-
-                unfinished_chunkers.add((quartet_name, which))
-            
-        chunk_pool.close()
-        
-        while True:
-            task_type, *task_info = tasks_done_queue.get()
-            
-            if task_type == 'chunk':
-                quartet_name, which, chunk_number = task_info
-                
-                if chunk_number == 'DONE':
-                    unfinished_chunkers.remove((quartet_name, which))
-                    if len(unfinished_chunkers) == 0:
-                        break
-                else:
-                    chunks_done[quartet_name, chunk_number].add(which)
-                    if chunks_done[quartet_name, chunk_number] == set(relevant_read_types):
-                        chunk_progress.update()
-                        
-                        if not just_chunk:
-                            args = (base_dir, batch, quartet_name, chunk_number, tasks_done_queue)
-                            demux_result = demux_pool.apply_async(demux_chunk_function, args)
-
-                            if debug:
-                                result = demux_result.get()
-                                if not demux_result.successful():
-                                    print(result)
-
-                            demux_results.append(demux_result)
-
-            elif task_type == 'demux':
-                demux_progress.update()
-
-        if not just_chunk:
-            while demux_progress.n < chunk_progress.n:
-                task_type, *task_info = tasks_done_queue.get()
-                if task_type == 'demux':
-                    demux_progress.update()
-                else:
-                    error, = task_info
-                    raise error
-        
-        chunk_pool.join()
-        for chunk_result in chunk_results:
-            if not chunk_result.successful():
-                print(chunk_result.get())
-                
-        demux_pool.close()
-                
-        demux_pool.join()
-        for demux_result in demux_results:
-            if not demux_result.successful():
-                print(demux_result.get())
-
-    chunk_progress.close()
-
-    if not just_chunk:
-        demux_progress.close()
-
-        logging.info('Merging statistics...')
-
-        merge_pool = multiprocessing.Pool(processes=3)
-        merge_results = []
-
-        if not from_SRA:
-            merge_results.append(merge_pool.apply_async(merge_seq_counts, args=(base_dir, batch, 'I5', from_SRA)))
-            merge_results.append(merge_pool.apply_async(merge_seq_counts, args=(base_dir, batch, 'I7', from_SRA)))
-            merge_results.append(merge_pool.apply_async(merge_seq_counts, args=(base_dir, batch, 'variable_guide', from_SRA)))
-            if 'fixed_guide_library' in sample_sheet:
-                merge_results.append(merge_pool.apply_async(merge_seq_counts, args=(base_dir, batch, 'fixed_guide_barcode', from_SRA)))
-
-        merge_results.append(merge_pool.apply_async(merge_ids, args=(base_dir, batch)))
-
-        merge_pool.close()
-        merge_pool.join()
-
-        for merge_result in merge_results:
-            if not merge_result.successful():
-                print(merge_result.get())
-
-        chunk_dir = base_dir / 'data' / batch / 'gDNA_chunks'
-        shutil.rmtree(str(chunk_dir))
-
-    merged_fn = Path(base_dir) / 'data' / batch / 'id_stats.txt'
-    id_counts = pd.read_csv(merged_fn,
-                            sep='\t',
-                            header=None,
-                            names=['pool', 'fixed_guide', 'variable_guide', 'num_reads'],
-                            index_col=[0, 1, 2],
-                           ).squeeze()
-
-    if not from_SRA:
-        pool_details = make_pool_sample_sheets(base_dir, batch)
-
-        for pool_name in pool_details:
+                fixed_guide_count_key = None
+
+            fields = [
+                engine.ConsistentField('sample', [
+                    engine.Field('I7', 'I1', count_key='I7'),
+                    engine.Field('I5', 'I2', count_key='I5'),
+                ]),
+                engine.Field('fixed_guide', 'R2', guide_barcode_slice, resolver='fixed_guide_barcode', count_key=fixed_guide_count_key),
+                # Note: primer for gDNA prep makes R1 read start 1 downstream of UMI prep.
+                engine.Field('variable_guide', 'R1', count_key='variable_guide'),
+            ]
+            read_kwargs = dict(standardize_names=True)
+
+        return engine.ReadStructure(
+            read_types=self.read_types,
+            fields=fields,
+            key_fields=['sample', 'fixed_guide', 'variable_guide'],
+            required_fields=['sample', 'variable_guide'],
+            output_read_type='R2',
+            output_slice=after_guide_barcode_slice,
+            Annotation=Annotations['R2_with_guide'],
+            annotation_values={
+                'query_name': ('R1', engine.read_name),
+                'guide': ('R1', engine.read_seq),
+                'guide_qual': ('R1', engine.sanitized_qual),
+            },
+            read_kwargs=read_kwargs,
+            # Without UMIs, reads are subsampled individually.
+            subsample_key=('R1', engine.read_name),
+        )
+
+    def finish(self):
+        if self.from_SRA:
+            return
+
+        id_counts = pd.read_csv(self.stats_fn('id'),
+                                sep='\t',
+                                header=None,
+                                names=['pool', 'fixed_guide', 'variable_guide', 'num_reads'],
+                                index_col=[0, 1, 2],
+                               ).squeeze()
+
+        for pool_name in self.sample_sheet['pool_details']:
             if pool_name in id_counts:
-                full_pool_name = f"{sample_sheet['group_name']}_{pool_name}"
-                pool = repair_seq.pooled_screen.PooledScreen(base_dir, full_pool_name)
+                full_pool_name = f"{self.sample_sheet['group_name']}_{pool_name}"
+                pool = repair_seq.pooled_screen.PooledScreen(self.base_dir, full_pool_name)
                 counts = id_counts.loc[pool_name].sort_values(ascending=False)
                 counts.to_csv(pool.fns['read_counts'], sep='\t', header=True)
-    
+
+def demux_group(base_dir, batch, from_SRA=False, **kwargs):
+    ''' See repair_seq.demux_engine.demux for options. '''
+    library = gDNALibrary(base_dir, batch, from_SRA=from_SRA)
+    repair_seq.demux_engine.demux(library, **kwargs)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('base_dir', type=Path, default=Path.home() / 'projects' / 'repair_seq')
     parser.add_argument('batch')
-    parser.add_argument('--debug', action='store_true')
     parser.add_argument('--from_SRA', action='store_true')
-    parser.add_argument('--just_chunk', action='store_true')
-    parser.add_argument('--reads_per_chunk', type=int, default=int(5e6))
+    repair_seq.demux_engine.add_arguments(parser)
 
     args = parser.parse_args()
-    
-    demux_group(args.base_dir,
-                args.batch,
-                debug=args.debug,
+
+    demux_group(args.base_dir, args.batch,
                 from_SRA=args.from_SRA,
-                reads_per_chunk=args.reads_per_chunk,
-                just_chunk=args.just_chunk,
-               )
\ No newline at end of file
+                **repair_seq.demux_engine.options_from_args(args),
+               )
@@ -0,0 +1,288 @@
+# cython: language_level=3
+
+''' Parsing of synchronized fastq files into batches of records that are
+held as offsets into the raw bytes read from each file, so that batches of
+reads can be checked for synchronization and have barcodes extracted without
+creating Python objects for every read.
+'''
+
+import numpy as np
+cimport cython
+from libc.string cimport memchr, memcmp, memcpy
+
+from hits import fastq
+
+cdef Py_ssize_t find_newline(const unsigned char* buf, Py_ssize_t start, Py_ssize_t length):
+    cdef const unsigned char* p
+
+    if start >= length:
+        return -1
+
+    p = <const unsigned char*> memchr(buf + start, b'\n', length - start)
+    if p == NULL:
+        return -1
+    else:
+        return p - buf
+
+cdef Py_ssize_t strip_end(const unsigned char* buf, Py_ssize_t start, Py_ssize_t end):
+    while end > start and (buf[end - 1] == b'\r' or buf[end - 1] == b' ' or buf[end - 1] == b'\t'):
+        end -= 1
+    return end
+
+cdef class FastqColumn:
+    ''' A batch of consecutive records from one fastq file. '''
+    cdef readonly bytes data
+    cdef readonly Py_ssize_t num_records
+    cdef long long[::1] name_starts
+    cdef long long[::1] name_ends
+    cdef long long[::1] seq_starts
+    cdef long long[::1] seq_ends
+    cdef long long[::1] qual_starts
+    cdef long long[::1] qual_ends
+
+    def __init__(self, bytes data, Py_ssize_t num_records, name_starts, name_ends, seq_starts, seq_ends, qual_starts, qual_ends):
+        self.data = data
+        self.num_records = num_records
+        self.name_starts = name_starts
+        self.name_ends = name_ends
+        self.seq_starts = seq_starts
+        self.seq_ends = seq_ends
+        self.qual_starts = qual_starts
+        self.qual_ends = qual_ends
+
+    def __len__(self):
+        return self.num_records
+
+    def __getitem__(self, Py_ssize_t i):
+        ''' Returns record i as a Read. '''
+        if i < 0:
+            i += self.num_records
+        if i < 0 or i >= self.num_records:
+            raise IndexError(i)
+
+        name = self.data[self.name_starts[i]:self.name_ends[i]].decode()
+        seq = self.data[self.seq_starts[i]:self.seq_ends[i]].decode().translate(fastq.period_to_N)
+        qual = self.data[self.qual_starts[i]:self.qual_ends[i]].decode()
+
+        return fastq.Read(name, seq, qual)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def names_match(self, FastqColumn other):
+        ''' Returns the index of the first record whose name differs from the
+        corresponding record in other, or -1 if all names match.
+        '''
+        cdef Py_ssize_t i, length
+        cdef const unsigned char* buf = self.data
+        cdef const unsigned char* other_buf = other.data
+
+        if self.num_records != other.num_records:
+            return min(self.num_records, other.num_records)
+
+        for i in range(self.num_records):
+            length = self.name_ends[i] - self.name_starts[i]
+
+            if length != other.name_ends[i] - other.name_starts[i]:
+                return i
+
+            if memcmp(buf + self.name_starts[i], other_buf + other.name_starts[i], length) != 0:
+                return i
+
+        return -1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def seq_array(self, seq_slice=slice(None)):
+        ''' Returns an (num_records, max length) uint8 array of the ASCII bases
+        in seq_slice of each record's sequence, zero-padded past each
+        record's length, and an array of lengths.
+        Periods are converted to N, as in fastq.reads.
+        '''
+        if seq_slice.step not in (None, 1):
+            raise ValueError('seq_array only supports contiguous slices')
+
+        cdef bint has_start = seq_slice.start is not None
+        cdef bint has_stop = seq_slice.stop is not None
+        cdef Py_ssize_t slice_start = seq_slice.start if has_start else 0
+        cdef Py_ssize_t slice_stop = seq_slice.stop if has_stop else 0
+
+        cdef Py_ssize_t i, j, seq_length, start, stop
+        cdef Py_ssize_t n = self.num_records
+
+        starts = np.zeros(n, dtype=np.int64)
+        lengths = np.zeros(n, dtype=np.int64)
+        cdef long long[::1] starts_view = starts
+        cdef long long[::1] lengths_view = lengths
+
+        for i in range(n):
+            seq_length = self.seq_ends[i] - self.seq_starts[i]
+
+            start = slice_start
+            if start < 0:
+                start = max(start + seq_length, 0)
+            start = min(start, seq_length)
+
+            if has_stop:
+                stop = slice_stop
+                if stop < 0:
+                    stop = max(stop + seq_length, 0)
+                stop = min(stop, seq_length)
+            else:
+                stop = seq_length
+
+            starts_view[i] = self.seq_starts[i] + start
+            lengths_view[i] = max(stop - start, 0)
+
+        width = int(lengths.max()) if n > 0 else 0
+
+        seqs = np.zeros((n, width), dtype=np.uint8)
+        cdef unsigned char[:, ::1] seqs_view = seqs
+        cdef const unsigned char* buf = self.data
+
+        for i in range(n):
+            if lengths_view[i] > 0:
+                memcpy(&seqs_view[i, 0], buf + starts_view[i], lengths_view[i])
+                for j in range(lengths_view[i]):
+                    if seqs_view[i, j] == b'.':
+                        seqs_view[i, j] = b'N'
+
+        return seqs, lengths
+
+cdef class FastqParser:
+    ''' Parses batches of records from a binary file object. '''
+    cdef object fh
+    cdef bytes leftover
+    cdef bint eof
+    cdef bint up_to_space
+    cdef Py_ssize_t block_size
+
+    def __init__(self, fh, up_to_space=False, block_size=1 << 20):
+        self.fh = fh
+        self.leftover = b''
+        self.eof = False
+        self.up_to_space = up_to_space
+        self.block_size = block_size
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def next_column(self, Py_ssize_t max_records):
+        ''' Returns a FastqColumn of up to max_records records. '''
+        chunks = [self.leftover]
+        num_newlines = self.leftover.count(b'\n')
+
+        while num_newlines < 4 * max_records and not self.eof:
+            block = self.fh.read(self.block_size)
+            if len(block) == 0:
+                self.eof = True
+            else:
+                chunks.append(block)
+                num_newlines += block.count(b'\n')
+
+        cdef bytes data = b''.join(chunks)
+
+        if self.eof and len(data) > 0 and not data.endswith(b'\n'):
+            data += b'\n'
+
+        name_starts = np.zeros(max_records, dtype=np.int64)
+        name_ends = np.zeros(max_records, dtype=np.int64)
+        seq_starts = np.zeros(max_records, dtype=np.int64)
+        seq_ends = np.zeros(max_records, dtype=np.int64)
+        qual_starts = np.zeros(max_records, dtype=np.int64)
+        qual_ends = np.zeros(max_records, dtype=np.int64)
+
+        cdef long long[::1] ns = name_starts
+        cdef long long[::1] ne = name_ends
+        cdef long long[::1] ss = seq_starts
+        cdef long long[::1] se = seq_ends
+        cdef long long[::1] qs = qual_starts
+        cdef long long[::1] qe = qual_ends
+
+        cdef const unsigned char* buf = data
+        cdef Py_ssize_t length = len(data)
+        cdef Py_ssize_t position = 0
+        cdef Py_ssize_t n = 0
+        cdef Py_ssize_t name_end, seq_end, plus_end, qual_end, name_start, k
+
+        while n < max_records:
+            name_end = find_newline(buf, position, length)
+            if name_end == -1:
+                break
+            seq_end = find_newline(buf, name_end + 1, length)
+            if seq_end == -1:
+                break
+            plus_end = find_newline(buf, seq_end + 1, length)
+            if plus_end == -1:
+                break
+            qual_end = find_newline(buf, plus_end + 1, length)
+            if qual_end == -1:
+                break
+
+            if buf[position] != b'@':
+                raise ValueError(f'malformed fastq record: {data[position:name_end]}')
+
+            name_start = position
+            while name_start < name_end and buf[name_start] == b'@':
+                name_start += 1
+
+            ns[n] = name_start
+            ne[n] = strip_end(buf, name_start, name_end)
+
+            if self.up_to_space:
+                for k in range(name_start, ne[n]):
+                    if buf[k] == b' ' or buf[k] == b'\t':
+                        ne[n] = k
+                        break
+
+            ss[n] = name_end + 1
+            se[n] = strip_end(buf, name_end + 1, seq_end)
+            qs[n] = plus_end + 1
+            qe[n] = strip_end(buf, plus_end + 1, qual_end)
+
+            position = qual_end + 1
+            n += 1
+
+        self.leftover = data[position:]
+
+        if self.eof and n == 0 and len(self.leftover.strip()) > 0:
+            raise ValueError('fastq file ends with an incomplete record')
+
+        return FastqColumn(data, n, name_starts, name_ends, seq_starts, seq_ends, qual_starts, qual_ends)
+
+class QuartetReader:
+    ''' Iterates over synchronized batches of records from several binary
+    file objects (e.g. R1, R2, I1, I2), yielding a list of FastqColumns
+    per batch. Raises ValueError if files get out of sync or have different
+    numbers of records.
+
+    max_records: if given, stop after this many records.
+    '''
+    def __init__(self, fhs, batch_size, up_to_space=False, max_records=None):
+        self.parsers = [FastqParser(fh, up_to_space=up_to_space) for fh in fhs]
+        self.batch_size = batch_size
+        self.max_records = max_records
+
+    def __iter__(self):
+        remaining = self.max_records
+
+        while remaining is None or remaining > 0:
+            batch_size = self.batch_size if remaining is None else min(self.batch_size, remaining)
+
+            columns = [parser.next_column(batch_size) for parser in self.parsers]
+
+            num_records = {len(column) for column in columns}
+            if len(num_records) != 1:
+                raise ValueError(f'files have different numbers of records: {num_records}')
+
+            num_records = num_records.pop()
+            if num_records == 0:
+                break
+
+            for column in columns[1:]:
+                mismatch = columns[0].names_match(column)
+                if mismatch != -1:
+                    raise ValueError(f'reads out of sync: {columns[0][mismatch].name} {column[mismatch].name}')
+
+            yield columns
+
+            if remaining is not None:
+                remaining -= num_records
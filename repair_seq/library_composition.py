@@ -1,79 +1,260 @@
+import argparse
+import contextlib
 import functools
-from collections import Counter
+import io
+import itertools
+import multiprocessing
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import tqdm
 import yaml
 
 import hits.fastq
+import hits.utilities
 import knock_knock.target_info
+import repair_seq.compression
+import repair_seq.demux_engine
 import repair_seq.guide_library
+import repair_seq.resolvers
+
+try:
+    import repair_seq.fastq_cython as fastq_cython
+except ImportError:
+    fastq_cython = None
+
+guide_count_batch_size = 100000
+
+def load_sample_sheet(base_dir, batch):
+    sample_sheet_fn = Path(base_dir) / 'data' / batch / 'sample_sheet.yaml'
+    sample_sheet = yaml.safe_load(sample_sheet_fn.read_text())
+    return sample_sheet
 
 def get_sample_info(base_dir, batch, sample_name):
     data_dir = Path(base_dir) / 'data' / batch
-    sample_sheet_fn = data_dir / 'sample_sheet.yaml'
-    sample_sheet = yaml.safe_load(sample_sheet_fn.read_text())
+    sample_sheet = load_sample_sheet(base_dir, batch)
     sample_info = sample_sheet['samples'][sample_name]
     sample_info['full_guide_fastq_fn'] = data_dir / sample_info['guide_fastq_fn']
+    sample_info['guide_fastq_index_fn'] = data_dir / 'fastq_indices' / f'{sample_name}_guides.npz'
     sample_info['guide_counts_fn'] = data_dir / f'{sample_name}_guide_counts.csv'
     sample_info['id_stats_fn'] = data_dir / f'{sample_name}_id_stats.txt'
     return sample_info
 
-@functools.lru_cache
+@functools.lru_cache(maxsize=None)
 def load_guide_library(base_dir, name):
     guide_library = repair_seq.guide_library.GuideLibrary(base_dir, name)
     return guide_library
 
-def count_guides(base_dir, batch, sample_name):
+class GuideCounter:
+    ''' Vectorized equivalent of matching reads one at a time: finds the guide
+    primer prefix near the start of each read in a batch and resolves the
+    primer-plus-protospacer window that follows it with a PackedResolver.
+    If one_mismatch is True, windows within one mismatch of a single guide
+    are also counted.
+    '''
+    primer_prefix_length = 6
+
+    def __init__(self, base_dir, batch, sample_name, one_mismatch=False):
+        sample_info = get_sample_info(base_dir, batch, sample_name)
+
+        ti = knock_knock.target_info.TargetInfo(base_dir, sample_info['target_info'],
+                                                sequencing_start_feature_name=sample_info['guide_primer'],
+                                               )
+
+        guide_library = load_guide_library(base_dir, sample_info['guide_library'])
+
+        guide_primer_seq = ti.feature_sequence(ti.target, sample_info['guide_primer'])
+        guide_primer_length = len(guide_primer_seq)
+
+        protospacer_lengths = guide_library.guides_df['protospacer'].str.len()
+        max_protospacer_length = max(protospacer_lengths)
+        self.length_to_examine = guide_primer_length + max_protospacer_length
+
+        prefix = guide_primer_seq[:self.primer_prefix_length]
+        self.prefix = np.frombuffer(prefix.encode(), dtype=np.uint8)
+
+        # The prefix is searched for in the first primer_prefix_length + 4 bases.
+        self.max_start = 4 + self.primer_prefix_length - len(prefix)
+        self.width = self.max_start + self.length_to_examine
+
+        if one_mismatch:
+            guide_seqs = {g: s[:self.length_to_examine] for g, s in guide_library.full_guide_seqs.items()}
+            dictionary = hits.utilities.get_one_mismatch_resolver(guide_seqs)
+        else:
+            dictionary = {s[:self.length_to_examine]: {g} for g, s in guide_library.full_guide_seqs.items()}
+
+        self.resolver = repair_seq.resolvers.PackedResolver(dictionary)
+
+        self.guides = guide_library.guides
+
+    def empty_counts(self):
+        # The final entry counts reads that didn't resolve to a guide.
+        return np.zeros(len(self.resolver.names) + 1, dtype=np.int64)
+
+    def count(self, seq_bytes, lengths, counts):
+        ''' Adds the guides of a batch of reads to counts.
+        seq_bytes: (n, width) uint8 array of the ASCII bases at the start of
+        each read, zero-padded past each read's length.
+        '''
+        if seq_bytes.shape[1] < self.width:
+            padding = np.zeros((seq_bytes.shape[0], self.width - seq_bytes.shape[1]), dtype=np.uint8)
+            seq_bytes = np.hstack([seq_bytes, padding])
+
+        search_region = seq_bytes[:, :self.max_start + len(self.prefix)]
+        windows = np.lib.stride_tricks.sliding_window_view(search_region, len(self.prefix), axis=1)
+        matches = (windows == self.prefix).all(axis=2)
+
+        # Reads without the prefix are examined from their first base.
+        starts = np.where(matches.any(axis=1), matches.argmax(axis=1), 0)
+
+        columns = starts[:, None] + np.arange(self.length_to_examine)
+        guide_seqs = np.take_along_axis(seq_bytes, columns, axis=1)
+        guide_lengths = np.clip(lengths - starts, 0, self.length_to_examine)
+
+        resolved = self.resolver.set_to_name[self.resolver.resolve_sets_array(guide_seqs, guide_lengths)]
+
+        # Shift so that unresolved (-1) lands in the final entry.
+        resolved = np.where(resolved == -1, len(self.resolver.names), resolved)
+        counts += np.bincount(resolved, minlength=len(counts))
+
+    def to_series(self, counts):
+        guide_counts = pd.Series(counts[:-1], index=self.resolver.names)
+        guide_counts = guide_counts.reindex(self.guides).fillna(0).astype(int)
+
+        guide_counts.name = 'read_count'
+        guide_counts.index.name = 'guide'
+
+        return guide_counts
+
+@functools.lru_cache(maxsize=None)
+def load_guide_counter(base_dir, batch, sample_name, one_mismatch):
+    return GuideCounter(base_dir, batch, sample_name, one_mismatch=one_mismatch)
+
+def seq_batches(fh, width, max_records=None, batch_size=guide_count_batch_size):
+    ''' Yields (seq_bytes, lengths) for batches of reads from binary file
+    object fh, where seq_bytes holds the first width bases of each read.
+    '''
+    if fastq_cython is not None:
+        parser = fastq_cython.FastqParser(fh)
+        remaining = max_records
+
+        while remaining is None or remaining > 0:
+            column = parser.next_column(batch_size if remaining is None else min(batch_size, remaining))
+            if len(column) == 0:
+                break
+
+            yield column.seq_array(slice(0, width))
+
+            if remaining is not None:
+                remaining -= len(column)
+
+    else:
+        reads = itertools.islice(hits.fastq.reads(io.TextIOWrapper(fh)), max_records)
+
+        for batch in hits.utilities.chunks(reads, batch_size):
+            seqs = [read.seq[:width] for read in batch]
+            lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+            padded = ''.join(seq.ljust(width, '\0') for seq in seqs).encode()
+            yield np.frombuffer(padded, dtype=np.uint8).reshape(len(seqs), width), lengths
+
+def get_guide_fastq_index(sample_info):
+    return repair_seq.demux_engine.FastqIndex(sample_info['full_guide_fastq_fn'], sample_info['guide_fastq_index_fn'])
+
+def get_shards(base_dir, batch, sample_name, reads_per_shard):
+    ''' Returns (start, num_reads) pieces of a sample's guide fastq that can be
+    counted independently. Files that can't be split into pieces of about
+    reads_per_shard reads (uncompressed, or gzipped as one large member) are
+    returned as a single (None, None) piece.
+    '''
     sample_info = get_sample_info(base_dir, batch, sample_name)
 
-    ti = knock_knock.target_info.TargetInfo(base_dir, sample_info['target_info'],
-                                            sequencing_start_feature_name=sample_info['guide_primer'],
-                                           )
+    if sample_info['full_guide_fastq_fn'].suffix != '.gz':
+        return sample_name, [(None, None)]
 
-    guide_library = load_guide_library(base_dir, sample_info['guide_library'])
+    index = get_guide_fastq_index(sample_info)
+    if not index.is_current:
+        index.build()
 
-    guide_primer_seq = ti.feature_sequence(ti.target, sample_info['guide_primer'])
-    guide_primer_length = len(guide_primer_seq)
+    if index.max_reads_per_member > reads_per_shard:
+        return sample_name, [(None, None)]
 
-    protospacer_lengths = guide_library.guides_df['protospacer'].str.len()
-    max_protospacer_length = max(protospacer_lengths)
-    length_to_examine = guide_primer_length + max_protospacer_length
+    shards = [(start, reads_per_shard) for start in range(0, index.num_reads, reads_per_shard)]
 
-    guide_seq_resolver = {s[:length_to_examine]: g for g, s in guide_library.full_guide_seqs.items()}.get
+    return sample_name, shards
 
-    primer_prefix_length = 6
-    prefix = guide_primer_seq[:primer_prefix_length]
+def count_shard(base_dir, batch, sample_name, start, num_reads, one_mismatch):
+    sample_info = get_sample_info(base_dir, batch, sample_name)
+    counter = load_guide_counter(base_dir, batch, sample_name, one_mismatch)
 
-    guide_counts = Counter()
+    counts = counter.empty_counts()
 
-    fastq_fn = sample_info['full_guide_fastq_fn']
+    with contextlib.ExitStack() as stack:
+        if start is None:
+            fh = stack.enter_context(repair_seq.compression.open_file(sample_info['full_guide_fastq_fn'], 'rb'))
+        else:
+            fh = stack.enter_context(get_guide_fastq_index(sample_info).open_binary(start))
 
-    total = sample_info.get('num_reads')
-    for read in tqdm.tqdm(hits.fastq.reads(fastq_fn), total=total):
-        try:
-            start = read.seq.index(prefix, 0, primer_prefix_length + 4)
-        except:
-            start = 0
+        for seq_bytes, lengths in seq_batches(fh, counter.width, max_records=num_reads):
+            counter.count(seq_bytes, lengths, counts)
 
-        trimmed = read[start:]
+    return sample_name, counts
 
-        guide_seq = trimmed.seq[:length_to_examine]
+def count_samples_guides(base_dir, batch, sample_names, num_processes=None, reads_per_shard=int(1e6), one_mismatch=False):
+    ''' Counts guides in all of sample_names at once, with every sample's guide
+    fastq split into shards that are counted in parallel.
+    Writes and returns the counts of each sample.
+    '''
+    if num_processes is None:
+        num_processes = min(multiprocessing.cpu_count(), 16)
 
-        guide = guide_seq_resolver(guide_seq, 'unknown')
+    with multiprocessing.Pool(processes=num_processes) as pool:
+        shards = dict(pool.starmap(get_shards, [(base_dir, batch, sample_name, reads_per_shard) for sample_name in sample_names]))
 
-        guide_counts[guide] += 1
+        args_list = [(base_dir, batch, sample_name, start, num_reads, one_mismatch)
+                     for sample_name in sample_names
+                     for start, num_reads in shards[sample_name]
+                    ]
 
-    guide_counts = pd.Series(guide_counts).reindex(guide_library.guides).fillna(0).astype(int)
+        counts = {}
 
-    guide_counts.name = 'read_count'
-    guide_counts.index.name = 'guide'
-    
-    csv_fn = sample_info['guide_counts_fn']
-    guide_counts.to_csv(csv_fn)
+        for sample_name, shard_counts in tqdm.tqdm(pool.imap_unordered(count_shard_star, args_list), total=len(args_list)):
+            if sample_name not in counts:
+                counts[sample_name] = shard_counts
+            else:
+                counts[sample_name] += shard_counts
 
-    return guide_counts
+    all_guide_counts = {}
+
+    for sample_name in sample_names:
+        sample_info = get_sample_info(base_dir, batch, sample_name)
+        counter = load_guide_counter(base_dir, batch, sample_name, one_mismatch)
+
+        guide_counts = counter.to_series(counts[sample_name])
+        guide_counts.to_csv(sample_info['guide_counts_fn'])
+
+        all_guide_counts[sample_name] = guide_counts
+
+    return all_guide_counts
+
+def count_shard_star(args):
+    return count_shard(*args)
+
+def count_guides(base_dir, batch, sample_name, num_processes=None, reads_per_shard=int(1e6), one_mismatch=False):
+    all_guide_counts = count_samples_guides(base_dir, batch, [sample_name],
+                                            num_processes=num_processes,
+                                            reads_per_shard=reads_per_shard,
+                                            one_mismatch=one_mismatch,
+                                           )
+    return all_guide_counts[sample_name]
+
+def count_batch_guides(base_dir, batch, num_processes=None, reads_per_shard=int(1e6), one_mismatch=False):
+    sample_names = list(load_sample_sheet(base_dir, batch)['samples'])
+    return count_samples_guides(base_dir, batch, sample_names,
+                                num_processes=num_processes,
+                                reads_per_shard=reads_per_shard,
+                                one_mismatch=one_mismatch,
+                               )
 
 def load_guide_counts(base_dir, batch, sample_name):
     sample_info = get_sample_info(base_dir, batch, sample_name)
@@ -98,9 +279,7 @@ def load_batch_guide_counts(base_dir, batch):
         guide_counts = pd.concat({bn: load_batch_guide_counts(base_dir, bn) for bn in batch}, axis=1)
         guide_counts = guide_counts.groupby(axis=1, level=1).sum()
     else:
-        data_dir = Path(base_dir) / 'data' / batch
-        sample_sheet_fn = data_dir / 'sample_sheet.yaml'
-        sample_sheet = yaml.safe_load(sample_sheet_fn.read_text())
+        sample_sheet = load_sample_sheet(base_dir, batch)
 
         all_counts = {}
         for sample_name in sample_sheet['samples']:
@@ -113,3 +292,21 @@ def load_batch_guide_counts(base_dir, batch):
         guide_counts = pd.DataFrame(all_counts)
 
     return guide_counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base_dir', type=Path)
+    parser.add_argument('batch')
+    parser.add_argument('--sample_name', help='count only this sample instead of every sample in the batch')
+    parser.add_argument('--num_processes', type=int)
+    parser.add_argument('--reads_per_shard', type=int, default=int(1e6))
+    parser.add_argument('--one_mismatch', action='store_true', help='also count reads within one mismatch of a single guide')
+
+    args = parser.parse_args()
+
+    kwargs = dict(num_processes=args.num_processes, reads_per_shard=args.reads_per_shard, one_mismatch=args.one_mismatch)
+
+    if args.sample_name is not None:
+        count_guides(args.base_dir, args.batch, args.sample_name, **kwargs)
+    else:
+        count_batch_guides(args.base_dir, args.batch, **kwargs)
@@ -0,0 +1,243 @@
+''' An on-disk map from read names to a small set of values (e.g. the common
+sequence name of every read that has a common sequence), stored as numpy
+arrays that are memory-mapped rather than loaded into a dictionary.
+
+A directory holds:
+    names.npy - fixed-width bytes names, sorted, for binary search
+    value_ids.npy - for each sorted name, an index into values
+    values.npy - the distinct values
+    read_order_value_ids.npy - for every read given to the writer, in the
+        order given, an index into values or -1 if the read had none
+
+Lookups touch O(log n) pages of names.npy, and read_order_value_ids.npy lets
+a pass over reads in their original order avoid lookups entirely.
+'''
+
+import array
+import shutil
+import tempfile
+
+from pathlib import Path
+
+import numpy as np
+
+from hits import utilities
+
+memoized_property = utilities.memoized_property
+
+fn_names = ['names', 'value_ids', 'values', 'read_order_value_ids']
+
+def fns(index_dir):
+    return {name: Path(index_dir) / f'{name}.npy' for name in fn_names}
+
+def bytes_array(strings):
+    # Avoids numpy's default of a zero-width dtype for an empty array.
+    width = max((len(s) for s in strings), default=1)
+    return np.array(strings, dtype=f'S{width}')
+
+def save(index_dir, names, value_ids, values, read_order_value_ids):
+    index_dir = Path(index_dir)
+
+    if index_dir.exists():
+        shutil.rmtree(str(index_dir))
+
+    index_dir.mkdir(parents=True)
+
+    order = np.argsort(names, kind='stable')
+
+    index_fns = fns(index_dir)
+    np.save(index_fns['names'], names[order])
+    np.save(index_fns['value_ids'], np.asarray(value_ids, dtype=np.int32)[order])
+    np.save(index_fns['values'], values)
+    np.save(index_fns['read_order_value_ids'], np.asarray(read_order_value_ids, dtype=np.int32))
+
+def concatenate(index_dirs, merged_dir):
+    ''' Combines indices written for consecutive runs of reads into a single
+    index, with read order following the order of index_dirs.
+    '''
+    value_to_id = {}
+
+    names = []
+    value_ids = []
+    read_order_value_ids = []
+
+    for index_dir in index_dirs:
+        index = NameIndex(index_dir)
+
+        # The extra trailing entry maps -1 to itself.
+        new_ids = [value_to_id.setdefault(value, len(value_to_id)) for value in index.values]
+        new_ids = np.array(new_ids + [-1], dtype=np.int32)
+
+        names.append(np.asarray(index.names))
+        value_ids.append(new_ids[index.value_ids])
+        read_order_value_ids.append(new_ids[index.read_order_value_ids])
+
+    values = bytes_array([value.encode() for value in value_to_id])
+
+    if len(names) > 0:
+        names = np.concatenate(names)
+        value_ids = np.concatenate(value_ids)
+        read_order_value_ids = np.concatenate(read_order_value_ids)
+    else:
+        names = bytes_array([])
+
+    save(merged_dir, names, value_ids, values, read_order_value_ids)
+
+class NameIndexWriter:
+    ''' Call add(name, value) for every read in order, with value None for reads
+    without a value, then close() (or use as a context manager).
+
+    Names are held as Python bytes only batch_size at a time. Each full batch
+    is written to a temporary file as a fixed-width array, and the batches are
+    concatenated and sorted in close().
+    '''
+    def __init__(self, index_dir, batch_size=1000000):
+        self.index_dir = Path(index_dir)
+        self.batch_size = batch_size
+
+        self.names = []
+        self.value_ids = array.array('i')
+        self.read_order_value_ids = array.array('i')
+
+        self.value_to_id = {}
+
+        self.batch_dir = None
+        self.batch_fns = []
+
+    def add(self, name, value):
+        if value is None:
+            self.read_order_value_ids.append(-1)
+        else:
+            value_id = self.value_to_id.setdefault(value, len(self.value_to_id))
+            self.names.append(name.encode())
+            self.value_ids.append(value_id)
+            self.read_order_value_ids.append(value_id)
+
+            if len(self.names) >= self.batch_size:
+                self.write_batch()
+
+    def write_batch(self):
+        if self.batch_dir is None:
+            self.batch_dir = Path(tempfile.mkdtemp(prefix='name_index_'))
+
+        batch_fn = self.batch_dir / f'{len(self.batch_fns)}.npy'
+        np.save(batch_fn, bytes_array(self.names))
+        self.batch_fns.append(batch_fn)
+
+        self.names = []
+
+    def remove_batches(self):
+        if self.batch_dir is not None:
+            shutil.rmtree(str(self.batch_dir))
+            self.batch_dir = None
+            self.batch_fns = []
+
+    def close(self):
+        try:
+            # Concatenating arrays of different widths pads to the widest.
+            names = np.concatenate([np.load(fn) for fn in self.batch_fns] + [bytes_array(self.names)])
+
+            save(self.index_dir,
+                 names,
+                 self.value_ids,
+                 bytes_array([value.encode() for value in self.value_to_id]),
+                 self.read_order_value_ids,
+                )
+        finally:
+            self.remove_batches()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.remove_batches()
+
+class NameIndex:
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        self.fns = fns(self.index_dir)
+
+    def exists(self):
+        return all(self.fns[name].exists() for name in ['names', 'value_ids', 'values'])
+
+    def has_read_order(self):
+        return self.fns['read_order_value_ids'].exists()
+
+    @memoized_property
+    def names(self):
+        return np.load(self.fns['names'], mmap_mode='r')
+
+    @memoized_property
+    def value_ids(self):
+        return np.load(self.fns['value_ids'], mmap_mode='r')
+
+    @memoized_property
+    def values(self):
+        return [value.decode() for value in np.load(self.fns['values'])]
+
+    @memoized_property
+    def read_order_value_ids(self):
+        return np.load(self.fns['read_order_value_ids'], mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name, default=None):
+        key = name.encode()
+
+        if len(key) > self.names.dtype.itemsize:
+            # Longer than every indexed name, and would be truncated by searchsorted.
+            return default
+
+        i = np.searchsorted(self.names, key)
+
+        if i < len(self.names) and self.names[i] == key:
+            value = self.values[self.value_ids[i]]
+        else:
+            value = default
+
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+
+        return value
+
+    def values_in_read_order(self, chunk_size=1000000):
+        ''' Yields the value (or None) of every read given to the writer, in order. '''
+        if not self.has_read_order():
+            raise ValueError(f'{self.index_dir} has no read order')
+
+        values = self.values
+        for start in range(0, len(self.read_order_value_ids), chunk_size):
+            for value_id in self.read_order_value_ids[start:start + chunk_size].tolist():
+                yield values[value_id] if value_id != -1 else None
+
+    def items(self):
+        values = self.values
+        for name, value_id in zip(self.names, self.value_ids):
+            yield name.decode(), values[value_id]
+
+    @classmethod
+    def from_text(cls, text_fn, index_dir):
+        ''' Builds an index from a tab-separated file of (name, value) lines,
+        the format previously used for qname_to_common_name. Reads without a
+        value aren't in the file, so the index has no read order.
+        '''
+        with NameIndexWriter(index_dir) as writer, open(text_fn) as fh:
+            for line in fh:
+                name, value = line.rstrip('\n').split('\t')
+                writer.add(name, value)
+
+        index = cls(index_dir)
+        index.fns['read_order_value_ids'].unlink()
+
+        return index
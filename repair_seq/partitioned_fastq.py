@@ -0,0 +1,117 @@
+''' A single file holding many independently readable fastq partitions.
+
+Each partition is a complete gzip member containing the reads for one key.
+Partitions are written back to back and are followed by a footer:
+
+    JSON offset table | 8-byte little-endian length of the table | MAGIC
+
+Readers load the footer, then seek straight to the byte range of the
+partition they need. Because of the footer, a container is not a valid
+gzip file as a whole and must only be read through PartitionedFastq.
+'''
+
+import gzip
+import io
+import json
+import os
+import struct
+
+from pathlib import Path
+
+from hits import fastq, utilities
+
+import repair_seq.compression
+
+MAGIC = b'RSPFQv01'
+footer_struct = struct.Struct('<Q')
+
+def write(fn, partitions, compresslevel=1):
+    ''' partitions: iterable of (key, reads) pairs. Partitions are written in
+    the order given, and reads within a partition in the order given.
+    Writes to a temporary file and renames so that a partially written
+    container is never visible to readers.
+    '''
+    fn = Path(fn)
+    temp_fn = fn.with_name(f'{fn.name}.{os.getpid()}.tmp')
+
+    offsets = {}
+
+    with open(temp_fn, 'wb') as fh:
+        for key, reads in partitions:
+            if key in offsets:
+                raise ValueError(f'duplicate partition key: {key}')
+
+            num_reads = 0
+            text = []
+            for read in reads:
+                text.append(str(read))
+                num_reads += 1
+
+            data = gzip.compress(''.join(text).encode(), compresslevel=compresslevel)
+
+            offsets[key] = (fh.tell(), len(data), num_reads)
+            fh.write(data)
+
+        table = json.dumps(offsets).encode()
+        fh.write(table)
+        fh.write(footer_struct.pack(len(table)))
+        fh.write(MAGIC)
+
+    temp_fn.rename(fn)
+
+class PartitionedFastq:
+    def __init__(self, fn):
+        self.fn = Path(fn)
+
+    @utilities.memoized_property
+    def offsets(self):
+        footer_length = footer_struct.size + len(MAGIC)
+
+        with open(self.fn, 'rb') as fh:
+            fh.seek(-footer_length, os.SEEK_END)
+            footer = fh.read(footer_length)
+
+            if footer[-len(MAGIC):] != MAGIC:
+                raise ValueError(f'{self.fn} is not a partitioned fastq file')
+
+            table_length, = footer_struct.unpack(footer[:footer_struct.size])
+
+            fh.seek(-(footer_length + table_length), os.SEEK_END)
+            table = json.loads(fh.read(table_length))
+
+        return {key: tuple(values) for key, values in table.items()}
+
+    @property
+    def keys(self):
+        return list(self.offsets)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def num_reads(self, key):
+        return self.offsets[key][2]
+
+    def partition_data(self, key):
+        ''' Returns the compressed bytes of partition key. Reading these into
+        memory means no file handle is held open while iterating, which lets
+        callers merge many containers at once.
+        '''
+        offset, length, num_reads = self.offsets[key]
+
+        with open(self.fn, 'rb') as fh:
+            fh.seek(offset)
+            data = fh.read(length)
+
+        return data
+
+    def reads(self, key, **kwargs):
+        ''' Yields the Reads in partition key. '''
+        lines = io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(self.partition_data(key))))
+        return fastq.reads(lines, **kwargs)
+
+    def records(self, key):
+        ''' Yields (name, record) pairs of bytes for the reads in partition key,
+        as in repair_seq.compression.iter_records.
+        '''
+        fh = gzip.GzipFile(fileobj=io.BytesIO(self.partition_data(key)))
+        return repair_seq.compression.iter_records(fh)
@@ -4,7 +4,6 @@ if 'inline' not in matplotlib.get_backend():
 
 import copy
 import datetime
-import gzip
 import heapq
 import itertools
 import logging
@@ -15,6 +14,7 @@ import time
 import warnings
 
 from collections import Counter, defaultdict
+from contextlib import ExitStack
 from pathlib import Path
 
 import h5py
@@ -32,11 +32,16 @@ from knock_knock import prime_editing_layout
 from knock_knock import twin_prime_layout
 
 from . import annotations
+from . import categorization_cache
 from . import coherence
 from . import collapse
+from . import compression
 from . import guide_library
+from . import name_index
+from . import partitioned_fastq
 from . import pooled_layout
 from . import statistics
+from . import subsample
 
 memoized_property = utilities.memoized_property
 memoized_with_args = utilities.memoized_with_args
@@ -70,7 +75,13 @@ class SingleGuideExperiment(experiment.Experiment):
             'guide_mismatch_rates': self.results_dir / 'guide_mismatch_rates.txt',
             'truncation_positions': self.results_dir / 'truncation_positions.txt',
 
-            'qname_to_common_name': self.results_dir / 'qname_to_common_name.txt',
+            'qname_to_common_name': self.results_dir / 'qname_to_common_name',
+            # Written by older versions, and converted on first use.
+            'qname_to_common_name_text': self.results_dir / 'qname_to_common_name.txt',
+            'common_sequence_counts': self.results_dir / 'common_sequence_counts.txt',
+            'qname_to_cached_sequence': self.results_dir / 'qname_to_cached_sequence',
+
+            'shards_dir': self.results_dir / 'shards',
 
             'genomic_insertion_seqs': self.results_dir / 'genomic_insertion_seqs.fa',
             'filtered_genomic_insertion_seqs': self.results_dir / 'filtered_genomic_insertion_seqs.fa',
@@ -104,6 +115,7 @@ class SingleGuideExperiment(experiment.Experiment):
         self.read_types = [
             'collapsed_R2',
             'collapsed_uncommon_R2',
+            'collapsed_cached_R2',
             'low_quality_R2',
         ]
 
@@ -162,17 +174,44 @@ class SingleGuideExperiment(experiment.Experiment):
         return ti
 
     @property
-    def reads(self):
+    def merged_records(self):
+        ''' (name, record) pairs of bytes for the reads in every chunk, merged
+        into name order. Names are compared as raw bytes without making Reads.
+        '''
         # To merge many chunks, need to raise limit on open files.
         soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
         resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
 
         chunks_dir = self.fns['chunks']
-        chunk_fns = sorted(chunks_dir.glob(f'*R2.fastq.gz'))
-        chunks = [fastq.reads(fn, up_to_space=True) for fn in chunk_fns]
-        merged_reads = heapq.merge(*chunks, key=lambda r: r.name)
+        chunk_fns = sorted(chunks_dir.glob(f'*R2.fastq*'))
+        chunks = [compression.records(fn) for fn in chunk_fns]
+
+        # Demux may instead have written this experiment's reads into
+        # pool-level partitioned containers.
+        chunks.extend(container.records(self.sample_name) for container in self.partitioned_chunks)
+
+        # Chunks are sorted by name, and tuples compare by name first.
+        return heapq.merge(*chunks)
 
-        return self.progress(merged_reads)
+    @property
+    def reads(self):
+        reads = (compression.record_to_read(record) for name, record in self.merged_records)
+        return self.progress(reads)
+
+    @memoized_property
+    def partitioned_chunks(self):
+        return [container for container in self.pool.read_chunk_containers if self.sample_name in container]
+
+    @property
+    def has_unprocessed_chunks(self):
+        return self.fns['chunks'].exists() or len(self.partitioned_chunks) > 0
+
+    def remove_chunks(self):
+        ''' Partitioned containers are shared by all experiments in the pool
+        and are removed by the pool once every experiment has been preprocessed.
+        '''
+        if self.fns['chunks'].exists():
+            shutil.rmtree(str(self.fns['chunks']))
 
     def get_read_alignments(self, read_id, fn_key='bam_by_name', outcome=None, read_type=None):
         # Note: read_type is ignored but needed for function signature.
@@ -184,8 +223,10 @@ class SingleGuideExperiment(experiment.Experiment):
             common_name = self.qname_to_common_name.get(read_id)
 
             if common_name is not None:
-                als = self.common_sequence_experiment.get_read_alignments(common_name)
+                als = self.common_sequence_alignments(common_name)
                 looked_up_common = True
+            elif read_id in self.qname_to_cached_sequence:
+                read_type = 'collapsed_cached_R2'
         else:
             read_type = 'collapsed_R2'
             
@@ -200,7 +241,15 @@ class SingleGuideExperiment(experiment.Experiment):
 
     def preprocess(self):
         self.collapse_UMI_reads()
-        self.extract_and_process_common_sequences()
+        self.process_or_count_common_sequences()
+
+    def process_or_count_common_sequences(self):
+        if self.pool.shares_common_sequences:
+            # The pool aligns and categorizes common sequences from all
+            # experiments together once every experiment has counted its own.
+            self.count_common_sequences()
+        else:
+            self.extract_and_process_common_sequences()
 
     def collapse_UMI_reads(self):
         ''' Takes R2_fn sorted by UMI and collapses reads with the same UMI and
@@ -208,11 +257,14 @@ class SingleGuideExperiment(experiment.Experiment):
         '''
         # Since chunks are deleted after being processed, if they aren't there, assume processing has
         # already been done.
-        if not self.fns['chunks'].exists():
+        if not self.has_unprocessed_chunks:
             return
 
-        def UMI_key(read):
-            return annotations.Annotations['UMI_guide'].from_identifier(read.name)['UMI']
+        def UMI_key(name_and_record):
+            # UMI_guide names start with the UMI, so the UMI can be read off
+            # of the raw name without parsing the whole annotation.
+            # Since chunks are sorted by name, reads sharing a UMI are consecutive.
+            return name_and_record[0].partition(b'_')[0]
 
         def num_reads_key(read):
             return annotations.Annotations['collapsed_UMI'].from_identifier(read.name)['num_reads']
@@ -228,9 +280,18 @@ class SingleGuideExperiment(experiment.Experiment):
 
         UMIs_seen = defaultdict(list)
 
-        with gzip.open(collapsed_fn, 'wt', compresslevel=1) as collapsed_fh:
-            groups = utilities.group_by(self.reads, UMI_key)
-            for UMI, UMI_group in groups:
+        with compression.open_for_stage(collapsed_fn, 'wt', self.pool.sample_sheet, 'collapsed_R2') as collapsed_fh:
+            groups = itertools.groupby(self.progress(self.merged_records), UMI_key)
+            for UMI, UMI_records in groups:
+                UMI = UMI.decode()
+
+                # Applies a subsample chosen after demux. If demux already
+                # applied it, every UMI passes.
+                if self.pool.UMI_subsample is not None and UMI not in self.pool.UMI_subsample:
+                    continue
+
+                UMI_group = [compression.record_to_read(record) for name, record in UMI_records]
+
                 clusters = collapse.form_clusters(UMI_group, max_read_length=None, max_hq_mismatches=0)
                 clusters = sorted(clusters, key=num_reads_key, reverse=True)
 
@@ -278,11 +339,12 @@ class SingleGuideExperiment(experiment.Experiment):
                 fh.write(f'{UMI}\t{cluster_sizes}\n')
 
         # To minimize resouce usage, delete chunks after merging them.
-        shutil.rmtree(str(self.fns['chunks']))
+        self.remove_chunks()
 
     def collapsed_reads(self, no_progress=False):
         fn = self.fns_by_read_type['fastq']['collapsed_R2']
-        reads = fastq.reads(fn)
+        threads = compression.get_settings(self.pool.sample_sheet, 'collapsed_R2')['threads']
+        reads = compression.reads(fn, threads=threads)
         if no_progress:
             return reads
         else:
@@ -296,26 +358,121 @@ class SingleGuideExperiment(experiment.Experiment):
     def extract_and_process_common_sequences(self):
         seq_counts = Counter(read.seq for read in self.collapsed_reads())
 
-        # Include one value outside of the solexa range to allow automatic detection.
-        qual = fastq.encode_sanger([25] + [40] * 1000)
-   
-        Annotation = annotations.Annotations['common_sequence']
-
         cs_exp = self.common_sequence_experiment
         cs_exp.results_dir.mkdir(exist_ok=True)
-        fn = cs_exp.fns_by_read_type['fastq']['collapsed_R2']
 
-        with gzip.open(fn, 'wt', compresslevel=1) as fh:
-            for rank, (seq, count) in enumerate(seq_counts.most_common()):
-                if count > 1:
-                    name = str(Annotation(rank=rank, count=count))
-                    read = fastq.Read(name, seq, qual[:len(seq)])
-                    fh.write(str(read))
+        ranked = [(seq, count) for seq, count in seq_counts.most_common() if count > 1]
+
+        # Sequences with cached outcomes are looked up later instead.
+        cached = self.cached_sequences(seq for seq, count in ranked)
+        ranked = [(seq, count) for seq, count in ranked if seq not in cached]
+
+        write_common_sequences(cs_exp, ranked)
 
         cs_exp.process()
 
+    def count_common_sequences(self):
+        ''' Records sequences that appear more than once among collapsed reads
+        for the pool to combine into its shared store.
+        '''
+        seq_counts = Counter(read.seq for read in self.collapsed_reads())
+
+        with open(self.fns['common_sequence_counts'], 'w') as fh:
+            for seq, count in seq_counts.most_common():
+                if count > 1:
+                    fh.write(f'{seq}\t{count}\n')
+
+    @property
+    def common_sequence_counts(self):
+        with open(self.fns['common_sequence_counts']) as fh:
+            for line in fh:
+                seq, count = line.rstrip('\n').split('\t')
+                yield seq, int(count)
+
+    @memoized_property
+    def categorization_cache_context(self):
+        return categorization_cache.context(self.target_info,
+                                            self.categorizer,
+                                            self.layout_mode,
+                                            self.pool.has_UMIs,
+                                            self.supplemental_index_names,
+                                           )
+
+    @memoized_property
+    def categorization_cache(self):
+        if self.pool.categorization_cache_fn is None:
+            return None
+
+        if self.pool.shares_common_sequences:
+            # Categorization is then assumed not to depend on the variable guide,
+            # so every experiment uses the context of the common sequence store.
+            context = self.pool.categorization_cache_context
+        else:
+            context = self.categorization_cache_context
+
+        return categorization_cache.CategorizationCache(self.pool.categorization_cache_fn, context)
+
+    def cached_sequences(self, seqs):
+        if self.categorization_cache is None:
+            return set()
+        else:
+            return self.categorization_cache.contains(seqs)
+
+    def cached_entries_in_read_order(self, chunk_size=10000):
+        ''' Yields the categorization cache entry of every read that was left out
+        of alignment because its sequence was in the cache, or None for other
+        reads, in the order of collapsed reads. Entries are looked up a chunk
+        of reads at a time.
+        '''
+        if self.categorization_cache is None and len(self.qname_to_cached_sequence) > 0:
+            raise ValueError(f'{self.sample_name}: reads were left out of alignment for a categorization cache that is no longer enabled; re-run align')
+
+        cached_seqs = self.qname_to_cached_sequence.values_in_read_order()
+
+        while True:
+            chunk = list(itertools.islice(cached_seqs, chunk_size))
+            if len(chunk) == 0:
+                break
+
+            seqs = {seq for seq in chunk if seq is not None}
+            if len(seqs) > 0:
+                seq_to_entry = self.categorization_cache.lookup(seqs)
+            else:
+                seq_to_entry = {}
+
+            for seq in chunk:
+                if seq is None:
+                    yield None
+                elif seq not in seq_to_entry:
+                    raise ValueError(f'{self.sample_name}: sequence is no longer in categorization cache {self.categorization_cache.fn}')
+                else:
+                    yield seq_to_entry[seq]
+
+    @memoized_property
+    def qname_to_cached_sequence(self):
+        ''' Memory-mapped index from qname to sequence, for reads that were left
+        out of alignment because their sequences were in the categorization cache.
+        '''
+        return name_index.NameIndex(self.fns['qname_to_cached_sequence'])
+
+    def store_in_categorization_cache(self, to_cache, bam_read_type):
+        header = sam.get_header(self.fns_by_read_type['bam_by_name'][bam_read_type])
+        entries = ((seq, *entry) for seq, entry in to_cache.items())
+        self.categorization_cache.store(entries, header)
+
+    def common_sequence_alignments(self, common_name):
+        if self.pool.shares_common_sequences:
+            cs_exp = self.pool.common_sequence_chunk_exp_for_name(common_name)
+        else:
+            cs_exp = self.common_sequence_experiment
+
+        return cs_exp.get_read_alignments(common_name)
+
     @memoized_property
     def common_sequence_outcomes(self):
+        if self.pool.shares_common_sequences:
+            return self.pool.common_sequence_outcomes
+
         outcomes = []
         for outcome in self.common_sequence_experiment.outcome_iter():
             outcomes.append(outcome)
@@ -364,8 +521,13 @@ class SingleGuideExperiment(experiment.Experiment):
     def common_name_to_special_alignment(self):
         name_to_al = {}
 
-        if self.fns['common_sequence_special_alignments'].exists():
-            for al in pysam.AlignmentFile(self.fns['common_sequence_special_alignments']):
+        if self.pool.shares_common_sequences:
+            fn = self.pool.fns['common_sequence_special_alignments']
+        else:
+            fn = self.fns['common_sequence_special_alignments']
+
+        if fn.exists():
+            for al in pysam.AlignmentFile(fn):
                 name_to_al[al.query_name] = al
 
         return name_to_al
@@ -374,8 +536,14 @@ class SingleGuideExperiment(experiment.Experiment):
     def common_name_to_alignments(self):
         common_name_to_alignments = {}
 
-        for common_name, als in self.common_sequence_experiment.alignment_groups():
-            common_name_to_alignments[common_name] = als
+        if self.pool.shares_common_sequences:
+            cs_exps = self.pool.common_sequence_chunk_exps()
+        else:
+            cs_exps = [self.common_sequence_experiment]
+
+        for cs_exp in cs_exps:
+            for common_name, als in cs_exp.alignment_groups():
+                common_name_to_alignments[common_name] = als
 
         return common_name_to_alignments
 
@@ -383,39 +551,61 @@ class SingleGuideExperiment(experiment.Experiment):
         ''' 
         Populate self.fns_by_read_type['fastq']['collapsed_uncommon_R2'] with fastq
         reads that don't have common sequences, and populate self.fns['qname_to_common_name']
-        with (qname, common_name) pairs for all reads that do have common sequences.
+        with an index of the common_name of all reads that do have common sequences.
+        Reads whose sequences are in the categorization cache are also left out,
+        and self.fns['qname_to_cached_sequence'] indexes their sequences.
         '''
 
-        qname_to_common_name = {}
+        if self.categorization_cache is not None:
+            seqs = {read.seq for read in self.collapsed_reads(no_progress=True)}
+            cached_seqs = self.cached_sequences(seqs - set(self.common_sequence_to_outcome))
+        else:
+            cached_seqs = set()
 
         fn = self.fns_by_read_type['fastq']['collapsed_uncommon_R2']
-        with gzip.open(fn, 'wt', compresslevel=1) as fh:
+        with compression.open_for_stage(fn, 'wt', self.pool.sample_sheet, 'collapsed_uncommon_R2') as fh, \
+             name_index.NameIndexWriter(self.fns['qname_to_common_name']) as qname_to_common_name, \
+             name_index.NameIndexWriter(self.fns['qname_to_cached_sequence']) as qname_to_cached_sequence:
+
             for read in self.collapsed_reads():
+                common_name = None
+                cached_seq = None
+
                 if read.seq in self.common_sequence_to_outcome:
                     outcome = self.common_sequence_to_outcome[read.seq]
-                    qname_to_common_name[read.name] = outcome.query_name
+                    common_name = outcome.query_name
+                elif read.seq in cached_seqs:
+                    cached_seq = read.seq
                 else:
                     fh.write(str(read))
 
-        with open(self.fns['qname_to_common_name'], 'w') as fh:
-            for qname, common_name in qname_to_common_name.items():
-                fh.write(f'{qname}\t{common_name}\n')
+                qname_to_common_name.add(read.name, common_name)
+                qname_to_cached_sequence.add(read.name, cached_seq)
+
+        if self.fns['qname_to_common_name_text'].exists():
+            self.fns['qname_to_common_name_text'].unlink()
+
+        for key in ['qname_to_common_name', 'qname_to_cached_sequence']:
+            if hasattr(self, f'_memoized_{key}'):
+                delattr(self, f'_memoized_{key}')
 
     @memoized_property
     def qname_to_common_name(self):
-        qname_to_common_name = {}
+        ''' Memory-mapped index from qname to common_name, for reads that have
+        common sequences. Supports get, in, and [] like a dictionary.
+        '''
+        index = name_index.NameIndex(self.fns['qname_to_common_name'])
 
-        with open(self.fns['qname_to_common_name']) as fh:
-            for line in fh:
-                qname, common_name = line.strip().split('\t')
-                qname_to_common_name[qname] = common_name
+        if not index.exists() and self.fns['qname_to_common_name_text'].exists():
+            index = name_index.NameIndex.from_text(self.fns['qname_to_common_name_text'], self.fns['qname_to_common_name'])
 
-        return qname_to_common_name
+        return index
                 
     @property
     def collapsed_uncommon_reads(self):
         fn = self.fns_by_read_type['fastq']['collapsed_uncommon_R2']
-        return self.progress(fastq.reads(fn))
+        threads = compression.get_settings(self.pool.sample_sheet, 'collapsed_uncommon_R2')['threads']
+        return self.progress(compression.reads(fn, threads=threads))
 
     @memoized_property
     def combined_header(self):
@@ -439,22 +629,74 @@ class SingleGuideExperiment(experiment.Experiment):
         alignment_groups = self.alignment_groups(fn_key='bam_by_name', read_type=bam_read_type)
         reads = self.reads_by_type('collapsed_R2')
 
+        # Common names were recorded in the same order as reads, so can be
+        # streamed alongside them instead of looked up. Indices converted
+        # from older text files have no read order, so are looked up per read.
+        if not self.use_memoized_outcomes:
+            common_names = itertools.repeat(None)
+        elif self.qname_to_common_name.has_read_order():
+            common_names = self.qname_to_common_name.values_in_read_order()
+        else:
+            common_names = None
+
+        if self.use_memoized_outcomes and self.qname_to_cached_sequence.exists():
+            cached_entries = self.cached_entries_in_read_order()
+        else:
+            cached_entries = itertools.repeat(None)
+
         if max_reads is not None:
             reads = itertools.islice(reads, max_reads)
 
         special_als = defaultdict(list)
 
-        with self.fns['outcome_list'].open('w') as outcome_fh, \
-             self.fns['genomic_insertion_seqs'].open('w') as genomic_insertion_seqs_fh:
+        # Newly categorized sequences to add to the categorization cache,
+        # stored in batches.
+        to_cache = {}
+        cache_batch_size = 10000
+
+        # Alignments of reads categorized from the cache are rebuilt into
+        # their own bam, in read order and therefore sorted by name.
+        cached_bam_fn = self.fns_by_read_type['bam_by_name']['collapsed_cached_R2']
+        if cached_bam_fn.exists():
+            cached_bam_fn.unlink()
+
+        cached_header = None
+        outcomes_with_cached_reads = set()
+
+        with ExitStack() as stack:
+            outcome_fh = stack.enter_context(self.fns['outcome_list'].open('w'))
+            genomic_insertion_seqs_fh = stack.enter_context(self.fns['genomic_insertion_seqs'].open('w'))
+            cached_bam_fh = None
 
             outcome_fh.write(f'## Generated at {utilities.current_time_string()}\n')
 
             for read in self.progress(reads, desc='Categorizing reads'):
-                if self.use_memoized_outcomes and read.name in self.qname_to_common_name:
-                    common_sequence_name = self.qname_to_common_name[read.name]
+                if common_names is not None:
+                    common_sequence_name = next(common_names)
+                else:
+                    common_sequence_name = self.qname_to_common_name.get(read.name)
+
+                cached_entry = next(cached_entries)
+
+                if common_sequence_name is not None:
                     layout = self.common_name_to_outcome[common_sequence_name]
                     special_alignment = self.common_name_to_special_alignment.get(common_sequence_name)
 
+                elif cached_entry is not None:
+                    common_sequence_name = ''
+                    fields, serialized_special_alignment, serialized_als = cached_entry
+                    layout = outcome_record.CommonSequenceOutcomeRecord(read.name, *fields, read.seq)
+                    special_alignment = categorization_cache.deserialize_special_alignment(serialized_special_alignment)
+
+                    if cached_bam_fh is None:
+                        cached_header = self.categorization_cache.header()
+                        cached_bam_fh = stack.enter_context(pysam.AlignmentFile(cached_bam_fn, 'wb', header=cached_header))
+
+                    for al in categorization_cache.deserialize_alignments(serialized_als, cached_header, read.name):
+                        cached_bam_fh.write(al)
+
+                    outcomes_with_cached_reads.add((layout.category, layout.subcategory))
+
                 else:
                     common_sequence_name = ''
                     name, als = next(alignment_groups)
@@ -477,6 +719,17 @@ class SingleGuideExperiment(experiment.Experiment):
 
                     special_alignment = layout.special_alignment
 
+                    if self.categorization_cache is not None:
+                        fields = (layout.inferred_amplicon_length, layout.category, layout.subcategory, layout.details)
+                        to_cache[read.seq] = (fields,
+                                              categorization_cache.serialize_special_alignment(special_alignment),
+                                              categorization_cache.serialize_alignments(als),
+                                             )
+
+                        if len(to_cache) >= cache_batch_size:
+                            self.store_in_categorization_cache(to_cache, bam_read_type)
+                            to_cache = {}
+
                 if special_alignment is not None:
                     special_als[layout.category, layout.subcategory].append(special_alignment)
 
@@ -526,6 +779,9 @@ class SingleGuideExperiment(experiment.Experiment):
                 
                 times.append(time.monotonic())
 
+        if len(to_cache) > 0:
+            self.store_in_categorization_cache(to_cache, bam_read_type)
+
         # To make plotting easier, for each outcome, make a file listing all of
         # qnames for the outcome and a bam file (sorted by name) with all of the
         # alignments for these qnames.
@@ -542,6 +798,9 @@ class SingleGuideExperiment(experiment.Experiment):
             outcome_fns['dir'].mkdir()
 
             alignment_sorters[outcome] = outcome_fns['bam_by_name'][bam_read_type]
+
+            if outcome in outcomes_with_cached_reads:
+                alignment_sorters['collapsed_cached_R2', outcome] = (outcome_fns['bam_by_name']['collapsed_cached_R2'], cached_header)
             
             with outcome_fns['query_names'].open('w') as fh:
                 for qname in qnames:
@@ -555,6 +814,13 @@ class SingleGuideExperiment(experiment.Experiment):
                     if al.query_name in qname_to_outcome:
                         outcome = qname_to_outcome[al.query_name]
                         alignment_sorters[outcome].write(al)
+
+            if len(outcomes_with_cached_reads) > 0:
+                with pysam.AlignmentFile(cached_bam_fn) as cached_bam_fh:
+                    for al in cached_bam_fh:
+                        outcome = qname_to_outcome[al.query_name]
+                        alignment_sorters['collapsed_cached_R2', outcome].write(al)
+
             pysam.set_verbosity(saved_verbosity)
 
         # Make special alignments bams.
@@ -594,19 +860,24 @@ class SingleGuideExperiment(experiment.Experiment):
 
     def collapse_UMI_outcomes(self):
         outcome_iter = self.outcome_iter(outcome_fn_keys=['outcome_list'])
-        all_collapsed_outcomes, most_abundant_outcomes = coherence.collapse_pooled_UMI_outcomes(outcome_iter)
-        with self.fns['collapsed_UMI_outcomes'].open('w') as fh:
-            for outcome in all_collapsed_outcomes:
-                fh.write(str(outcome) + '\n')
-        
-        with self.fns['cell_outcomes'].open('w') as fh:
-            for outcome in most_abundant_outcomes:
-                fh.write(str(outcome) + '\n')
-        
-        with self.fns['filtered_cell_outcomes'].open('w') as fh:
-            for outcome in most_abundant_outcomes:
-                if outcome.num_reads >= self.min_reads_per_UMI:
-                    fh.write(str(outcome) + '\n')
+
+        # Outcomes are listed in the order of collapsed reads, which are
+        # grouped by UMI in sorted order.
+        UMI_groups = coherence.iter_collapsed_UMI_outcomes(outcome_iter, presorted=True)
+
+        with self.fns['collapsed_UMI_outcomes'].open('w') as collapsed_fh, \
+             self.fns['cell_outcomes'].open('w') as cell_fh, \
+             self.fns['filtered_cell_outcomes'].open('w') as filtered_cell_fh:
+
+            for collapsed_outcomes, most_abundant_outcome in UMI_groups:
+                for outcome in collapsed_outcomes:
+                    collapsed_fh.write(str(outcome) + '\n')
+
+                if most_abundant_outcome is not None:
+                    cell_fh.write(str(most_abundant_outcome) + '\n')
+
+                    if most_abundant_outcome.num_reads >= self.min_reads_per_UMI:
+                        filtered_cell_fh.write(str(most_abundant_outcome) + '\n')
 
     def make_filtered_cell_bams(self):
         # Make bams containing only alignments from final cell assignments for IGV browsing.
@@ -962,6 +1233,11 @@ class SingleGuideExperiment(experiment.Experiment):
         return ranges.Ranges(self.target_info, self.target_info.target, range_iter, total_reads, exps=[self])
 
     def align(self):
+        # Shards left by an earlier sharded run would otherwise be merged
+        # in place of this run's outcomes.
+        if self.fns['shards_dir'].exists():
+            shutil.rmtree(str(self.fns['shards_dir']))
+
         if self.use_memoized_outcomes:
             self.extract_uncommon_sequences()
             read_type = 'collapsed_uncommon_R2'
@@ -973,7 +1249,11 @@ class SingleGuideExperiment(experiment.Experiment):
         self.combine_alignments(read_type)
 
     def categorize(self):
-        self.categorize_outcomes()
+        if self.fns['shards_dir'].exists():
+            self.merge_shard_outcomes()
+        else:
+            self.categorize_outcomes()
+
         self.collapse_UMI_outcomes()
 
         self.generate_outcome_counts()
@@ -989,6 +1269,130 @@ class SingleGuideExperiment(experiment.Experiment):
         #self.make_filtered_cell_bams()
         #self.make_outcome_plots(num_examples=3)
 
+    def shard(self, shard_index):
+        return SingleGuideExperimentShard(self.base_dir, self.pool_name, self.fixed_guide, self.variable_guide, shard_index, pool=self.pool)
+
+    @property
+    def shards(self):
+        shard_dirs = sorted(self.fns['shards_dir'].glob('shard_*'))
+        return [self.shard(int(d.name[len('shard_'):])) for d in shard_dirs]
+
+    def split_into_shards(self, num_shards):
+        ''' Splits collapsed reads into up to num_shards contiguous shards of
+        equal size, to be aligned and categorized by separate workers and then
+        merged back with merge_shard_alignments and merge_shard_outcomes.
+        '''
+        if self.fns['shards_dir'].exists():
+            shutil.rmtree(str(self.fns['shards_dir']))
+
+        fn = self.fns_by_read_type['fastq']['collapsed_R2']
+
+        num_reads = sum(1 for _ in compression.records(fn))
+        reads_per_shard = max(1, int(np.ceil(num_reads / num_shards)))
+
+        with ExitStack() as stack:
+            shard_fhs = []
+
+            for i, (name, record) in enumerate(compression.records(fn)):
+                shard_index = i // reads_per_shard
+
+                if shard_index == len(shard_fhs):
+                    shard = self.shard(shard_index)
+                    shard.results_dir.mkdir(parents=True)
+                    shard_fn = shard.fns_by_read_type['fastq']['collapsed_R2']
+                    shard_fhs.append(stack.enter_context(compression.open_for_stage(shard_fn, 'wb', self.pool.sample_sheet, 'collapsed_R2')))
+
+                shard_fhs[shard_index].write(record)
+
+    def merge_shard_alignments(self):
+        ''' Combines the alignments and common sequence lookups of shards that
+        have each been aligned, in shard order so that the result matches
+        the order of collapsed reads.
+        '''
+        shards = self.shards
+
+        if self.use_memoized_outcomes:
+            read_type = 'collapsed_uncommon_R2'
+        else:
+            read_type = 'collapsed_R2'
+
+        bam_fns = [str(shard.fns_by_read_type['bam_by_name'][read_type]) for shard in shards]
+        pysam.cat('-o', str(self.fns_by_read_type['bam_by_name'][read_type]), *bam_fns)
+
+        if self.use_memoized_outcomes:
+            # Concatenated gzip members are a valid gzip file.
+            with open(self.fns_by_read_type['fastq'][read_type], 'wb') as fh:
+                for shard in shards:
+                    with open(shard.fns_by_read_type['fastq'][read_type], 'rb') as shard_fh:
+                        shutil.copyfileobj(shard_fh, fh)
+
+            for key in ['qname_to_common_name', 'qname_to_cached_sequence']:
+                name_index.concatenate([shard.fns[key] for shard in shards], self.fns[key])
+
+                if hasattr(self, f'_memoized_{key}'):
+                    delattr(self, f'_memoized_{key}')
+
+    def merge_shard_outcomes(self):
+        ''' Combines the outcomes of shards into the files categorize_outcomes
+        would have written for the whole experiment, then removes the shards.
+        '''
+        shards = self.shards
+
+        # Shards are categorized by separate workers, but any that weren't
+        # are categorized here.
+        for shard in shards:
+            if not shard.fns['outcome_list'].exists():
+                shard.categorize_outcomes()
+
+        with self.fns['outcome_list'].open('w') as outcome_fh, \
+             self.fns['genomic_insertion_seqs'].open('w') as genomic_insertion_seqs_fh:
+
+            outcome_fh.write(f'## Generated at {utilities.current_time_string()}\n')
+
+            for shard in shards:
+                with shard.fns['outcome_list'].open() as shard_fh:
+                    for line in shard_fh:
+                        if not line.startswith('##'):
+                            outcome_fh.write(line)
+
+                with shard.fns['genomic_insertion_seqs'].open() as shard_fh:
+                    shutil.copyfileobj(shard_fh, genomic_insertion_seqs_fh)
+
+        cached_bam_fn = self.fns_by_read_type['bam_by_name']['collapsed_cached_R2']
+        if cached_bam_fn.exists():
+            cached_bam_fn.unlink()
+
+        shard_cached_bam_fns = [str(shard.fns_by_read_type['bam_by_name']['collapsed_cached_R2']) for shard in shards]
+        shard_cached_bam_fns = [fn for fn in shard_cached_bam_fns if Path(fn).exists()]
+        if len(shard_cached_bam_fns) > 0:
+            pysam.cat('-o', str(cached_bam_fn), *shard_cached_bam_fns)
+
+        if self.fns['outcomes_dir'].is_dir():
+            shutil.rmtree(str(self.fns['outcomes_dir']))
+
+        self.fns['outcomes_dir'].mkdir()
+
+        # Per-outcome directories hold text files of qnames and bams sorted
+        # by name, both of which can be concatenated in shard order.
+        bam_fns = defaultdict(list)
+
+        for shard in shards:
+            for shard_outcome_dir in shard.fns['outcomes_dir'].iterdir():
+                outcome_dir = self.fns['outcomes_dir'] / shard_outcome_dir.name
+                outcome_dir.mkdir(exist_ok=True)
+
+                for shard_fn in shard_outcome_dir.iterdir():
+                    if shard_fn.suffix == '.bam':
+                        bam_fns[outcome_dir / shard_fn.name].append(str(shard_fn))
+                    else:
+                        with open(shard_fn) as shard_fh, open(outcome_dir / shard_fn.name, 'a') as fh:
+                            shutil.copyfileobj(shard_fh, fh)
+
+        for fn, shard_fns in bam_fns.items():
+            pysam.cat('-o', str(fn), *shard_fns)
+
+        shutil.rmtree(str(self.fns['shards_dir']))
+
 class SingleGuideNoUMIExperiment(SingleGuideExperiment):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1001,12 +1405,12 @@ class SingleGuideNoUMIExperiment(SingleGuideExperiment):
 
     def preprocess(self):
         self.merge_read_chunks()
-        self.extract_and_process_common_sequences()
+        self.process_or_count_common_sequences()
 
     def merge_read_chunks(self):
         # Since chunks are deleted after being merged, if they aren't there, assume merging has
         # already been done.
-        if not self.fns['chunks'].exists():
+        if not self.has_unprocessed_chunks:
             return
 
         ti = self.target_info
@@ -1022,8 +1426,8 @@ class SingleGuideNoUMIExperiment(SingleGuideExperiment):
         Annotation_in = annotations.Annotations['R2_with_guide']
         Annotation_out = annotations.Annotations['R2_with_guide_mismatches']
 
-        with gzip.open(self.fns_by_read_type['fastq']['collapsed_R2'], 'wt', compresslevel=1) as combined_fh, \
-             gzip.open(self.fns_by_read_type['fastq']['low_quality_R2'], 'wt', compresslevel=1) as low_quality_fh:
+        with compression.open_for_stage(self.fns_by_read_type['fastq']['collapsed_R2'], 'wt', self.pool.sample_sheet, 'collapsed_R2') as combined_fh, \
+             compression.open_for_stage(self.fns_by_read_type['fastq']['low_quality_R2'], 'wt', self.pool.sample_sheet, 'low_quality_R2') as low_quality_fh:
 
             for read in self.reads:
                 mismatches = []
@@ -1046,7 +1450,7 @@ class SingleGuideNoUMIExperiment(SingleGuideExperiment):
                     low_quality_fh.write(str(read))
 
         # To minimize resouce usage, delete chunks after merging them.
-        shutil.rmtree(str(self.fns['chunks']))
+        self.remove_chunks()
 
     def generate_outcome_counts(self):
         outcome_fn_keys = ['outcome_list']
@@ -1110,6 +1514,92 @@ class CommonSequenceExperiment(SingleGuideExperiment):
     def final_Outcome(self):
         return outcome_record.CommonSequenceOutcomeRecord
 
+class CommonSequenceChunkExperiment(CommonSequenceExperiment):
+    ''' One chunk of the common sequences shared by all experiments in a pool.
+    Sequences are categorized against the target of the pool's
+    common_sequence_guides.
+    '''
+    def __init__(self, base_dir, pool_name, chunk_index, *args, **kwargs):
+        # Needed by results_dir, which is used during super().__init__.
+        self.chunk_index = chunk_index
+
+        pool = kwargs['pool']
+        fixed_guide, variable_guide = pool.common_sequence_guides
+
+        super().__init__(base_dir, (pool_name, 'common_sequences'), fixed_guide, variable_guide, *args, **kwargs)
+
+    @memoized_property
+    def results_dir(self):
+        return self.pool.fns['common_sequences_dir'] / f'chunk_{self.chunk_index:06d}'
+
+class SingleGuideExperimentShard(SingleGuideExperiment):
+    ''' A contiguous slice of the collapsed reads of an experiment with many
+    more reads than most, aligned and categorized by its own worker.
+    '''
+    def __init__(self, base_dir, pool_name, fixed_guide, variable_guide, shard_index, *args, **kwargs):
+        # Needed by results_dir, which is used during super().__init__.
+        self.shard_index = shard_index
+
+        super().__init__(base_dir, pool_name, fixed_guide, variable_guide, *args, **kwargs)
+
+        # Common sequences processed by the whole experiment.
+        for key in ['common_sequences_dir', 'common_sequence_outcomes', 'common_sequence_special_alignments']:
+            self.fns[key] = self.parent.fns[key]
+
+    @memoized_property
+    def parent(self):
+        return self.pool.single_guide_experiment(self.fixed_guide, self.variable_guide, no_progress=True)
+
+    @memoized_property
+    def results_dir(self):
+        return self.parent.fns['shards_dir'] / f'shard_{self.shard_index:03d}'
+
+    def categorize(self):
+        # The rest of categorization is done by the parent on merged outcomes.
+        self.categorize_outcomes()
+
+def write_common_sequences(cs_exp, ranked_seq_counts, first_rank=0):
+    ''' Writes (seq, count) pairs as reads to be aligned and categorized by
+    cs_exp, named by their rank and count.
+    '''
+    # Include one value outside of the solexa range to allow automatic detection.
+    qual = fastq.encode_sanger([25] + [40] * 1000)
+
+    Annotation = annotations.Annotations['common_sequence']
+
+    fn = cs_exp.fns_by_read_type['fastq']['collapsed_R2']
+
+    with compression.open_for_stage(fn, 'wt', cs_exp.pool.sample_sheet, 'common_sequences') as fh:
+        for rank, (seq, count) in enumerate(ranked_seq_counts, first_rank):
+            name = str(Annotation(rank=rank, count=count))
+            read = fastq.Read(name, seq, qual[:len(seq)])
+            fh.write(str(read))
+
+def enumerate_simple_edits(amplicon, cut, window, max_insertion_length):
+    ''' Returns the set of sequences produced from amplicon (with cut bases
+    before the cut site) by no edit, a single deletion lying entirely within
+    window nts of the cut, or an insertion of up to max_insertion_length nts
+    at a position within window nts of the cut.
+    '''
+    start = max(0, cut - window)
+    end = min(len(amplicon), cut + window)
+
+    seqs = {amplicon}
+
+    for deletion_start in range(start, end):
+        for deletion_end in range(deletion_start + 1, end + 1):
+            seqs.add(amplicon[:deletion_start] + amplicon[deletion_end:])
+
+    insertions = [''.join(bases) for length in range(1, max_insertion_length + 1)
+                  for bases in itertools.product(utilities.base_order[:4], repeat=length)
+                 ]
+
+    for position in range(start, end + 1):
+        for inserted in insertions:
+            seqs.add(amplicon[:position] + inserted + amplicon[position:])
+
+    return seqs
+
 def collapse_categories(df):
     # Collapse details, retaining subcategories.
     possibly_collapse = [
@@ -1206,6 +1696,7 @@ class PooledScreen:
         self.layout_mode = self.sample_sheet.get('layout_mode', 'cutting')
 
         self.Experiment = SingleGuideExperiment
+        self.shards_experiments = True
 
         index_names = self.sample_sheet.get('supplemental_indices')
 
@@ -1219,9 +1710,44 @@ class PooledScreen:
 
         self.min_reads_per_UMI = self.sample_sheet.get('min_reads_per_UMI', 4)
 
+        self.UMI_subsample = subsample.Subsample.from_sample_sheet(self.sample_sheet)
+
+        # If set, common sequences from all experiments are aligned and
+        # categorized once for the whole pool instead of once per experiment.
+        # This assumes that categorization of outcome reads doesn't depend on
+        # the variable guide, i.e. that its protospacer isn't sequenced.
+        self.shares_common_sequences = self.sample_sheet.get('share_common_sequences', False)
+        self.common_sequences_per_chunk = self.sample_sheet.get('common_sequences_per_chunk', 10000)
+
+        # If set, the common sequence store also holds every read expected from
+        # wild type or a simple deletion or insertion near the cut site, so that
+        # reads with these outcomes never need to be aligned or categorized.
+        self.enumerates_simple_edits = self.sample_sheet.get('enumerate_simple_edits', False)
+        self.simple_edit_window = self.sample_sheet.get('simple_edit_window', 20)
+        self.simple_edit_max_insertion_length = self.sample_sheet.get('simple_edit_max_insertion_length', 2)
+
+        if self.enumerates_simple_edits and not self.shares_common_sequences:
+            raise ValueError('enumerate_simple_edits requires share_common_sequences')
+
+        # Experiments with more than this many reads in read_counts are split
+        # into shards for the align and categorize stages. If not given, this
+        # is 4 times the median. Set to 0 to never split experiments.
+        self.reads_per_shard = self.sample_sheet.get('reads_per_shard')
+
+        # See categorization_cache for details.
+        cache_setting = self.sample_sheet.get('categorization_cache', False)
+        if cache_setting is True:
+            self.categorization_cache_fn = self.base_dir / 'categorization_cache.sqlite'
+        elif cache_setting:
+            self.categorization_cache_fn = Path(cache_setting)
+        else:
+            self.categorization_cache_fn = None
+
         self.fns = {
             'read_counts': self.dir / 'read_counts.txt',
 
+            'read_chunks': self.dir / 'read_chunks',
+
             'outcome_counts': self.dir  / 'outcome_counts.npz',
             'total_outcome_counts': self.dir / 'total_outcome_counts.txt',
             'collapsed_outcome_counts': self.dir / 'collapsed_outcome_counts.npz',
@@ -1241,6 +1767,10 @@ class PooledScreen:
 
             'special_alignments_dir': self.dir / 'special_alignments',
 
+            'common_sequences_dir': self.dir / 'common_sequences',
+            'common_sequence_outcomes': self.dir / 'common_sequences' / 'common_sequence_outcomes.txt',
+            'common_sequence_special_alignments': self.dir / 'common_sequences' / 'all_special_alignments.bam',
+
             'filtered_templated_insertion_details': self.dir / 'filtered_templated_insertion_details.hdf5',
             'filtered_duplication_details': self.dir / 'filtered_duplication_details.hdf5',
             
@@ -1330,6 +1860,52 @@ class PooledScreen:
         else:
             return self.guide_combinations
 
+    @memoized_property
+    def experiment_shard_counts(self):
+        ''' Number of shards to split each experiment with more than
+        reads_per_shard reads into. Experiments not listed aren't split.
+        '''
+        if not self.shards_experiments or self.reads_per_shard == 0 or not self.fns['read_counts'].exists():
+            return {}
+
+        read_counts = pd.read_csv(self.fns['read_counts'], sep='\t', index_col=[0, 1]).squeeze('columns')
+        read_counts = read_counts[[fg != 'unknown' and vg != 'unknown' for fg, vg in read_counts.index.values]]
+
+        if len(read_counts) == 0:
+            return {}
+
+        if self.reads_per_shard is None:
+            reads_per_shard = max(1, int(4 * read_counts.median()))
+        else:
+            reads_per_shard = self.reads_per_shard
+
+        shard_counts = {}
+        for (fixed_guide, variable_guide), count in read_counts.items():
+            num_shards = int(np.ceil(count / reads_per_shard))
+            if num_shards > 1:
+                shard_counts[fixed_guide, variable_guide] = num_shards
+
+        return shard_counts
+
+    def remove_demuxed_reads(self):
+        ''' Deletes demuxed reads that haven't been preprocessed yet, both
+        per-experiment chunks and partitioned containers. Experiment
+        directories are found on disk so that experiments needn't be made.
+        '''
+        for chunks_dir in self.dir.glob('*/*/chunks'):
+            shutil.rmtree(str(chunks_dir))
+
+        if self.fns['read_chunks'].exists():
+            shutil.rmtree(str(self.fns['read_chunks']))
+
+    @memoized_property
+    def read_chunk_containers(self):
+        ''' Partitioned read chunks written by demux, each holding reads for
+        many guide combinations.
+        '''
+        fns = sorted(self.fns['read_chunks'].glob('*.partitioned_fastq'))
+        return [partitioned_fastq.PartitionedFastq(fn) for fn in fns]
+
     def guide_combinations_for_gene(self, gene, **kwargs):
         if isinstance(gene, (list, tuple)):
             return self.guide_combinations_for_gene_pair(gene)
@@ -2306,6 +2882,117 @@ class PooledScreen:
         sizes = [len(groups[name]) for name in group_order]
         return ordered, sizes
 
+    @memoized_property
+    def common_sequence_guides(self):
+        ''' The (fixed_guide, variable_guide) experiment whose target is used to
+        categorize shared common sequences.
+        '''
+        if 'common_sequence_guides' in self.sample_sheet:
+            fixed_guide, variable_guide = self.sample_sheet['common_sequence_guides']
+        else:
+            fixed_guide, variable_guide = self.guide_combinations_by_read_count[0]
+
+        return fixed_guide, variable_guide
+
+    @memoized_property
+    def categorization_cache_context(self):
+        exp = self.single_guide_experiment(*self.common_sequence_guides, no_progress=True)
+        return exp.categorization_cache_context
+
+    def simple_edit_sequences(self):
+        ''' Reads expected from wild type and from every single deletion and
+        short insertion within simple_edit_window nts of the cut site.
+        '''
+        exp = self.single_guide_experiment(*self.common_sequence_guides, no_progress=True)
+        ti = exp.target_info
+
+        interval = ti.amplicon_interval
+        amplicon = ti.target_sequence[interval.start:interval.end + 1]
+        cut = ti.cut_after - interval.start + 1
+
+        edited = enumerate_simple_edits(amplicon, cut, self.simple_edit_window, self.simple_edit_max_insertion_length)
+
+        if ti.sequencing_direction == '-':
+            edited = {utilities.reverse_complement(seq) for seq in edited}
+
+        return {seq[:self.R2_read_length] for seq in edited}
+
+    def common_sequence_chunk_exp(self, chunk_index):
+        return CommonSequenceChunkExperiment(self.base_dir, self.name, chunk_index, pool=self)
+
+    def common_sequence_chunk_exps(self):
+        chunk_dirs = sorted(self.fns['common_sequences_dir'].glob('chunk_*'))
+        return [self.common_sequence_chunk_exp(int(d.name[len('chunk_'):])) for d in chunk_dirs]
+
+    def common_sequence_chunk_exp_for_name(self, common_name):
+        rank = annotations.Annotations['common_sequence'].from_identifier(common_name)['rank']
+        return self.common_sequence_chunk_exp(int(rank) // self.common_sequences_per_chunk)
+
+    def make_common_sequence_store(self, num_processes, logger):
+        ''' Combines the common sequences counted by every experiment and aligns
+        and categorizes each distinct sequence once, in parallel chunks.
+        '''
+        protospacer_lengths = self.variable_guide_library.guides_df['protospacer'].str.len()
+        if protospacer_lengths.nunique() > 1:
+            raise ValueError('share_common_sequences requires variable guide protospacers of equal length')
+
+        seq_counts = Counter()
+        for fixed_guide, variable_guide in self.guide_combinations_by_read_count:
+            exp = self.single_guide_experiment(fixed_guide, variable_guide, no_progress=True)
+            for seq, count in exp.common_sequence_counts:
+                seq_counts[seq] += count
+
+        if self.enumerates_simple_edits:
+            # Enumerated sequences that weren't seen as common rank last, with a
+            # count of 0.
+            for seq in self.simple_edit_sequences():
+                seq_counts[seq] += 0
+
+        # Sequences with cached outcomes are looked up by each experiment instead.
+        cached = self.common_sequence_chunk_exp(0).cached_sequences(seq_counts)
+        for seq in cached:
+            del seq_counts[seq]
+
+        # Ties are broken by sequence so that ranks are reproducible.
+        ranked = sorted(seq_counts.items(), key=lambda seq_count: (-seq_count[1], seq_count[0]))
+
+        store_dir = self.fns['common_sequences_dir']
+        if store_dir.exists():
+            shutil.rmtree(str(store_dir))
+
+        chunk_size = self.common_sequences_per_chunk
+
+        arg_tuples = []
+
+        for chunk_index, first_rank in enumerate(range(0, len(ranked), chunk_size)):
+            cs_exp = self.common_sequence_chunk_exp(chunk_index)
+            cs_exp.results_dir.mkdir(parents=True)
+            write_common_sequences(cs_exp, ranked[first_rank:first_rank + chunk_size], first_rank=first_rank)
+
+            arg_tuples.append((self.base_dir, self.name, chunk_index))
+
+        with parallel.PoolWithLoggerThread(num_processes, logger) as process_pool:
+            process_pool.starmap(process_common_sequence_chunk, arg_tuples)
+
+        store_dir.mkdir(exist_ok=True)
+
+        with open(self.fns['common_sequence_outcomes'], 'w') as fh:
+            for cs_exp in self.common_sequence_chunk_exps():
+                for outcome in cs_exp.outcome_iter():
+                    fh.write(f'{outcome}\n')
+
+        self.merge_common_sequence_special_alignments()
+
+    @memoized_property
+    def common_sequence_outcomes(self):
+        outcomes = []
+
+        with open(self.fns['common_sequence_outcomes']) as fh:
+            for line in fh:
+                outcomes.append(outcome_record.CommonSequenceOutcomeRecord.from_line(line))
+
+        return outcomes
+
     def merge_common_sequence_special_alignments(self):
         chunks = self.common_sequence_chunk_exps()
 
@@ -2634,20 +3321,81 @@ class PooledScreen:
 
         print(f'Logging in {log_fn}')
 
-        def process_stage(stage):
+        for stage in ['preprocess', 'align', 'categorize']:
+            self.process_experiment_stage(stage, num_processes, logger)
+
+        self.merge_experiment_outputs()
+
+        logger.removeHandler(file_handler)
+        file_handler.close()
+
+    def process_experiment_stage(self, stage, num_processes, logger):
+        guide_combinations = self.guide_combinations_by_read_count
+
+        # Experiments with many more reads than most would otherwise leave
+        # their workers running alone long after the rest have finished,
+        # so they are aligned and categorized in shards by several workers.
+        if stage == 'align' and num_processes > 1:
+            shard_counts = self.experiment_shard_counts
+        elif stage == 'categorize':
+            # Experiments that were aligned in shards.
+            shard_counts = {}
+            for fixed_guide, variable_guide in self.experiment_shard_counts:
+                exp = self.single_guide_experiment(fixed_guide, variable_guide, no_progress=True)
+                num_shards = len(exp.shards)
+                if num_shards > 0:
+                    shard_counts[fixed_guide, variable_guide] = num_shards
+        else:
+            shard_counts = {}
+
+        with parallel.PoolWithLoggerThread(num_processes, logger) as process_pool:
+            if stage == 'align' and len(shard_counts) > 0:
+                arg_tuples = [(self.base_dir, self.name, fixed_guide, variable_guide, num_shards)
+                              for (fixed_guide, variable_guide), num_shards in shard_counts.items()
+                             ]
+                process_pool.starmap(split_single_guide_experiment, arg_tuples)
+
+                # Splitting may have produced fewer shards than asked for, or
+                # none for an experiment with no collapsed reads, which is
+                # then processed unsharded and not merged.
+                for fixed_guide, variable_guide in list(shard_counts):
+                    exp = self.single_guide_experiment(fixed_guide, variable_guide, no_progress=True)
+                    num_shards = len(exp.shards)
+                    if num_shards > 0:
+                        shard_counts[fixed_guide, variable_guide] = num_shards
+                    else:
+                        del shard_counts[fixed_guide, variable_guide]
+
             arg_tuples = []
 
-            for exp_i, (fixed_guide, variable_guide) in enumerate(self.guide_combinations_by_read_count):
-                arg_tuple = (self.base_dir, self.name, fixed_guide, variable_guide, stage, None, exp_i, len(self.guide_combinations_by_read_count))
-                arg_tuples.append(arg_tuple)
+            for exp_i, (fixed_guide, variable_guide) in enumerate(guide_combinations):
+                common_args = (self.base_dir, self.name, fixed_guide, variable_guide, stage, None, exp_i, len(guide_combinations))
 
-            with parallel.PoolWithLoggerThread(num_processes, logger) as process_pool:
-                process_pool.starmap(process_single_guide_experiment_stage, arg_tuples)
+                if (fixed_guide, variable_guide) in shard_counts:
+                    for shard_index in range(shard_counts[fixed_guide, variable_guide]):
+                        arg_tuples.append(common_args + (shard_index,))
+                else:
+                    arg_tuples.append(common_args)
+
+            process_pool.starmap(process_single_guide_experiment_stage, arg_tuples)
+
+            if len(shard_counts) > 0:
+                arg_tuples = [(self.base_dir, self.name, fixed_guide, variable_guide, stage)
+                              for fixed_guide, variable_guide in shard_counts
+                             ]
+                process_pool.starmap(merge_single_guide_experiment_shards, arg_tuples)
+
+        if stage == 'preprocess':
+            # Every experiment has now consumed its partitions of any
+            # pool-level read chunk containers.
+            if self.fns['read_chunks'].exists():
+                shutil.rmtree(str(self.fns['read_chunks']))
 
-        process_stage('preprocess')
-        process_stage('align')
-        process_stage('categorize')
+            # Every experiment has now counted its common sequences.
+            if self.shares_common_sequences:
+                self.make_common_sequence_store(num_processes, logger)
 
+    def merge_experiment_outputs(self):
         self.generate_outcome_counts()
         self.merge_templated_insertion_details()
         self.extract_genomic_insertion_length_distributions()
@@ -2657,15 +3405,13 @@ class PooledScreen:
         #self.merge_deletion_ranges()
         #self.merge_templated_insertion_details(fn_key='filtered_duplication_details')
         #self.merge_special_alignments()
-
-        logger.removeHandler(file_handler)
-        file_handler.close()
         
 class PooledScreenNoUMI(PooledScreen):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.Experiment = SingleGuideNoUMIExperiment
+        self.shards_experiments = False
 
     read_counts = PooledScreen.UMI_counts
 
@@ -2768,18 +3514,57 @@ def process_single_guide_experiment_stage(base_dir,
                                           progress=None,
                                           guide_index=None,
                                           total_guides=None,
+                                          shard_index=None,
                                          ):
     pool = get_pool(base_dir, pool_name, progress=progress)
     exp = pool.single_guide_experiment(fixed_guide, variable_guide)
 
     progress_string = f'({guide_index + 1: >7,} / {total_guides: >7,})'
     stage_string = f'{fixed_guide}-{variable_guide} {stage}'
+
+    if shard_index is not None:
+        exp = exp.shard(shard_index)
+        stage_string = f'{fixed_guide}-{variable_guide} shard {shard_index} {stage}'
     logging.info(f'{progress_string} Started {stage_string}')
 
     exp.process(stage)
 
     logging.info(f'{progress_string} Finished {stage_string}')
 
+def split_single_guide_experiment(base_dir, pool_name, fixed_guide, variable_guide, num_shards, progress=None):
+    pool = get_pool(base_dir, pool_name, progress=progress)
+    exp = pool.single_guide_experiment(fixed_guide, variable_guide)
+
+    exp.split_into_shards(num_shards)
+
+    logging.info(f'Split {fixed_guide}-{variable_guide} into {len(exp.shards)} shards')
+
+def merge_single_guide_experiment_shards(base_dir, pool_name, fixed_guide, variable_guide, stage, progress=None):
+    ''' Merges shards after they have each been through stage. After
+    categorize, this also does the rest of categorize for the whole experiment.
+    '''
+    pool = get_pool(base_dir, pool_name, progress=progress)
+    exp = pool.single_guide_experiment(fixed_guide, variable_guide)
+
+    if stage == 'align':
+        exp.merge_shard_alignments()
+    elif stage == 'categorize':
+        exp.process('categorize')
+    else:
+        raise ValueError(f'stage can\'t be sharded: {stage}')
+
+    logging.info(f'Merged shards of {fixed_guide}-{variable_guide} {stage}')
+
+def process_common_sequence_chunk(base_dir, pool_name, chunk_index, progress=None):
+    pool = get_pool(base_dir, pool_name, progress=progress)
+    cs_exp = pool.common_sequence_chunk_exp(chunk_index)
+
+    logging.info(f'Started common sequence chunk {chunk_index}')
+
+    cs_exp.process()
+
+    logging.info(f'Finished common sequence chunk {chunk_index}')
+
 class PooledScreenExplorer(explore.Explorer):
     def __init__(self,
                  pool,
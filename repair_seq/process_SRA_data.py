@@ -59,7 +59,7 @@ def download_data(base_dir, screen_name, debug=False):
         fastq_dump_command += f' {sra_fn}'
         subprocess.run(shlex.split(fastq_dump_command), check=True)
 
-def demux(base_dir, screen_name, debug=False):
+def demux(base_dir, screen_name, debug=False, subsample=None):
     has_UMIs = repair_seq.demux.load_SRA_sample_sheet().loc[screen_name, 'has_UMIs']
     
     if has_UMIs:
@@ -67,4 +67,4 @@ def demux(base_dir, screen_name, debug=False):
     else:
         demux_module = repair_seq.demux_gDNA
 
-    demux_module.demux_group(base_dir, screen_name, from_SRA=True, debug=debug)
+    demux_module.demux_group(base_dir, screen_name, from_SRA=True, debug=debug, subsample=subsample)
@@ -0,0 +1,219 @@
+import functools
+import os
+import pickle
+
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+def resolve_to_none(*args):
+    ''' Resolver for pools without multiple fixed guides. Everything is kept
+    to allow possibility of outcomes that don't include the intended NotI site.
+    Defined at module level (rather than as a closure) so that compiled
+    resolvers can be pickled.
+    '''
+    return {'none'}
+
+def compile_resolvers(fn, get_resolvers, *args):
+    ''' Calls get_resolvers(*args) and stores the result in fn so that demux
+    workers can load it instead of rebuilding one-mismatch dictionaries (and
+    possibly TargetInfo's) for every chunk.
+    '''
+    fn = Path(fn)
+
+    resolvers = get_resolvers(*args)
+
+    # Write to a process-specific temporary name and rename so that a worker
+    # can never load a partially written file.
+    temp_fn = fn.with_name(f'{fn.name}.{os.getpid()}.tmp')
+    with open(temp_fn, 'wb') as fh:
+        pickle.dump(resolvers, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    temp_fn.rename(fn)
+
+    return resolvers
+
+@functools.lru_cache(maxsize=None)
+def _load_resolvers(fn, mtime):
+    with open(fn, 'rb') as fh:
+        resolvers = pickle.load(fh)
+    return resolvers
+
+def load_resolvers(fn, get_resolvers, *args):
+    ''' Loads resolvers compiled by compile_resolvers, compiling them first if
+    they don't exist yet. Loaded resolvers are cached for the lifetime of the
+    process, so workers that handle many chunks only load them once.
+    '''
+    fn = Path(fn)
+
+    if not fn.exists():
+        compile_resolvers(fn, get_resolvers, *args)
+
+    return _load_resolvers(fn, fn.stat().st_mtime_ns)
+
+# Maps ASCII bytes to 2-bit base codes. Anything other than ACGT is marked as
+# invalid and resolved through the original dictionary instead.
+INVALID = 255
+base_codes = np.full(256, INVALID, dtype=np.uint8)
+for i, b in enumerate(b'ACGT'):
+    base_codes[b] = i
+
+def pack(seq_bytes):
+    ''' Packs an (n, length) array of ASCII bases into (n,) keys made up of
+    ceil(length / 32) big-endian uint64 words with 2 bits per base, viewed as
+    a single fixed-width void so that keys sort and compare as a unit.
+    Also returns a boolean array marking rows that contained anything other
+    than ACGT.
+    '''
+    n, length = seq_bytes.shape
+
+    codes = base_codes[seq_bytes]
+    invalid = (codes == INVALID).any(axis=1)
+
+    num_words = max(1, -(-length // 32))
+    words = np.zeros((n, num_words), dtype='>u8')
+
+    for i in range(length):
+        w = i // 32
+        words[:, w] = (words[:, w] << np.uint64(2)) | (codes[:, i] & 3)
+
+    keys = np.ascontiguousarray(words).view(np.dtype((np.void, 8 * num_words))).ravel()
+
+    return keys, invalid
+
+def seqs_to_array(seqs, length):
+    return np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).reshape(len(seqs), length)
+
+class PackedResolver:
+    ''' Batched equivalent of a resolver from utilities.get_one_mismatch_resolver.
+    Sequences (including all one-mismatch neighbors already present as keys in the
+    resolver dictionary) are packed into 2-bit integers and stored in sorted tables,
+    one per sequence length, so that whole batches of reads can be resolved with
+    np.searchsorted instead of a dictionary lookup per read.
+
+    resolve_sets returns an array of indices into self.name_sets (the distinct sets
+    of names the resolver can return), with -1 for sequences it doesn't contain.
+    resolve returns an array of indices into self.names, with -1 for sequences that
+    don't resolve to exactly one name (i.e. would have been called 'unknown').
+    '''
+    def __init__(self, resolver):
+        self.constant = None
+
+        if resolver is resolve_to_none:
+            self.dictionary = {}
+            self.name_sets = [frozenset({'none'})]
+            self.constant = 0
+        else:
+            # Resolvers are stored as the bound .get of a dictionary.
+            self.dictionary = getattr(resolver, '__self__', resolver)
+            self.name_sets = sorted({frozenset(names) for names in self.dictionary.values()}, key=sorted)
+
+        self.names = sorted({name for names in self.name_sets for name in names})
+        # Indexing with -1 gives 'unknown'.
+        self.names_with_unknown = self.names + ['unknown']
+
+        name_to_index = {name: i for i, name in enumerate(self.names)}
+        self.set_to_index = {names: i for i, names in enumerate(self.name_sets)}
+
+        # Maps set indices to name indices, with -1 for sets with more than one name.
+        # The extra final entry maps set index -1 to -1.
+        self.set_to_name = np.array([name_to_index[next(iter(names))] if len(names) == 1 else -1 for names in self.name_sets] + [-1], dtype=np.int32)
+
+        by_length = defaultdict(list)
+        for seq, names in self.dictionary.items():
+            by_length[len(seq)].append((seq, self.set_to_index[frozenset(names)]))
+
+        self.tables = {}
+        for length, pairs in by_length.items():
+            seqs = [seq for seq, value in pairs]
+            values = np.array([value for seq, value in pairs], dtype=np.int32)
+
+            keys, invalid = pack(seqs_to_array(seqs, length))
+
+            # Keys containing non-ACGT characters are only reachable through the
+            # dictionary fallback.
+            keys = keys[~invalid]
+            values = values[~invalid]
+
+            order = np.argsort(keys)
+            self.tables[length] = (keys[order], values[order])
+
+    def resolve_one(self, seq):
+        names = self.dictionary.get(seq)
+        if names is None:
+            return -1
+        else:
+            return self.set_to_index[frozenset(names)]
+
+    def resolve_sets(self, seqs):
+        ''' seqs: list of str '''
+        n = len(seqs)
+
+        if self.constant is not None:
+            return np.full(n, self.constant, dtype=np.int32)
+
+        resolved = np.full(n, -1, dtype=np.int32)
+
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=n)
+
+        for length in np.unique(lengths):
+            rows = np.flatnonzero(lengths == length)
+            self.resolve_rows(rows, seqs_to_array([seqs[i] for i in rows], length), resolved)
+
+        return resolved
+
+    def resolve_sets_array(self, seq_bytes, lengths):
+        ''' Equivalent of resolve_sets for sequences given as an (n, width) array
+        of ASCII bases, zero-padded past each sequence's length, as produced by
+        fastq_cython.FastqColumn.seq_array.
+        '''
+        n = len(lengths)
+
+        if self.constant is not None:
+            return np.full(n, self.constant, dtype=np.int32)
+
+        resolved = np.full(n, -1, dtype=np.int32)
+
+        for length in np.unique(lengths):
+            rows = np.flatnonzero(lengths == length)
+            self.resolve_rows(rows, seq_bytes[rows, :length], resolved)
+
+        return resolved
+
+    def resolve_rows(self, rows, seq_bytes, resolved):
+        ''' Fills in resolved[rows] for the equal-length sequences in seq_bytes. '''
+        length = seq_bytes.shape[1]
+        if length not in self.tables:
+            return
+
+        keys, invalid = pack(seq_bytes)
+
+        table_keys, table_values = self.tables[length]
+
+        if len(table_keys) > 0:
+            positions = np.searchsorted(table_keys, keys)
+            positions = np.minimum(positions, len(table_keys) - 1)
+            found = (table_keys[positions] == keys) & ~invalid
+            resolved[rows[found]] = table_values[positions[found]]
+
+        for i in np.flatnonzero(invalid):
+            resolved[rows[i]] = self.resolve_one(seq_bytes[i].tobytes().decode())
+
+    def resolve(self, seqs):
+        ''' seqs: list of str '''
+        return self.set_to_name[self.resolve_sets(seqs)]
+
+_packed_resolvers = {}
+
+def pack_resolvers(resolvers):
+    ''' Wraps every resolver in a dictionary of resolvers (as returned by
+    load_resolvers) in a PackedResolver. Packed tables are cached for as long
+    as the loaded resolvers are.
+    '''
+    key = id(resolvers)
+    if key not in _packed_resolvers:
+        packed = {name: PackedResolver(resolver) for name, resolver in resolvers.items()}
+        # Hold a reference to resolvers so that id can't be reused.
+        _packed_resolvers[key] = (resolvers, packed)
+
+    return _packed_resolvers[key][1]
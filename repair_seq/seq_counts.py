@@ -0,0 +1,109 @@
+''' Compact binary files of sequence (or id) counts that can be merged with
+vectorized operations.
+
+Keys are stored as a fixed-width bytes array, with the fields of tuple keys
+joined by tabs, alongside an int64 array of counts.
+'''
+
+import numpy as np
+
+def encode_key(key):
+    if isinstance(key, tuple):
+        key = '\t'.join(key)
+    return key.encode()
+
+def decode_key(key):
+    key = key.decode()
+    if '\t' in key:
+        key = tuple(key.split('\t'))
+    return key
+
+def write_counts(fn, counts):
+    ''' counts: dict-like of key -> count, where keys are strs or tuples of strs. '''
+    keys = np.array([encode_key(key) for key in counts], dtype=bytes)
+    values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+
+    with open(fn, 'wb') as fh:
+        np.savez(fh, keys=keys, counts=values)
+
+def load_counts(fn):
+    with np.load(fn) as data:
+        return data['keys'], data['counts']
+
+def combine(keys, counts):
+    ''' Sums counts of identical keys. Returned keys are sorted. '''
+    if len(keys) == 0:
+        return keys, counts
+
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    summed = np.bincount(inverse.ravel(), weights=counts, minlength=len(unique_keys)).astype(np.int64)
+
+    return unique_keys, summed
+
+def merge_counts(fns):
+    ''' Exact merge of count files. '''
+    all_keys = []
+    all_counts = []
+
+    for fn in fns:
+        keys, counts = load_counts(fn)
+        all_keys.append(keys)
+        all_counts.append(counts)
+
+    if len(all_keys) == 0:
+        return np.array([], dtype=bytes), np.array([], dtype=np.int64)
+
+    return combine(np.concatenate(all_keys), np.concatenate(all_counts))
+
+def most_common(keys, counts, n=None):
+    ''' Returns (key, count) pairs in descending order of count, with ties
+    broken by key.
+    '''
+    order = np.lexsort([keys, -counts])
+    if n is not None:
+        order = order[:n]
+
+    return [(decode_key(keys[i]), int(counts[i])) for i in order]
+
+def to_dict(keys, counts):
+    return {decode_key(key): int(count) for key, count in zip(keys, counts)}
+
+class HeavyHitters:
+    ''' Bounded-memory Misra-Gries summary that holds at most capacity keys.
+    Whole batches of (keys, counts) are folded in at once. Whenever more than
+    capacity keys are held, the (capacity + 1)-th largest count is subtracted
+    from every key and keys that drop to zero or below are discarded.
+
+    Reported counts are underestimates by at most max_error, and any key whose
+    true count exceeds max_error is guaranteed to be present.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.keys = np.array([], dtype=bytes)
+        self.counts = np.array([], dtype=np.int64)
+        self.total = 0
+        self.max_error = 0
+
+    def update(self, keys, counts):
+        self.total += int(counts.sum())
+
+        keys, counts = combine(np.concatenate([self.keys, keys]), np.concatenate([self.counts, counts]))
+
+        if len(keys) > self.capacity:
+            threshold = np.partition(counts, len(counts) - self.capacity - 1)[len(counts) - self.capacity - 1]
+            counts = counts - threshold
+            self.max_error += int(threshold)
+
+            keep = counts > 0
+            keys = keys[keep]
+            counts = counts[keep]
+
+        self.keys = keys
+        self.counts = counts
+
+    def update_from_files(self, fns):
+        for fn in fns:
+            self.update(*load_counts(fn))
+
+    def most_common(self, n=None):
+        return most_common(self.keys, self.counts, n)
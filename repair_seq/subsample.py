@@ -0,0 +1,52 @@
+''' Deterministic subsampling of UMIs (or of reads, for libraries without UMIs).
+
+A key is kept if a hash of it falls in the lowest fraction of the hash range.
+This depends only on the key, fraction, and seed, so demux, collapsing and
+categorization all keep the same UMIs, reruns keep the same UMIs, and which
+UMIs are kept is unrelated to where reads are on a flowcell.
+
+Since reads with sequencing errors in their UMI hash differently from the
+rest of their UMI family, a few such reads from families that weren't kept
+make it through as small families of their own.
+
+Subsampling is recorded in pool sample sheets as
+
+    UMI_subsample:
+        fraction: 0.02
+        seed: 0
+'''
+
+import hashlib
+
+class Subsample:
+    def __init__(self, fraction, seed=0):
+        if not 0 < fraction <= 1:
+            raise ValueError(f'subsample fraction must be in (0, 1], not {fraction}')
+
+        self.fraction = fraction
+        self.seed = seed
+
+        self.threshold = int(fraction * 2**64)
+        self.prefix = f'{seed}:'.encode()
+
+    def __repr__(self):
+        return f'Subsample(fraction={self.fraction}, seed={self.seed})'
+
+    def __eq__(self, other):
+        return isinstance(other, Subsample) and (self.fraction, self.seed) == (other.fraction, other.seed)
+
+    def __contains__(self, key):
+        digest = hashlib.blake2b(self.prefix + key.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') < self.threshold
+
+    def to_dict(self):
+        return {'fraction': self.fraction, 'seed': self.seed}
+
+    @classmethod
+    def from_sample_sheet(cls, sample_sheet):
+        ''' Returns the Subsample recorded in sample_sheet, or None. '''
+        details = sample_sheet.get('UMI_subsample')
+        if details is None:
+            return None
+        else:
+            return cls(details['fraction'], seed=details.get('seed', 0))
@@ -0,0 +1,192 @@
+import random
+
+from types import SimpleNamespace
+
+import pytest
+
+from hits.utilities import group_by
+
+import repair_seq.coherence
+from repair_seq.collapse_cython import hamming_distance_matrix, register_corrections
+
+def mutate(rng, seq, num_mismatches, alphabet='ACGT'):
+    seq = list(seq)
+    for i in rng.sample(range(len(seq)), min(num_mismatches, len(seq))):
+        seq[i] = rng.choice(alphabet)
+    return ''.join(seq)
+
+def random_UMIs(rng, length, num_parents=20, num_UMIs=300):
+    ''' Distinct UMIs in descending order of abundance, clustered around a few
+    parents so that many are within a few mismatches of each other, with
+    occasional Ns.
+    '''
+    parents = [''.join(rng.choice('ACGT') for _ in range(length)) for _ in range(num_parents)]
+
+    UMIs = set()
+    for _ in range(num_UMIs):
+        alphabet = 'ACGTN' if rng.random() < 0.1 else 'ACGT'
+        UMIs.add(mutate(rng, rng.choice(parents), rng.randint(0, 3), alphabet))
+
+    UMIs = sorted(UMIs)
+    rng.shuffle(UMIs)
+
+    return UMIs
+
+def baseline_corrections(UMIs, max_UMI_distance):
+    return register_corrections(hamming_distance_matrix(UMIs), max_UMI_distance, UMIs)
+
+@pytest.mark.parametrize('max_UMI_distance', [0, 1, 2, 3])
+def test_register_corrections_indexed_matches_matrix(max_UMI_distance):
+    rng = random.Random(max_UMI_distance)
+
+    # Lengths 1 and 2 have fewer bases than segments for larger distances.
+    for length in [1, 2, 4, 8, 12, 13]:
+        for _ in range(5):
+            UMIs = random_UMIs(rng, length)
+
+            expected = baseline_corrections(UMIs, max_UMI_distance)
+            assert repair_seq.coherence.register_corrections_indexed(UMIs, max_UMI_distance) == expected
+
+def test_register_corrections_indexed_trivial():
+    for UMIs in [['ACGT'], ['ACGT', 'ACGA'], ['NNNN', 'NNNA', 'ANNN']]:
+        for max_UMI_distance in [0, 1, 2]:
+            expected = baseline_corrections(UMIs, max_UMI_distance)
+            assert repair_seq.coherence.register_corrections_indexed(UMIs, max_UMI_distance) == expected
+
+def test_error_correct_outcome_UMIs_indexed_matches_matrix():
+    rng = random.Random(0)
+
+    for _ in range(20):
+        UMIs = random_UMIs(rng, 12, num_UMIs=100)
+
+        outcomes = [(rng.choice(UMIs), rng.randint(1, 50)) for _ in range(200)]
+
+        def corrected_UMIs(indexed):
+            outcome_group = [SimpleNamespace(UMI=UMI, num_reads=num_reads) for UMI, num_reads in outcomes]
+            outcome_group = repair_seq.coherence.error_correct_outcome_UMIs(outcome_group, indexed=indexed)
+            return [outcome.UMI for outcome in outcome_group]
+
+        assert corrected_UMIs(True) == corrected_UMIs(False)
+
+def baseline_collapse_pooled_UMI_outcomes(outcome_iter):
+    ''' collapse_pooled_UMI_outcomes as written before it streamed over UMIs. '''
+    def is_relevant(outcome):
+        return (outcome.category != 'bad sequence' and
+                outcome.outcome != ('no indel', 'other', 'ambiguous')
+               )
+
+    all_outcomes = [o for o in outcome_iter if is_relevant(o)]
+    all_outcomes = sorted(all_outcomes, key=lambda u: (u.UMI, u.cluster_id))
+
+    all_collapsed_outcomes = []
+    most_abundant_outcomes = []
+
+    for UMI, UMI_outcomes in group_by(all_outcomes, lambda u: u.UMI):
+        observed = set(u.outcome for u in UMI_outcomes)
+
+        collapsed_outcomes = []
+        for outcome in observed:
+            relevant = [u for u in UMI_outcomes if u.outcome == outcome]
+            representative = max(relevant, key=lambda u: u.num_reads)
+            representative.num_reads = sum(u.num_reads for u in relevant)
+
+            collapsed_outcomes.append(representative)
+            all_collapsed_outcomes.append(representative)
+
+        max_count = max(u.num_reads for u in collapsed_outcomes)
+        has_max_count = [u for u in collapsed_outcomes if u.num_reads == max_count]
+
+        if len(has_max_count) == 1:
+            most_abundant_outcomes.append(has_max_count[0])
+
+    all_collapsed_outcomes = sorted(all_collapsed_outcomes, key=lambda u: (u.UMI, u.cluster_id))
+    return all_collapsed_outcomes, most_abundant_outcomes
+
+def random_outcome_lines(rng, num_UMIs=200):
+    ''' Lines of Pooled_UMI_Outcomes, with several clusters per UMI that often
+    share an outcome or a number of reads, and some outcomes that collapsing
+    ignores.
+    '''
+    outcomes = [
+        ('wild type', 'clean', 'n/a'),
+        ('deletion', 'clean', 'D:{-5..-3},4'),
+        ('insertion', 'clean', 'I:{2},A'),
+        ('no indel', 'other', 'ambiguous'),
+        ('bad sequence', 'n/a', 'n/a'),
+    ]
+
+    UMIs = sorted({''.join(rng.choice('ACGT') for _ in range(10)) for _ in range(num_UMIs)})
+
+    lines = []
+    for UMI in UMIs:
+        num_clusters = rng.randint(1, 6)
+        for cluster_id in rng.sample(range(20), num_clusters):
+            category, subcategory, details = rng.choice(outcomes)
+            fields = [
+                UMI,
+                rng.randint(0, 1),
+                f'{cluster_id:06d}',
+                rng.choice([1, 1, 2, 3, 5, 10]),
+                rng.randint(100, 200),
+                category,
+                subcategory,
+                details,
+                f'{UMI}_{cluster_id:06d}',
+                'n/a',
+            ]
+            lines.append('\t'.join(map(str, fields)))
+
+    return lines
+
+def parse(lines):
+    # Collapsing modifies num_reads in place, so every run needs its own outcomes.
+    return [repair_seq.coherence.Pooled_UMI_Outcome.from_line(line) for line in lines]
+
+def as_strings(all_collapsed_outcomes, most_abundant_outcomes):
+    return [str(o) for o in all_collapsed_outcomes], [str(o) for o in most_abundant_outcomes]
+
+def sorted_by_UMI(lines, rng):
+    ''' lines grouped by UMI, but in a random order within each UMI. '''
+    return sorted(lines, key=lambda line: (line.split('\t')[0], rng.random()))
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_collapse_pooled_UMI_outcomes_matches_baseline(seed):
+    rng = random.Random(seed)
+
+    lines = random_outcome_lines(rng)
+    rng.shuffle(lines)
+
+    expected = as_strings(*baseline_collapse_pooled_UMI_outcomes(parse(lines)))
+    assert len(expected[0]) > 0 and len(expected[1]) > 0
+
+    assert as_strings(*repair_seq.coherence.collapse_pooled_UMI_outcomes(parse(lines))) == expected
+
+    presorted_lines = sorted_by_UMI(lines, rng)
+    assert as_strings(*repair_seq.coherence.collapse_pooled_UMI_outcomes(parse(presorted_lines), presorted=True)) == expected
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100])
+def test_iter_collapsed_UMI_outcomes_spilled_matches_baseline(chunk_size):
+    rng = random.Random(chunk_size)
+
+    lines = random_outcome_lines(rng)
+    rng.shuffle(lines)
+
+    expected = as_strings(*baseline_collapse_pooled_UMI_outcomes(parse(lines)))
+
+    all_collapsed_outcomes = []
+    most_abundant_outcomes = []
+    for collapsed_outcomes, most_abundant_outcome in repair_seq.coherence.iter_collapsed_UMI_outcomes(parse(lines), chunk_size=chunk_size):
+        all_collapsed_outcomes.extend(collapsed_outcomes)
+        if most_abundant_outcome is not None:
+            most_abundant_outcomes.append(most_abundant_outcome)
+
+    assert as_strings(all_collapsed_outcomes, most_abundant_outcomes) == expected
+
+def test_presorted_rejects_unsorted_outcomes():
+    rng = random.Random(0)
+
+    lines = random_outcome_lines(rng)
+    rng.shuffle(lines)
+
+    with pytest.raises(ValueError):
+        repair_seq.coherence.collapse_pooled_UMI_outcomes(parse(lines), presorted=True)
@@ -0,0 +1,291 @@
+''' Compares UMI clustering and consensus calling with the recursive,
+per-read implementation they replaced, which is reproduced here as written
+before the switch to per-family arrays (apart from comparing reads to seeds
+shorter than them, which the original left undefined).
+'''
+
+import array
+import random
+
+from collections import Counter
+
+import numpy as np
+import pysam
+import pytest
+
+from hits import fastq, utilities
+
+import repair_seq.collapse
+from repair_seq.annotations import Annotations
+from repair_seq.collapse_cython import hq_mismatches_from_seed
+
+# Baseline implementation.
+
+def baseline_consensus_seq_and_qs(reads, max_read_length, bam):
+    if max_read_length is None:
+        max_read_length = len(reads[0].query_sequence)
+
+    statistics = fastq.quality_and_complexity(reads, max_read_length, alignments=bam, min_q=30)
+    shape = statistics['c'].shape
+
+    rl_range = np.arange(max_read_length)
+
+    fields = [
+        ('c_above_min_q', int),
+        ('c', int),
+        ('average_q', float),
+    ]
+
+    stat_tuples = np.zeros(shape, dtype=fields)
+    for k in ['c_above_min_q', 'c', 'average_q']:
+        stat_tuples[k] = statistics[k]
+
+    argsorted = stat_tuples.argsort()
+    second_best_idxs, best_idxs = argsorted[:, -2:].T
+
+    best_stats = stat_tuples[rl_range, best_idxs]
+
+    majority = (best_stats['c'] / len(reads)) > 0.5
+    at_least_one_hq = best_stats['c_above_min_q'] > 0
+
+    qs = np.full(max_read_length, repair_seq.collapse.LOW_Q, dtype=int)
+    qs[majority & at_least_one_hq] = repair_seq.collapse.HIGH_Q
+
+    ties = (best_stats == stat_tuples[rl_range, second_best_idxs])
+
+    best_idxs[ties] = utilities.base_to_index['N']
+    qs[ties] = repair_seq.collapse.N_Q
+
+    seq = ''.join(utilities.base_order[i] for i in best_idxs)
+
+    return seq, qs
+
+def baseline_call_consensus(reads, max_read_length, bam):
+    seq, qs = baseline_consensus_seq_and_qs(reads, max_read_length, bam)
+
+    if bam:
+        consensus = pysam.AlignedSegment()
+        consensus.query_sequence = seq
+        consensus.query_qualities = array.array('B', qs)
+        consensus.set_tag(repair_seq.collapse.NUM_READS_TAG, len(reads), 'i')
+    else:
+        guide_reads = []
+        for read in reads:
+            annotation = Annotations['UMI_guide'].from_identifier(read.name)
+            guide_read = fastq.Read('PH', annotation['guide'], annotation['guide_qual'])
+            guide_reads.append(guide_read)
+
+        guide_seq, guide_qs = baseline_consensus_seq_and_qs(guide_reads, None, False)
+        guide_qual = fastq.encode_sanger(guide_qs)
+
+        annotation = Annotations['collapsed_UMI'](UMI='PH',
+                                                  num_reads=len(reads),
+                                                  guide=guide_seq,
+                                                  guide_qual=guide_qual,
+                                                  cluster_id=0,
+                                                 )
+        name = str(annotation)
+        qual = fastq.encode_sanger(qs)
+        consensus = fastq.Read(name, seq, qual)
+
+    return consensus
+
+def padded_hq_mismatches_from_seed(seed, seq, qual, min_q):
+    ''' collapse_cython.hq_mismatches_from_seed reads past the end of a seed
+    shorter than seq, so for those seeds compare against the seed padded with
+    the NULs that end it instead.
+    '''
+    if len(seed) >= len(seq):
+        d = hq_mismatches_from_seed(seed, seq, qual, min_q)
+    else:
+        padded = seed.ljust(len(seq), b'\0')
+        d = sum(1 for s, b, q in zip(seq, padded, qual) if s != b and q >= min_q)
+
+    return d
+
+def baseline_within_radius_of_seed(seed, reads, max_hq_mismatches):
+    seed_b = seed.encode()
+    ds = [padded_hq_mismatches_from_seed(seed_b, read.query_sequence.encode(), read.query_qualities, 20)
+          for read in reads]
+
+    near_seed = []
+    remaining = []
+
+    for i, (d, al) in enumerate(zip(ds, reads)):
+        if d <= max_hq_mismatches:
+            near_seed.append(al)
+        else:
+            remaining.append(al)
+
+    return near_seed, remaining
+
+def baseline_propose_seed(reads, max_read_length, bam):
+    seqs = (read.query_sequence for read in reads)
+
+    seq_counts = Counter(seqs).most_common()
+
+    highest_count = seq_counts[0][1]
+    most_frequents = [s for s, c in seq_counts if c == highest_count]
+
+    # If there is a tie, take the alphabetically first for determinism.
+    seq = sorted(most_frequents)[0]
+
+    if highest_count > 1:
+        seed = seq
+    else:
+        consensus = baseline_call_consensus(reads, max_read_length, bam)
+        seed = consensus.query_sequence
+
+    return seed
+
+def baseline_form_clusters(reads, max_read_length=None, max_hq_mismatches=0, bam=False):
+    if len(reads) == 0:
+        clusters = []
+
+    elif len(reads) == 1:
+        clusters = [repair_seq.collapse.make_singleton_cluster(read, bam) for read in reads]
+
+    else:
+        seed = baseline_propose_seed(reads, max_read_length, bam)
+        near_seed, remaining = baseline_within_radius_of_seed(seed, reads, max_hq_mismatches)
+
+        if len(near_seed) == 0:
+            # didn't make progress, so give up
+            clusters = [repair_seq.collapse.make_singleton_cluster(read, bam) for read in reads]
+
+        else:
+            consensus_near_seed = baseline_call_consensus(near_seed, max_read_length, bam)
+            all_others = baseline_form_clusters(remaining, max_read_length, max_hq_mismatches, bam)
+            clusters = [consensus_near_seed] + all_others
+
+    return clusters
+
+# Random UMI families.
+
+def mutate(rng, seq, rate, alphabet='ACGT'):
+    return ''.join(rng.choice(alphabet) if rng.random() < rate else b for b in seq)
+
+def random_quals(rng, length):
+    return ''.join(rng.choice('##+5?FFII') for _ in range(length))
+
+def random_family(rng, length, variable_length):
+    ''' Reads sharing a UMI, drawn from a few molecules with sequencing errors,
+    occasional Ns and, if variable_length, trimmed to different lengths
+    no longer than length.
+    '''
+    UMI = ''.join(rng.choice('ACGT') for _ in range(12))
+    guide = ''.join(rng.choice('ACGT') for _ in range(20))
+
+    molecules = [''.join(rng.choice('ACGT') for _ in range(length))]
+    for _ in range(rng.randint(0, 2)):
+        molecules.append(mutate(rng, molecules[0], 0.1))
+
+    num_reads = rng.choice([2, 2, 3, 5, 8, 20])
+
+    reads = []
+    for i in range(num_reads):
+        seq = mutate(rng, rng.choice(molecules), 0.03, alphabet='ACGTN')
+
+        if variable_length and rng.random() < 0.5:
+            seq = seq[:rng.randint(length - 5, length)]
+
+        guide_seq = mutate(rng, guide, 0.05)
+
+        name = Annotations['UMI_guide'](UMI=UMI,
+                                        guide=guide_seq,
+                                        guide_qual=random_quals(rng, len(guide_seq)),
+                                        original_name=f'read{i}',
+                                       )
+        reads.append(fastq.Read(str(name), seq, random_quals(rng, len(seq))))
+
+    return reads
+
+def to_alignment(read):
+    al = pysam.AlignedSegment()
+    al.query_name = read.name
+    al.query_sequence = read.seq
+    al.query_qualities = array.array('B', fastq.decode_sanger(read.qual))
+    return al
+
+def cluster_tuple(cluster, bam):
+    if bam:
+        return (cluster.query_sequence, list(cluster.query_qualities), cluster.get_tag(repair_seq.collapse.NUM_READS_TAG))
+    else:
+        return (cluster.name, cluster.seq, cluster.qual)
+
+def families(seed, variable_length, num_families=300):
+    rng = random.Random(seed)
+    for _ in range(num_families):
+        length = rng.randint(20, 60)
+        yield random_family(rng, length, variable_length), length
+
+@pytest.mark.parametrize('bam', [False, True])
+@pytest.mark.parametrize('max_hq_mismatches', [0, 2])
+def test_form_clusters_matches_baseline(bam, max_hq_mismatches):
+    for reads, length in families(0, variable_length=False):
+        if bam:
+            reads = [to_alignment(read) for read in reads]
+
+        for max_read_length in [None, length]:
+            expected = baseline_form_clusters(reads, max_read_length, max_hq_mismatches, bam)
+            clusters = repair_seq.collapse.form_clusters(reads, max_read_length, max_hq_mismatches, bam)
+
+            assert [cluster_tuple(c, bam) for c in clusters] == [cluster_tuple(c, bam) for c in expected]
+
+@pytest.mark.parametrize('bam', [False, True])
+@pytest.mark.parametrize('max_hq_mismatches', [0, 2])
+def test_form_clusters_variable_length_matches_baseline(bam, max_hq_mismatches):
+    ''' Reads of different lengths, with consensuses called out to the
+    full read length as collapse_UMI_reads would with a max_read_length.
+    '''
+    for reads, length in families(1, variable_length=True):
+        if bam:
+            reads = [to_alignment(read) for read in reads]
+
+        expected = baseline_form_clusters(reads, length, max_hq_mismatches, bam)
+        clusters = repair_seq.collapse.form_clusters(reads, length, max_hq_mismatches, bam)
+
+        assert [cluster_tuple(c, bam) for c in clusters] == [cluster_tuple(c, bam) for c in expected]
+
+@pytest.mark.parametrize('variable_length', [False, True])
+def test_consensus_matches_baseline(variable_length):
+    for reads, length in families(2, variable_length=variable_length):
+        for max_read_length in [length, length + 3]:
+            expected_seq, expected_qs = baseline_consensus_seq_and_qs(reads, max_read_length, False)
+            seq, qs = repair_seq.collapse.consensus_seq_and_qs(reads, max_read_length, False)
+
+            assert seq == expected_seq
+            assert list(qs) == list(expected_qs)
+
+            expected = baseline_call_consensus(reads, max_read_length, False)
+            consensus = repair_seq.collapse.call_consensus(reads, max_read_length, False)
+
+            assert cluster_tuple(consensus, False) == cluster_tuple(expected, False)
+
+def test_consensus_from_arrays_matches_baseline():
+    ''' consensus_from_arrays directly on random count tensors, including
+    ties and positions past the end of every read.
+    '''
+    rng = random.Random(3)
+
+    for _ in range(500):
+        num_reads = rng.randint(1, 12)
+        length = rng.randint(1, 30)
+
+        reads = []
+        for i in range(num_reads):
+            read_length = rng.randint(0, length)
+            seq = ''.join(rng.choice('ACGTN') for _ in range(read_length))
+            reads.append(fastq.Read(f'read_{i}', seq, random_quals(rng, read_length)))
+
+        expected_seq, expected_qs = baseline_consensus_seq_and_qs(reads, length, False)
+
+        codes = repair_seq.collapse.base_to_code[repair_seq.collapse.strings_to_array([read.seq for read in reads])]
+        quals = repair_seq.collapse.strings_to_array([read.qual for read in reads], offset=fastq.SANGER_OFFSET)
+        codes = repair_seq.collapse.fit_to_width(codes, length, repair_seq.collapse.NOT_A_BASE)
+        quals = repair_seq.collapse.fit_to_width(quals, length, 0)
+
+        seq, qs = repair_seq.collapse.consensus_from_arrays(codes, quals, num_reads)
+
+        assert seq.decode() == expected_seq
+        assert list(qs) == list(expected_qs)
@@ -0,0 +1,77 @@
+import gzip
+import random
+import shutil
+
+import pytest
+
+import repair_seq.benchmark
+import repair_seq.demux
+import repair_seq.demux_engine
+
+reads_per_chunk = 200
+
+def split_into_members(fn, rng, max_member_size=2000):
+    ''' Recompresses fn as many gzip members of up to max_member_size
+    uncompressed bytes, each starting at an arbitrary byte (so usually partway
+    through a line), so that the file can be demuxed directly.
+    '''
+    data = gzip.decompress(fn.read_bytes())
+
+    with open(fn, 'wb') as fh:
+        start = 0
+        while start < len(data):
+            end = min(len(data), start + rng.randint(1, max_member_size))
+            fh.write(gzip.compress(data[start:end]))
+            start = end
+
+def demux_digests(screen, **kwargs):
+    results_dir = screen.base_dir / 'results'
+    if results_dir.exists():
+        shutil.rmtree(str(results_dir))
+
+    repair_seq.demux.demux_group(screen.base_dir, screen.group,
+                                 reads_per_chunk=reads_per_chunk,
+                                 num_processes=4,
+                                 restart=True,
+                                 **kwargs,
+                                )
+
+    return repair_seq.benchmark.experiment_read_digests(screen)
+
+@pytest.fixture(scope='module')
+def screen(tmp_path_factory):
+    base_dir = tmp_path_factory.mktemp('demux')
+
+    screen = repair_seq.benchmark.SyntheticScreen(base_dir,
+                                                  num_pools=2,
+                                                  num_units=2,
+                                                  num_guides=5,
+                                                  num_UMIs=150,
+                                                  mean_reads_per_UMI=3,
+                                                  R2_read_length=60,
+                                                 )
+    total_reads = screen.write(block_size=100)
+
+    rng = random.Random(0)
+    for fn in sorted(screen.data_dir.glob('*.fastq.gz')):
+        split_into_members(fn, rng, reads_per_chunk)
+
+    screen.test_total_reads = total_reads
+
+    return screen
+
+def test_direct_matches_chunked(screen):
+    chunked = demux_digests(screen)
+
+    # Every input file is indexable, so direct demux doesn't fall back to chunk files.
+    library = repair_seq.demux.UMILibrary(screen.base_dir, screen.group)
+    assert repair_seq.demux_engine.index_input_fastqs(library, reads_per_chunk) is not None
+
+    direct = demux_digests(screen, direct=True)
+
+    assert len(chunked) > 0
+    assert direct == chunked
+
+    # Demux only keeps reads that resolve to a pool and guide, but nearly all
+    # synthetic reads should.
+    assert sum(num_reads for num_reads, digest in chunked.values()) > 0.5 * screen.test_total_reads
@@ -0,0 +1,96 @@
+import gzip
+import itertools
+import random
+
+from hits import fastq
+
+import repair_seq.demux_engine
+
+def make_fastq_text(num_reads, rng):
+    lines = []
+    for i in range(num_reads):
+        length = rng.randint(5, 30)
+        seq = ''.join(rng.choice('ACGTN') for _ in range(length))
+        qual = ''.join(rng.choice('#+5?FI') for _ in range(length))
+        lines.extend([f'@read_{i:05d}', seq, '+', qual])
+
+    return ''.join(line + '\n' for line in lines).encode()
+
+def write_multi_member_gzip(fn, data, rng, split_points=None):
+    ''' Compresses data as consecutive gzip members split at arbitrary byte
+    positions, so that most members start partway through a line.
+    '''
+    if split_points is None:
+        split_points = sorted(rng.sample(range(1, len(data)), 40))
+
+    boundaries = [0] + list(split_points) + [len(data)]
+
+    with open(fn, 'wb') as fh:
+        for start, end in zip(boundaries, boundaries[1:]):
+            fh.write(gzip.compress(data[start:end]))
+
+def read_tuples(reads):
+    return [(read.name, read.seq, read.qual) for read in reads]
+
+def check_all_starts(fn, index_fn, num_reads):
+    index = repair_seq.demux_engine.FastqIndex(fn, index_fn)
+    index.build()
+
+    assert index.num_reads == num_reads
+
+    expected = read_tuples(fastq.reads(str(fn)))
+
+    for start in range(num_reads):
+        for n in [1, 3, num_reads]:
+            from_index = read_tuples(index.reads(start, n))
+            sequential = expected[start:start + n]
+            assert from_index == sequential, (start, n)
+
+        with index.open_binary(start) as fh:
+            first_line = fh.readline().decode().rstrip('\n')
+            assert first_line == f'@{expected[start][0]}', start
+
+def test_members_split_mid_line(tmp_path):
+    rng = random.Random(0)
+
+    num_reads = 60
+    data = make_fastq_text(num_reads, rng)
+
+    fn = tmp_path / 'R1.fastq.gz'
+    write_multi_member_gzip(fn, data, rng)
+
+    check_all_starts(fn, tmp_path / 'R1.index.npz', num_reads)
+
+def test_members_split_just_after_newlines(tmp_path):
+    ''' Members that start with the final character of a line, or exactly on
+    a line boundary, are the edge cases for choosing a member.
+    '''
+    rng = random.Random(1)
+
+    num_reads = 40
+    data = make_fastq_text(num_reads, rng)
+
+    newlines = [i for i, b in enumerate(data) if b == ord('\n')]
+    split_points = sorted({p for i in newlines[:-1:3] for p in (i, i + 1)})
+
+    fn = tmp_path / 'R1.fastq.gz'
+    write_multi_member_gzip(fn, data, rng, split_points=split_points)
+
+    check_all_starts(fn, tmp_path / 'R1.index.npz', num_reads)
+
+def test_matches_islice(tmp_path):
+    rng = random.Random(2)
+
+    num_reads = 50
+    data = make_fastq_text(num_reads, rng)
+
+    fn = tmp_path / 'R1.fastq.gz'
+    write_multi_member_gzip(fn, data, rng)
+
+    index = repair_seq.demux_engine.FastqIndex(fn, tmp_path / 'R1.index.npz')
+    index.build()
+
+    for start in range(num_reads):
+        n = rng.randint(1, 10)
+        expected = read_tuples(itertools.islice(fastq.reads(str(fn)), start, start + n))
+        assert read_tuples(index.reads(start, n)) == expected
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+import repair_seq.name_index
+
+def random_reads(rng, num_reads, num_values=30):
+    ''' (name, value or None) pairs in read order. '''
+    values = [f'common_{i}' for i in range(num_values)]
+
+    pairs = []
+    for i in range(num_reads):
+        # Names of varying widths, not given in sorted order.
+        name = f'{rng.randrange(10**rng.randint(1, 8)):x}_{i}'
+        value = rng.choice(values) if rng.random() < 0.6 else None
+        pairs.append((name, value))
+
+    return pairs
+
+def write_index(index_dir, pairs, batch_size=1000000):
+    with repair_seq.name_index.NameIndexWriter(index_dir, batch_size=batch_size) as writer:
+        for name, value in pairs:
+            writer.add(name, value)
+
+    # Batches written along the way are cleaned up.
+    assert writer.batch_dir is None
+
+    return repair_seq.name_index.NameIndex(index_dir)
+
+def check_lookups(index, pairs, rng):
+    expected = {name: value for name, value in pairs if value is not None}
+
+    assert len(index) == len(expected)
+    assert dict(index.items()) == expected
+
+    for name, value in pairs:
+        assert index.get(name) == value
+        assert (name in index) == (value is not None)
+
+    for name in ['', 'zz' * 20, 'not_a_read'] + [f'{name}x' for name, value in rng.sample(pairs, 10)]:
+        assert index.get(name) is None
+        assert name not in index
+
+# Small batches spill names to several temporary files of different widths.
+@pytest.mark.parametrize('batch_size', [1, 37, 1000000])
+def test_matches_text_file(tmp_path, batch_size):
+    rng = random.Random(0)
+    pairs = random_reads(rng, 3000)
+
+    # The format previously used for qname_to_common_name.
+    text_fn = tmp_path / 'qname_to_common_name.txt'
+    with open(text_fn, 'w') as fh:
+        for name, value in pairs:
+            if value is not None:
+                fh.write(f'{name}\t{value}\n')
+
+    from_text = repair_seq.name_index.NameIndex.from_text(text_fn, tmp_path / 'from_text')
+    check_lookups(from_text, pairs, rng)
+    assert not from_text.has_read_order()
+
+    index = write_index(tmp_path / 'index', pairs, batch_size)
+    check_lookups(index, pairs, rng)
+    assert index.has_read_order()
+
+    assert list(index.values_in_read_order(chunk_size=7)) == [value for name, value in pairs]
+
+@pytest.mark.parametrize('batch_size', [100, 1000000])
+def test_concatenate(tmp_path, batch_size):
+    rng = random.Random(1)
+    pairs = random_reads(rng, 2000)
+
+    bounds = [0, 500, 500, 1300, 2000]
+    index_dirs = []
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        index_dir = tmp_path / f'shard_{i}'
+        write_index(index_dir, pairs[start:end], batch_size)
+        index_dirs.append(index_dir)
+
+    repair_seq.name_index.concatenate(index_dirs, tmp_path / 'merged')
+    merged = repair_seq.name_index.NameIndex(tmp_path / 'merged')
+
+    check_lookups(merged, pairs, rng)
+    assert list(merged.values_in_read_order()) == [value for name, value in pairs]
+
+def test_empty(tmp_path):
+    index = write_index(tmp_path / 'index', [('a', None), ('b', None)])
+
+    assert len(index) == 0
+    assert index.get('a') is None
+    assert list(index.values_in_read_order()) == [None, None]
+
+def test_failed_write_removes_batches(tmp_path):
+    writer = repair_seq.name_index.NameIndexWriter(tmp_path / 'index', batch_size=2)
+
+    with pytest.raises(RuntimeError):
+        with writer:
+            for name, value in random_reads(random.Random(2), 100):
+                writer.add(name, value)
+            batch_dir = writer.batch_dir
+            raise RuntimeError
+
+    assert not batch_dir.exists()
+    assert not (tmp_path / 'index').exists()
@@ -0,0 +1,106 @@
+import random
+
+import numpy as np
+
+from hits import utilities
+
+import repair_seq.resolvers
+
+def random_seq(rng, length, alphabet='ACGT'):
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+def make_resolver(rng, lengths, num_per_length=20):
+    guides = {}
+    for length in lengths:
+        for i in range(num_per_length):
+            guides[f'guide_{length}_{i}'] = random_seq(rng, length)
+
+    # Give some names several sequences of different lengths, as guide
+    # resolvers do for multiple read lengths.
+    for i in range(5):
+        guides[f'multi_{i}'] = [random_seq(rng, length) for length in lengths]
+
+    return utilities.get_one_mismatch_resolver(guides)
+
+def query_seqs(rng, dictionary, lengths, num_seqs=2000):
+    known = sorted(dictionary)
+
+    seqs = []
+    for _ in range(num_seqs):
+        kind = rng.random()
+        if kind < 0.5:
+            seq = rng.choice(known)
+        elif kind < 0.8:
+            seq = random_seq(rng, rng.choice(lengths))
+        else:
+            # Non-ACGT characters and lengths that aren't in the resolver.
+            seq = random_seq(rng, rng.choice(lengths + [7, 33]), alphabet='ACGTNacgt.')
+        seqs.append(seq)
+
+    # Known sequences with an N are only resolvable through the dictionary.
+    seqs.extend(seq for seq in known[:200] if 'N' in seq)
+    seqs.append('')
+
+    return seqs
+
+def expected_name_sets(dictionary, seqs):
+    return [frozenset(dictionary[seq]) if seq in dictionary else None for seq in seqs]
+
+def test_resolve_sets_matches_dictionary():
+    rng = random.Random(0)
+
+    lengths = [19, 20, 45]
+    dictionary = make_resolver(rng, lengths)
+    packed = repair_seq.resolvers.PackedResolver(dictionary.get)
+
+    seqs = query_seqs(rng, dictionary, lengths)
+
+    resolved = [packed.name_sets[i] if i != -1 else None for i in packed.resolve_sets(seqs)]
+
+    assert resolved == expected_name_sets(dictionary, seqs)
+
+def test_resolve_sets_array_matches_dictionary():
+    rng = random.Random(1)
+
+    lengths = [8, 20, 70]
+    dictionary = make_resolver(rng, lengths)
+    packed = repair_seq.resolvers.PackedResolver(dictionary.get)
+
+    seqs = query_seqs(rng, dictionary, lengths)
+
+    width = max(len(seq) for seq in seqs)
+    seq_bytes = np.zeros((len(seqs), width), dtype=np.uint8)
+    for i, seq in enumerate(seqs):
+        seq_bytes[i, :len(seq)] = np.frombuffer(seq.encode(), dtype=np.uint8)
+
+    lengths = np.array([len(seq) for seq in seqs])
+
+    resolved = [packed.name_sets[i] if i != -1 else None for i in packed.resolve_sets_array(seq_bytes, lengths)]
+
+    assert resolved == expected_name_sets(dictionary, seqs)
+
+def test_resolve_matches_unique_names():
+    rng = random.Random(2)
+
+    lengths = [20]
+    dictionary = make_resolver(rng, lengths)
+    packed = repair_seq.resolvers.PackedResolver(dictionary.get)
+
+    seqs = query_seqs(rng, dictionary, lengths)
+
+    resolved = [packed.names_with_unknown[i] for i in packed.resolve(seqs)]
+
+    expected = []
+    for seq in seqs:
+        names = dictionary.get(seq, set())
+        expected.append(next(iter(names)) if len(names) == 1 else 'unknown')
+
+    assert resolved == expected
+
+def test_resolve_to_none():
+    packed = repair_seq.resolvers.PackedResolver(repair_seq.resolvers.resolve_to_none)
+
+    seqs = ['ACGT', 'NNNN', '']
+    resolved = [packed.name_sets[i] for i in packed.resolve_sets(seqs)]
+
+    assert resolved == [repair_seq.resolvers.resolve_to_none(seq) for seq in seqs]
@@ -0,0 +1,54 @@
+import random
+
+from collections import Counter
+
+import repair_seq.seq_counts
+
+def random_counts(rng, keys):
+    return Counter({key: rng.randint(1, 10**6) for key in rng.sample(keys, rng.randint(0, len(keys)))})
+
+def merged_as_counter(fns):
+    return Counter(repair_seq.seq_counts.to_dict(*repair_seq.seq_counts.merge_counts(fns)))
+
+def test_merge_counts_matches_counter_sum(tmp_path):
+    rng = random.Random(0)
+
+    keys = [''.join(rng.choice('ACGTN') for _ in range(rng.randint(1, 30))) for _ in range(500)]
+
+    fns = []
+    total = Counter()
+    for i in range(8):
+        counts = random_counts(rng, keys)
+        fn = tmp_path / f'{i}.npz'
+        repair_seq.seq_counts.write_counts(fn, counts)
+        fns.append(fn)
+        total += counts
+
+    assert merged_as_counter(fns) == total
+
+    expected_most_common = sorted(total.items(), key=lambda key_count: (-key_count[1], key_count[0]))[:20]
+    assert repair_seq.seq_counts.most_common(*repair_seq.seq_counts.merge_counts(fns), 20) == expected_most_common
+
+def test_merge_tuple_keys(tmp_path):
+    rng = random.Random(1)
+
+    keys = [(f'guide_{rng.randrange(50)}', f'sample_{rng.randrange(5)}') for _ in range(300)]
+    keys = sorted(set(keys))
+
+    fns = []
+    total = Counter()
+    for i in range(4):
+        counts = random_counts(rng, keys)
+        fn = tmp_path / f'{i}.npz'
+        repair_seq.seq_counts.write_counts(fn, counts)
+        fns.append(fn)
+        total += counts
+
+    assert merged_as_counter(fns) == total
+
+def test_merge_nothing(tmp_path):
+    empty_fn = tmp_path / 'empty.npz'
+    repair_seq.seq_counts.write_counts(empty_fn, Counter())
+
+    assert merged_as_counter([]) == Counter()
+    assert merged_as_counter([empty_fn]) == Counter()
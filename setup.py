@@ -46,5 +46,6 @@ setup(
     ext_package='repair_seq',
     ext_modules=[
         Extension('collapse_cython', ['repair_seq/collapse_cython.pyx']),
+        Extension('fastq_cython', ['repair_seq/fastq_cython.pyx']),
     ],
 )